@@ -1,14 +1,6 @@
-import yaml
 from pathlib import Path
 
+from src.registry import YamlRegistry
 
-story_dict = {}
-
-for file in Path("Persona").glob("*.yml"):
-    fname = file.stem
-    try:
-        story_dict[fname] = yaml.load(open(file, encoding='utf-8'), Loader=yaml.FullLoader)
-    except UnicodeDecodeError as e:
-        story_dict[fname] = yaml.load(open(file), Loader=yaml.FullLoader)
-    except yaml.scanner.ScannerError as e:
-        print("Error with ", file)
+# Personas are parsed on first access, see YamlRegistry
+story_dict = YamlRegistry(Path(__file__).parent)
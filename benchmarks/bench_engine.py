@@ -0,0 +1,212 @@
+"""Benchmarks of the orchestration engine against a zero-latency mock LLM.
+
+Every case is run for each session length (``--turns``, ``--scenario_turns``)
+and reports the time and the peak traced memory per turn, so that super-linear
+costs show up as a growing per-turn figure. Timing and memory are measured in separate passes,
+tracemalloc slowing the code it traces.
+
+Cases
+-----
+field
+    ``Field.run`` / ``add_chat`` / ``get_last_chat`` for ``--agents`` agents
+    taking turns, then ``view_dialog``.
+scenario
+    ``run_clinical_conversation.run_scenario`` end to end, artifacts and
+    checkpoints included.
+
+Example usage
+-------------
+
+```bash
+python benchmarks/bench_engine.py --output bench_before.json
+git checkout my-branch
+python benchmarks/bench_engine.py --output bench_after.json --compare bench_before.json
+```
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import prompts  # noqa: E402
+from engine.field import Field  # noqa: E402
+from engine.provider import MockProvider  # noqa: E402
+from engine.space import Space  # noqa: E402
+
+BENCH_PROMPT = "bench-agent"
+DEFAULT_TURNS = [10, 100, 1000, 10000]
+DEFAULT_SCENARIO_TURNS = [10, 100, 1000, 10000]
+
+
+def register_prompt(prompt_chars: int) -> None:
+    """Synthetic prompt script, ``prompt_chars`` long, asking for a json ``Response``."""
+    padding = ("Stay in character and answer briefly. " * (prompt_chars // 38 + 1))[:prompt_chars]
+    prompts.prompt_dict[BENCH_PROMPT] = {
+        "api_inps": {"model": "mock", "temperature": 0, "response_format": {"type": "json_object"}},
+        "system": "You are {agent_role}. " + padding,
+        "user": {
+            "outs": ["Response"],
+            "inps": ["last_message"],
+            "content": 'Last message: {last_message}\nReturn a json object with the key:\n- "Response": a string',
+        },
+    }
+
+
+def bench_field(n_turns: int, n_agents: int, message_len: int) -> None:
+    field = Field(provider=MockProvider())
+    names = [f"Agent{i}" for i in range(n_agents)]
+    for name in names:
+        field.add_agent(name, BENCH_PROMPT)
+    space = Space(["agent_role", "last_message"])
+    space["agent_role"] = "a participant of a group conversation"
+    field.add_chat(names[-1], "Hello everyone.")
+
+    for turn in range(n_turns):
+        _, last_utterance = field.get_last_chat()
+        space["last_message"] = last_utterance
+        response, _ = field.run(names[turn % n_agents], space, message_len)
+        field.add_chat(names[turn % n_agents], response["Response"])
+    field.view_dialog()
+
+
+def bench_scenario(n_turns: int, memory_turns: int) -> None:
+    from run_clinical_conversation import run_scenario
+
+    prompts.prompt_dict["bench-patient"] = {
+        "api_inps": {"model": "mock", "temperature": 0, "response_format": {"type": "json_object"}},
+        "system": "You are {patient_name}, {patient_summary}",
+        "user": {
+            "outs": ["patient_utterance"],
+            "inps": ["last_physician_message"],
+            "content": 'Doctor: {last_physician_message}\nReturn json with the key:\n- "patient_utterance": a string',
+        },
+    }
+    prompts.prompt_dict["bench-physician"] = {
+        "api_inps": {"model": "mock", "temperature": 0, "response_format": {"type": "json_object"}},
+        "system": "You are a physician at {institution}.",
+        "user": {
+            "outs": ["physician_utterance"],
+            "inps": ["last_patient_message"],
+            "content": 'Patient: {last_patient_message}\nReturn json with the key:\n- "physician_utterance": a string',
+        },
+    }
+    config = {"roles": {"patient_prompt": "bench-patient", "physician_prompt": "bench-physician"}}
+    scenario = {"id": "bench", "patient_profile": {"name": "Bench"}, "initial_physician_message": "Hello."}
+    with tempfile.TemporaryDirectory() as output_dir:
+        run_scenario(config, scenario, Path(output_dir), n_turns, memory_turns, provider=MockProvider())
+
+
+def measure(fn: Callable[[], None], n_turns: int, memory: bool) -> Dict:
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    res = {"seconds": seconds, "us_per_turn": seconds / n_turns * 1e6}
+
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        res.update(peak_kb=peak / 1024, peak_bytes_per_turn=peak / n_turns)
+    return res
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> Dict:
+    register_prompt(args.prompt_chars)
+    results = []
+    for case in args.cases:
+        for n_turns in args.turns if case == "field" else args.scenario_turns:
+            if case == "field":
+                for n_agents in args.agents:
+                    fn = lambda: bench_field(n_turns, n_agents, args.message_len)  # noqa: E731
+                    results.append(dict(case=case, turns=n_turns, agents=n_agents, **measure(fn, n_turns, args.memory)))
+                    print_row(results[-1])
+            elif case == "scenario":
+                fn = lambda: bench_scenario(n_turns, args.message_len)  # noqa: E731
+                results.append(dict(case=case, turns=n_turns, agents=2, **measure(fn, n_turns, args.memory)))
+                print_row(results[-1])
+    return {
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+
+
+def row_key(row: Dict) -> tuple:
+    return row["case"], row["turns"], row["agents"]
+
+
+def print_row(row: Dict, baseline: Dict | None = None) -> None:
+    line = f"{row['case']:<9} turns={row['turns']:<6} agents={row['agents']:<3} {row['us_per_turn']:>10.1f} us/turn"
+    if "peak_kb" in row:
+        line += f" {row['peak_bytes_per_turn']:>10.0f} B/turn peak"
+    if baseline is not None:
+        line += f"  time x{row['us_per_turn'] / baseline['us_per_turn']:.2f}"
+        if "peak_kb" in row and "peak_kb" in baseline:
+            line += f"  memory x{row['peak_kb'] / baseline['peak_kb']:.2f}"
+    print(line, flush=True)
+
+
+def compare(report: Dict, baseline_report: Dict) -> None:
+    baseline = {row_key(row): row for row in baseline_report["results"]}
+    print(f"\nCompared to {baseline_report.get('revision')} ({baseline_report.get('date')}):")
+    for row in report["results"]:
+        print_row(row, baseline.get(row_key(row)))
+
+
+def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the orchestration engine with a mock LLM")
+    parser.add_argument("--cases", nargs="+", default=["field", "scenario"], choices=["field", "scenario"])
+    parser.add_argument("--turns", nargs="+", type=int, default=DEFAULT_TURNS, help="Session lengths (field case)")
+    parser.add_argument(
+        "--scenario_turns", nargs="+", type=int, default=DEFAULT_SCENARIO_TURNS, help="Session lengths (scenario case)"
+    )
+    parser.add_argument("--agents", nargs="+", type=int, default=[2, 4], help="Agents taking turns (field case)")
+    parser.add_argument("--message_len", type=int, default=8, help="History window of every request")
+    parser.add_argument("--prompt_chars", type=int, default=2000, help="Length of the system prompt")
+    parser.add_argument("--no_memory", dest="memory", action="store_false", help="Skip the tracemalloc pass")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this json file")
+    parser.add_argument("--compare", type=str, default=None, help="Results json of a previous run to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] | None = None) -> None:
+    args = parse_args(argv)
+    report = run(args)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            compare(report, json.load(fh))
+
+
+if __name__ == "__main__":
+    main()
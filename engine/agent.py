@@ -1,29 +1,65 @@
 import os
 import time
-import json
+import asyncio
 import logging
+import weakref
+import functools
 from typing import Dict, List
 from engine.space import Space
-from openai import ChatCompletion
-from string import Formatter
+from engine.cache import ResponseCache
+from engine.provider import Provider, OpenAIProvider, make_response
+from engine.scheduler import RequestScheduler, estimate_tokens
+from engine.template import PromptTemplate
+from engine.parsing import JsonStream, ResponseParser, ResponseParseError
 
 logger = logging.getLogger(__name__)
 
 
 class Agent:
-    def __init__(self, prompt_script: Dict) -> None:
+    def __init__(self,
+                 prompt_script: Dict,
+                 cache: ResponseCache = None,
+                 provider: Provider = None,
+                 scheduler: RequestScheduler = None) -> None:
         for k in ['api_inps', 'user']:
             assert k in prompt_script.keys(), f'{k} not in {prompt_script.keys()}'
         
-        self.api_kwargs = prompt_script['api_inps']
+        self.api_kwargs = dict(prompt_script['api_inps'])
+        self.api_kwargs.pop('provider', None)
+        # Streamed completions, closed once the keys of user.outs are complete
+        self.stream = bool(self.api_kwargs.pop('stream', False))
+        rate_limit = self.api_kwargs.pop('rate_limit', None) or {}
         assert 'model' in self.api_kwargs.keys(), 'GPT Model should be specified in the api_inps'
+        self.provider = provider if provider is not None else OpenAIProvider()
+
+        self.scheduler = scheduler
+        if scheduler is not None and rate_limit:
+            scheduler.set_limits(self.api_kwargs['model'], rate_limit.get('rpm'), rate_limit.get('tpm'))
 
         self.system_prompt = None
+        self.system_template = None
         if 'system' in prompt_script.keys():
             self.system_prompt = prompt_script['system']
-            self.system_inputs = [i[1] for i in Formatter().parse(self.system_prompt)  if i[1] is not None]
+            self.system_template = PromptTemplate(self.system_prompt)
+            self.system_inputs = list(self.system_template.fields)
         self.user_inputs = prompt_script['user']['inps']
+        self.user_outputs = prompt_script['user'].get('outs') or []
         self.user_content = prompt_script['user']['content']
+        self.user_template = PromptTemplate(self.user_content)
+
+        undeclared = self.user_template.missing(self.user_inputs)
+        if undeclared:
+            raise KeyError(f'{undeclared} used in the user content but not declared in user.inps')
+
+        self.json_output = self.api_kwargs.get('response_format', {}).get('type') == 'json_object'
+        self.parser = ResponseParser(self.user_outputs)
+        # Re-requests of a turn whose response cannot be parsed nor repaired
+        self.max_reparse = 1
+        self.parse_stats = dict(rerequests=0)
+
+        self.cache = cache
+        # Spaces already validated against the templates, dropped with the space
+        self._checked_spaces = weakref.WeakSet()
 
     def __repr__(self) -> str:
         line_div = os.getenv('LINE_DIV', '=')*100
@@ -33,51 +69,267 @@ class Agent:
     
     @staticmethod
     def fmt_prompt(prompt, var_space: Space):
-        inputs = [i[1] for i in Formatter().parse(prompt)  if i[1] is not None]
-        inputs = {k:v for k, v in var_space.values.items() if k in inputs}
-        return prompt.format(**inputs) 
+        return PromptTemplate(prompt).render(var_space.values)
+
+    def check_space(self, var_space: Space):
+        """Validate once per space that it holds every variable the prompts need."""
+        if var_space in self._checked_spaces:
+            return
+        scope = var_space.values.keys()
+        for template in (self.system_template, self.user_template):
+            if template is None:
+                continue
+            try:
+                template.validate(scope)
+            except KeyError:
+                logger.error(f'WRONG space\n{template}\n{list(scope)}')
+                raise
+        self._checked_spaces.add(var_space)
     
     def get_sys_prompt(self, var_space:Space):
-        if self.system_prompt is not None:
-            return self.fmt_prompt(self.system_prompt, var_space)
+        if self.system_template is not None:
+            self.check_space(var_space)
+            return self.system_template.render(var_space.values)
         else:
             return self.system_prompt
     
     def get_message(self, var_space: Space):
-        inputs = {k:v for k, v in var_space.values.items() if k in self.user_inputs}
+        self.check_space(var_space)
+        return self.user_template.render(var_space.values)
+    
+    def lookup_cache(self, messages: List, candidate: int = 0, api_kwargs: Dict = None):
+        """Candidates after the first one of a turn are cached apart, see `Field.branch`."""
+        if self.cache is None:
+            return None, None
+        api_kwargs = api_kwargs if api_kwargs is not None else self.api_kwargs
+        if candidate:
+            api_kwargs = dict(api_kwargs, candidate=candidate)
+        return self.cache.lookup(messages, api_kwargs, provider=self.provider.name)
+
+    def store_cache(self, key, response):
+        if self.cache is not None:
+            self.cache.store(key, response, model=self.api_kwargs['model'])
+
+    async def alookup_cache(self, messages: List, candidate: int = 0, api_kwargs: Dict = None):
+        """Same as `lookup_cache`, in a worker thread : sqlite does not block the event loop."""
+        if self.cache is None:
+            return None, None
+        return await asyncio.to_thread(self.lookup_cache, messages, candidate, api_kwargs)
+
+    async def astore_cache(self, key, response):
+        if self.cache is not None:
+            await asyncio.to_thread(self.store_cache, key, response)
 
+    def create(self, messages: List, api_kwargs: Dict = None, on_token=None):
+        """Returns the response and the call info : latency (seconds) and retries."""
+        api_kwargs = api_kwargs if api_kwargs is not None else self.api_kwargs
+        create = self.provider.create
+        if self.stream and api_kwargs.get('n', 1) == 1:
+            create = functools.partial(self.consume_stream, on_token=on_token)
+        info = dict(retries=0)
+        start = time.perf_counter()
+        if self.scheduler is not None:
+            response = self.scheduler.call(create, messages, api_kwargs, info)
+        else:
+            response = create(messages, **api_kwargs)
+        info['latency'] = time.perf_counter() - start
+        return response, info
+
+    async def acreate(self, messages: List, api_kwargs: Dict = None, on_token=None):
+        api_kwargs = api_kwargs if api_kwargs is not None else self.api_kwargs
+        acreate = self.provider.acreate
+        if self.stream and api_kwargs.get('n', 1) == 1:
+            acreate = functools.partial(self.aconsume_stream, on_token=on_token)
+        info = dict(retries=0)
+        start = time.perf_counter()
+        if self.scheduler is not None:
+            response = await self.scheduler.acall(acreate, messages, api_kwargs, info)
+        else:
+            response = await acreate(messages, **api_kwargs)
+        info['latency'] = time.perf_counter() - start
+        return response, info
+
+    def consume_stream(self, messages: List, on_token=None, **api_kwargs):
+        """
+        Read a streamed completion, calling ``on_token(delta, stream)`` with every chunk and the
+        `JsonStream` received so far, and close it as soon as the keys of ``user.outs`` are complete.
+        Returns a response shaped like a plain one, with the time to first token.
+        """
+        stream = JsonStream(self.user_outputs if self.json_output else ())
+        state = dict(start=time.perf_counter(), ttft=None, usage=None, chunks=0)
+        chunks = self.provider.stream(messages, **api_kwargs)
         try:
-            return self.user_content.format(**inputs) 
-        except KeyError as err:
-            logger.error(f'WRONG space\n{self.user_content}\n{inputs}')
-            raise KeyError(err)    
-    
-    def request(self, messages: List):
-        start = time.time()
-        response = ChatCompletion.create(messages=messages, **self.api_kwargs)
-        latency = time.time() - start
-
-        response_formated = response['choices'][0].message['content']
-        if ('response_format' in self.api_kwargs):
-            if self.api_kwargs['response_format']['type'] == 'json_object':
-                response_formated = json.loads(response_formated)
-        
-        response_info = get_response_info(response, latency)
+            for chunk in chunks:
+                if self.read_chunk(chunk, stream, state, on_token):
+                    break
+        finally:
+            chunks.close()
+        return self.stream_response(messages, stream, state)
+
+    async def aconsume_stream(self, messages: List, on_token=None, **api_kwargs):
+        stream = JsonStream(self.user_outputs if self.json_output else ())
+        state = dict(start=time.perf_counter(), ttft=None, usage=None, chunks=0)
+        chunks = self.provider.astream(messages, **api_kwargs)
+        try:
+            async for chunk in chunks:
+                if self.read_chunk(chunk, stream, state, on_token):
+                    break
+        finally:
+            await chunks.aclose()
+        return self.stream_response(messages, stream, state)
+
+    @staticmethod
+    def read_chunk(chunk: Dict, stream: JsonStream, state: Dict, on_token) -> bool:
+        """Returns whether the stream can be closed."""
+        if chunk.get('usage'):
+            state['usage'] = chunk['usage']
+        delta = chunk.get('content')
+        if not delta:
+            return False
+        if state['ttft'] is None:
+            state['ttft'] = time.perf_counter() - state['start']
+        state['chunks'] += 1
+        stream.feed(delta)
+        if on_token is not None:
+            on_token(delta, stream)
+        return stream.done
+
+    @staticmethod
+    def stream_response(messages: List, stream: JsonStream, state: Dict):
+        content = stream.closed_text() if stream.done else stream.text
+        usage = state['usage']
+        if usage is None:
+            # Streams do not report the usage : estimated prompt, one token per chunk
+            usage = dict(prompt_tokens=estimate_tokens(messages, {}), completion_tokens=state['chunks'])
+        response = make_response(content, usage['prompt_tokens'], usage['completion_tokens'])
+        ttft = round(state['ttft'], 4) if state['ttft'] is not None else None
+        response['stream'] = dict(ttft=ttft, early_stop=stream.done)
+        return response
+
+    def request(self, messages: List, candidate: int = 0, on_token=None):
+        cache_key, response = self.lookup_cache(messages, candidate)
+        if response is not None:
+            try:
+                return self.format_response(response, 0., cached=True)
+            except ResponseParseError:
+                logger.warning('Cached response cannot be parsed, requesting it again')
+
+        for attempt in range(self.max_reparse + 1):
+            response, info = self.create(messages, on_token=on_token)
+            try:
+                result = self.format_response(response, info['latency'], attempt=attempt, retries=info['retries'])
+            except ResponseParseError:
+                if not self.on_parse_error(attempt):
+                    raise
+                continue
+            self.store_cache(cache_key, response)
+            return result
+
+    async def arequest(self, messages: List, candidate: int = 0, on_token=None):
+        cache_key, response = await self.alookup_cache(messages, candidate)
+        if response is not None:
+            try:
+                return self.format_response(response, 0., cached=True)
+            except ResponseParseError:
+                logger.warning('Cached response cannot be parsed, requesting it again')
+
+        for attempt in range(self.max_reparse + 1):
+            response, info = await self.acreate(messages, on_token=on_token)
+            try:
+                result = self.format_response(response, info['latency'], attempt=attempt, retries=info['retries'])
+            except ResponseParseError:
+                if not self.on_parse_error(attempt):
+                    raise
+                continue
+            await self.astore_cache(cache_key, response)
+            return result
+
+    def request_n(self, messages: List, n: int):
+        """
+        ``n`` candidate responses from a single call, with the ``n`` parameter of the API.
+        Candidates that cannot be parsed are dropped rather than re-requested.
+        """
+        api_kwargs = dict(self.api_kwargs, n=n)
+        cache_key, response = self.lookup_cache(messages, api_kwargs=api_kwargs)
+        if response is not None:
+            return self.format_choices(response, dict(latency=0., retries=0), cached=True)
+        response, info = self.create(messages, api_kwargs)
+        results = self.format_choices(response, info)
+        self.store_cache(cache_key, response)
+        return results
+
+    async def arequest_n(self, messages: List, n: int):
+        api_kwargs = dict(self.api_kwargs, n=n)
+        cache_key, response = await self.alookup_cache(messages, api_kwargs=api_kwargs)
+        if response is not None:
+            return self.format_choices(response, dict(latency=0., retries=0), cached=True)
+        response, info = await self.acreate(messages, api_kwargs)
+        results = self.format_choices(response, info)
+        await self.astore_cache(cache_key, response)
+        return results
+
+    def format_choices(self, response, info: Dict, cached: bool = False):
+        results = []
+        for choice in range(len(response['choices'])):
+            try:
+                result = self.format_response(response, info['latency'], cached, retries=info['retries'], choice=choice)
+            except ResponseParseError:
+                logger.warning(f'Candidate {choice} cannot be parsed, dropped')
+                continue
+            if choice > 0:
+                # The usage covers the whole call, it is reported with the first candidate only
+                result[1].update(prompt_tokens=0, completion_tokens=0)
+            results.append(result)
+        if not results:
+            raise ResponseParseError(f'None of the {len(response["choices"])} candidates could be parsed')
+        return results
+
+    def on_parse_error(self, attempt: int) -> bool:
+        """Whether the failed turn is requested again."""
+        if attempt >= self.max_reparse:
+            logger.error(f'Response still invalid after {attempt} re-requests')
+            return False
+        self.parse_stats['rerequests'] += 1
+        logger.warning(f'Invalid response, re-request {attempt + 1}/{self.max_reparse}')
+        return True
+
+    def get_parse_stats(self) -> Dict:
+        return dict(self.parser.stats, **self.parse_stats)
+
+    def format_response(self, response, latency: float, cached: bool = False, attempt: int = 0, retries: int = 0,
+                        choice: int = 0):
+        response_formated = response['choices'][choice]['message']['content']
+        response_info = get_response_info(response, latency, cached, retries)
+        if self.json_output:
+            response_formated, response_info['parse'] = self.parser.parse(response_formated)
+            response_info['attempts'] = attempt + 1
 
         return response_formated, response_info
 
 
-def get_response_info(_response, _latency: float):
+def get_response_info(_response, _latency: float, _cached: bool = False, _retries: int = 0):
     res = dict()
     res['prompt_tokens'] = _response['usage']['prompt_tokens']
     res['completion_tokens'] = _response['usage']['completion_tokens']
-    res['latency'] = f'{_latency:.2f}s'
+    # Seconds, rounded to keep turns.csv readable
+    res['latency'] = round(_latency, 4)
+    res['cached'] = _cached
+    res['retries'] = _retries
+    if not _cached and 'stream' in _response:
+        # Time to first token (s) and whether the stream was closed once the outputs were complete
+        res.update(_response['stream'])
     return res
 
 
 class HumanAgent:
-    def __init__(self, name='Human') -> None:
+    """
+    A human participant, answering on stdin or, with a ``channel`` (see `engine.server`),
+    through an object whose ``async ask(messages)`` returns the utterance.
+    """
+
+    def __init__(self, name='Human', channel=None) -> None:
         self.name = name
+        self.channel = channel
         self.system_prompt = None
         self.user_inputs = []
         self.user_content = ""
@@ -89,9 +341,19 @@ class HumanAgent:
         return ""
 
     def request(self, messages: List):
+        if self.channel is not None:
+            raise RuntimeError(f'{self.name} answers through a channel, use arequest')
         if messages:
             print("\n[Context from previous turn]")
             print(f"{messages[-1]['role'].capitalize()}: {messages[-1]['content']}")
 
+        start = time.perf_counter()
         response = input("\n[Your Response] > ")
-        return {'Response': response}, {"latency": "human"}
+        return {'Response': response}, {"latency": round(time.perf_counter() - start, 4), "human": True}
+
+    async def arequest(self, messages: List):
+        if self.channel is None:
+            return await asyncio.to_thread(self.request, messages)
+        start = time.perf_counter()
+        response = await self.channel.ask(messages)
+        return {'Response': response}, {"latency": round(time.perf_counter() - start, 4), "human": True}
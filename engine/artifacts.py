@@ -0,0 +1,310 @@
+import os
+import csv
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_FNAME = 'artifacts.jsonl'
+INDEX_FNAME = 'artifacts_index.json'
+TURNS_FNAME = 'turns.csv'
+BLOBS_FNAME = 'blobs.jsonl'
+TREE_FNAME = 'tree.jsonl'
+
+
+class ArtifactSink:
+    """
+    Append-only writer of the per-turn outputs of a scenario.
+
+    Every turn appends one compact json line to ``artifacts.jsonl`` and one row to
+    ``turns.csv``, both flushed right away, so an interrupted run keeps every completed
+    turn. ``artifacts_index.json`` records the byte offset of each artifact line and is
+    written on `close`; `load_index` rebuilds it from the jsonl file when it is missing.
+    Large repeated contents (prompts, history messages) go through `blob`, which writes
+    each distinct content once to ``blobs.jsonl`` and returns its hash for the artifact
+    to reference. With ``compress``, the jsonl files are gzipped on `close`.
+
+    With ``resume_turn``, the files of an interrupted run are reopened in append mode and
+    everything recorded after that turn (the turn in flight when the run stopped) is dropped.
+    """
+
+    def __init__(self, scenario_dir: Path, compress: bool = False, fsync: bool = False, resume_turn: int = None) -> None:
+        self.scenario_dir = Path(scenario_dir)
+        self.scenario_dir.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.fsync = fsync
+
+        self.artifact_path = self.scenario_dir / ARTIFACTS_FNAME
+        self.blob_path = self.scenario_dir / BLOBS_FNAME
+        self.turns_path = self.scenario_dir / TURNS_FNAME
+        self.index: List[Dict] = []
+
+        self._blob_hashes = set()
+        self._turns_writer = None
+        self._turns_columns: List[str] = []
+
+        if resume_turn is not None and self.artifact_path.exists():
+            self._recover(resume_turn)
+        else:
+            self._artifact_fh = self.artifact_path.open('wb')
+            self._blob_fh = self.blob_path.open('wb')
+            self._turns_fh = self.turns_path.open('w', encoding='utf-8', newline='')
+
+    def _recover(self, resume_turn: int) -> None:
+        offset = 0
+        with self.artifact_path.open('rb') as fh:
+            for line in fh:
+                try:
+                    artifact = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    break
+                if artifact['turn'] > resume_turn:
+                    break
+                self.index.append(_index_entry(artifact, offset, len(line)))
+                offset += len(line)
+        _truncate(self.artifact_path, offset)
+        self._artifact_fh = self.artifact_path.open('ab')
+
+        offset = 0
+        if self.blob_path.exists():
+            with self.blob_path.open('rb') as fh:
+                for line in fh:
+                    try:
+                        self._blob_hashes.add(json.loads(line)['hash'])
+                    except json.decoder.JSONDecodeError:
+                        break
+                    offset += len(line)
+            _truncate(self.blob_path, offset)
+        self._blob_fh = self.blob_path.open('ab')
+
+        rows = []
+        if self.turns_path.exists():
+            with self.turns_path.open('r', encoding='utf-8', newline='') as fh:
+                reader = csv.DictReader(fh)
+                self._turns_columns = list(reader.fieldnames or [])
+                rows = [row for row in reader if row.get('turn') and int(row['turn']) <= resume_turn]
+        self._turns_fh = self.turns_path.open('w', encoding='utf-8', newline='')
+        if self._turns_columns:
+            self._turns_writer = csv.DictWriter(self._turns_fh, fieldnames=self._turns_columns, restval='')
+            self._turns_writer.writeheader()
+            self._turns_writer.writerows(rows)
+            self._flush(self._turns_fh)
+        logger.info(f'Resume {self.scenario_dir} after turn {resume_turn} ({len(self.index)} artifacts kept)')
+
+    def blob(self, content) -> Optional[str]:
+        """Store ``content`` once and return the hash referencing it."""
+        if content is None:
+            return None
+        text = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, sort_keys=True)
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if key not in self._blob_hashes:
+            self._blob_hashes.add(key)
+            line = json.dumps({'hash': key, 'content': content}, ensure_ascii=False, separators=(',', ':'))
+            self._blob_fh.write(line.encode('utf-8') + b'\n')
+            # Flushed before the artifact referencing it
+            self._flush(self._blob_fh)
+        return key
+
+    def write_turn(self, record: Dict, artifact: Dict) -> None:
+        """Append the ``turns.csv`` row and the artifact of a finished turn."""
+        line = json.dumps(artifact, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+        offset = self._artifact_fh.tell()
+        self._artifact_fh.write(line)
+        self._flush(self._artifact_fh)
+
+        self.index.append(_index_entry(artifact, offset, len(line)))
+        self._write_row(record)
+
+    def _write_row(self, record: Dict) -> None:
+        new_columns = [k for k in record.keys() if k not in self._turns_columns]
+        if new_columns:
+            self._turns_columns.extend(new_columns)
+            if self._turns_writer is not None:
+                self._rewrite_turns()
+            else:
+                self._turns_writer = csv.DictWriter(self._turns_fh, fieldnames=self._turns_columns, restval='')
+                self._turns_writer.writeheader()
+        self._turns_writer.writerow(record)
+        self._flush(self._turns_fh)
+
+    def _rewrite_turns(self) -> None:
+        # A record brought new columns : rewrite the rows written so far under the wider header
+        self._turns_fh.close()
+        with self.turns_path.open('r', encoding='utf-8', newline='') as fh:
+            rows = list(csv.DictReader(fh))
+        self._turns_fh = self.turns_path.open('w', encoding='utf-8', newline='')
+        self._turns_writer = csv.DictWriter(self._turns_fh, fieldnames=self._turns_columns, restval='')
+        self._turns_writer.writeheader()
+        self._turns_writer.writerows(rows)
+
+    def _flush(self, fh) -> None:
+        fh.flush()
+        if self.fsync:
+            os.fsync(fh.fileno())
+
+    def close(self, **index_info) -> None:
+        """Close the files and write ``artifacts_index.json`` with ``index_info`` added to it."""
+        self._artifact_fh.close()
+        self._blob_fh.close()
+        self._turns_fh.close()
+
+        artifacts = self.index
+        if self.compress:
+            compressed_path = _gzip(self.artifact_path)
+            _gzip(self.blob_path)
+            artifacts = [dict(entry, path=compressed_path.name) for entry in artifacts]
+
+        with (self.scenario_dir / INDEX_FNAME).open('w', encoding='utf-8') as fh:
+            json.dump(dict(index_info, artifacts=artifacts), fh, ensure_ascii=False, indent=2)
+
+
+class TreeSink:
+    """
+    Append-only writer of a conversation tree, one json line per turn in ``tree.jsonl``.
+
+    A node points to the ``parent`` turn it follows, so the turns shared by several branches
+    are written once. Nodes carry the ``space_delta`` of their turn, `iter_branches`
+    rebuilds the dialog and variables of every branch.
+    """
+
+    def __init__(self, run_dir: Path) -> None:
+        self.path = Path(run_dir) / TREE_FNAME
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = self.path.open('w', encoding='utf-8')
+        self.n_nodes = 0
+
+    def add(self, parent: Optional[int], **record) -> int:
+        node = self.n_nodes
+        self._fh.write(json.dumps(dict(node=node, parent=parent, **record), ensure_ascii=False, default=str) + '\n')
+        self._fh.flush()
+        self.n_nodes += 1
+        return node
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+def _index_entry(artifact: Dict, offset: int, length: int) -> Dict:
+    return {
+        'turn': artifact['turn'],
+        'speaker': artifact['speaker'],
+        'key': f"turn_{artifact['turn']:02d}_{artifact['speaker'].lower()}",
+        'path': ARTIFACTS_FNAME,
+        'offset': offset,
+        'length': length,
+    }
+
+
+def _truncate(path: Path, size: int) -> None:
+    with path.open('r+b') as fh:
+        fh.truncate(size)
+
+
+def _gzip(path: Path) -> Path:
+    compressed_path = path.with_name(path.name + '.gz')
+    with path.open('rb') as src, gzip.open(compressed_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    path.unlink()
+    return compressed_path
+
+
+def _iter_jsonl(scenario_dir: Path, fname: str) -> Iterator[Dict]:
+    plain = scenario_dir / fname
+    compressed = scenario_dir / (fname + '.gz')
+    if plain.exists():
+        fh = plain.open('rb')
+    elif compressed.exists():
+        fh = gzip.open(compressed, 'rb')
+    else:
+        return
+    with fh:
+        for line in fh:
+            try:
+                yield json.loads(line)
+            except json.decoder.JSONDecodeError:
+                # Partially written last line of an interrupted run
+                logger.warning(f'Skip a truncated line of {fname} in {scenario_dir}')
+
+
+def resolve_artifact(artifact: Dict, blobs: Dict, space: Dict) -> Dict:
+    """
+    Expand the blob references of an artifact and rebuild its full ``space_variables``
+    from ``space``, the variables accumulated over the previous artifacts (updated in place).
+    """
+    if 'space_delta' in artifact:
+        space.update(artifact['space_delta'])
+        artifact['space_variables'] = dict(space)
+    if 'system_prompt_ref' in artifact:
+        artifact['system_prompt'] = blobs.get(artifact['system_prompt_ref'])
+    if 'user_prompt_ref' in artifact:
+        artifact['user_prompt'] = blobs.get(artifact['user_prompt_ref'])
+    if 'request_message_refs' in artifact:
+        artifact['request_messages'] = [
+            {'role': m['role'], 'content': blobs[m['ref']]} for m in artifact['request_message_refs']
+        ]
+    return artifact
+
+
+def iter_artifacts(scenario_dir: Path, resolve: bool = True) -> Iterator[Dict]:
+    """
+    Artifacts of a scenario, from ``artifacts.jsonl(.gz)`` or legacy ``turn_XX_*.json`` files.
+    With ``resolve``, blob references and space deltas are expanded (see `resolve_artifact`).
+    """
+    scenario_dir = Path(scenario_dir)
+    if (scenario_dir / ARTIFACTS_FNAME).exists() or (scenario_dir / (ARTIFACTS_FNAME + '.gz')).exists():
+        blobs = {b['hash']: b['content'] for b in _iter_jsonl(scenario_dir, BLOBS_FNAME)} if resolve else None
+        space = dict()
+        for artifact in _iter_jsonl(scenario_dir, ARTIFACTS_FNAME):
+            yield resolve_artifact(artifact, blobs, space) if resolve else artifact
+    else:
+        for path in sorted((scenario_dir / 'artifacts').glob('turn_*.json')):
+            with path.open('r', encoding='utf-8') as fh:
+                yield json.load(fh)
+
+
+def load_index(scenario_dir: Path) -> Dict:
+    """The artifact index of a scenario, rebuilt from the artifacts if the run did not close."""
+    index_path = Path(scenario_dir) / INDEX_FNAME
+    if index_path.exists():
+        with index_path.open('r', encoding='utf-8') as fh:
+            return json.load(fh)
+    artifacts = [
+        {'turn': a['turn'], 'speaker': a['speaker'], 'key': f"turn_{a['turn']:02d}_{a['speaker'].lower()}"}
+        for a in iter_artifacts(scenario_dir)
+    ]
+    return {'artifacts': artifacts}
+
+
+def iter_branches(run_dir: Path) -> Iterator[List[Dict]]:
+    """
+    Every root-to-leaf path of the tree written by a `TreeSink`, each node with the
+    accumulated ``space_variables`` of its branch.
+    """
+    nodes = {node['node']: node for node in _iter_jsonl(Path(run_dir), TREE_FNAME)}
+    parents = {node['parent'] for node in nodes.values()}
+    for leaf in sorted(set(nodes) - parents):
+        path = []
+        node = nodes.get(leaf)
+        while node is not None:
+            path.append(node)
+            node = nodes.get(node['parent'])
+        space = dict()
+        branch = []
+        for node in reversed(path):
+            space.update(node.get('space_delta') or {})
+            branch.append(dict(node, space_variables=dict(space)))
+        yield branch
+
+
+def find_scenario_dirs(root: Path) -> List[Path]:
+    """Every directory below ``root`` holding artifacts of a scenario."""
+    root = Path(root)
+    dirs = {p.parent for p in root.rglob(ARTIFACTS_FNAME)}
+    dirs.update(p.parent for p in root.rglob(ARTIFACTS_FNAME + '.gz'))
+    dirs.update(p.parent.parent for p in root.rglob('artifacts/turn_*.json'))
+    return sorted(dirs)
@@ -0,0 +1,168 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Content-addressed store of LLM responses backed by a local SQLite file.
+
+    Entries are keyed by a stable hash of the provider, model, request parameters and messages,
+    so that responses of the mock, replay or local providers are never served to another one.
+    For sampled requests (temperature > 0) the ``sample`` identifier (e.g. the run seed)
+    is part of the key too, so a replay with the same seed returns the same responses
+    while a different seed still reaches the API.
+
+    Modes
+        off       : never read nor write
+        read      : serve hits, do not store new responses
+        write     : always request, store every response
+        readwrite : serve hits and store misses
+    """
+    MODES = ('off', 'read', 'write', 'readwrite')
+
+    def __init__(self,
+                 path: str,
+                 mode: str = 'readwrite',
+                 max_entries: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 sample=None) -> None:
+        assert mode in ResponseCache.MODES, f'{mode} not in {ResponseCache.MODES}'
+        self.path = Path(path)
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # seconds
+        self.max_age = max_age
+        self.sample = sample
+
+        self.stats = dict(hits=0, misses=0, writes=0, evictions=0)
+        self._lock = threading.Lock()
+        self._conn = None
+        if self.mode != 'off':
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)')
+            self._conn.commit()
+            self.evict()
+
+    @property
+    def readable(self) -> bool:
+        return self.mode in ('read', 'readwrite')
+
+    @property
+    def writable(self) -> bool:
+        return self.mode in ('write', 'readwrite')
+
+    def key(self, messages: List[Dict], api_kwargs: Dict, provider: str = None) -> str:
+        content = {'api_kwargs': api_kwargs, 'messages': messages, 'provider': provider}
+        if api_kwargs.get('temperature', 1) != 0:
+            content['sample'] = self.sample
+        content = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def lookup(self, messages: List[Dict], api_kwargs: Dict, provider: str = None) -> Tuple[Optional[str], Optional[Dict]]:
+        """Returns the key of the request and the cached response, None on a miss."""
+        if self.mode == 'off':
+            return None, None
+
+        key = self.key(messages, api_kwargs, provider)
+        if not self.readable:
+            return key, None
+
+        with self._lock:
+            row = self._conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return key, None
+            self.stats['hits'] += 1
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self._conn.commit()
+        return key, json.loads(row[0])
+
+    def store(self, key: Optional[str], response: Dict, model: str = None) -> None:
+        if key is None or not self.writable:
+            return
+        payload = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, payload, len(payload), now, now)
+            )
+            self._conn.commit()
+            self.stats['writes'] += 1
+        if self.max_entries is not None or self.max_bytes is not None:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop expired entries, then least recently used ones until the size limits hold."""
+        if self._conn is None:
+            return 0
+        evicted = 0
+        with self._lock:
+            if self.max_age is not None:
+                cur = self._conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+                evicted += cur.rowcount
+            if self.max_entries is not None:
+                cur = self._conn.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+                evicted += cur.rowcount
+            if self.max_bytes is not None:
+                total, = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+                if total > self.max_bytes:
+                    rows = self._conn.execute('SELECT key, size FROM responses ORDER BY accessed ASC').fetchall()
+                    stale = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        total -= size
+                    self._conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+                    evicted += len(stale)
+            self._conn.commit()
+            self.stats['evictions'] += evicted
+        if evicted:
+            logger.debug(f'Evicted {evicted} cached responses from {self.path}')
+        return evicted
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __repr__(self) -> str:
+        return f'ResponseCache(path={str(self.path)!r}, mode={self.mode!r}, stats={self.stats})'
+
+
+def add_cache_arguments(parser) -> None:
+    parser.add_argument('--cache_path', type=str, default=None, help='SQLite file caching LLM responses (disabled if omitted)')
+    parser.add_argument('--cache_mode', type=str, default='readwrite', choices=ResponseCache.MODES)
+    parser.add_argument('--cache_max_entries', type=int, default=None)
+    parser.add_argument('--cache_max_age_days', type=float, default=None)
+
+
+def cache_from_args(args, sample=None) -> Optional[ResponseCache]:
+    if args.cache_path is None or args.cache_mode == 'off':
+        return None
+    max_age = None if args.cache_max_age_days is None else args.cache_max_age_days * 24 * 3600
+    return ResponseCache(args.cache_path,
+                         mode=args.cache_mode,
+                         max_entries=args.cache_max_entries,
+                         max_age=max_age,
+                         sample=sample)
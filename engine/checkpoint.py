@@ -0,0 +1,140 @@
+import os
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FNAME = 'checkpoint.json'
+CHECKPOINT_LOG_FNAME = 'checkpoint.jsonl'
+
+
+def save_checkpoint(path: Path, state: Dict, fsync: bool = True) -> None:
+    """Atomically replace the checkpoint at ``path``, a crash never leaves it half written."""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as fh:
+        json.dump(state, fh, ensure_ascii=False, separators=(',', ':'))
+        if fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: Path) -> Optional[Dict]:
+    path = Path(path)
+    if not path.exists():
+        return None
+    with path.open('r', encoding='utf-8') as fh:
+        state = json.load(fh)
+    logger.info(f'Resume from {path}')
+    return state
+
+
+class CheckpointLog:
+    """
+    Incremental checkpoint of a session, O(1) per turn.
+
+    Every `commit` appends one line to ``checkpoint.jsonl`` with the dialog turns added since
+    the previous line, the space variables written since then (see `Space.subscribe`) and the
+    caller's fields, then atomically replaces ``checkpoint.json``, a small header holding the
+    caller's counters and the number of lines it covers. Only the line is fsynced : a header
+    lost in a crash points to fewer lines, and the run resumes a turn earlier. `load` returns
+    the header and the lines it covers, dropping lines written after it (the turn in flight
+    when the run stopped); `restore` rebuilds the dialog and the space from them.
+    """
+
+    def __init__(self, run_dir: Path) -> None:
+        self.header_path = Path(run_dir) / CHECKPOINT_FNAME
+        self.log_path = Path(run_dir) / CHECKPOINT_LOG_FNAME
+        self.n_entries = 0
+        self._fh = None
+        self._field = None
+        self._space = None
+        self._n_turns = 0
+        # Undeclared keys with the value last logged
+        self._unknown = dict()
+        self._pending = dict()
+        self._unsubscribe = None
+
+    def load(self) -> Optional[Tuple[Dict, List[Dict]]]:
+        """The header and the log lines of the last commit, None without checkpoint."""
+        header = load_checkpoint(self.header_path)
+        if header is None or not self.log_path.exists():
+            return None
+        if 'entries' not in header:
+            logger.warning(f'{self.header_path} is not an incremental checkpoint, the run starts over')
+            return None
+        entries = []
+        offset = 0
+        with self.log_path.open('rb') as fh:
+            for line in fh:
+                if len(entries) == header['entries']:
+                    break
+                entries.append(json.loads(line))
+                offset += len(line)
+        if len(entries) < header['entries']:
+            raise ValueError(f'{self.log_path} holds {len(entries)} of the {header["entries"]} checkpointed turns')
+        with self.log_path.open('r+b') as fh:
+            fh.truncate(offset)
+        self.n_entries = len(entries)
+        return header, entries
+
+    @staticmethod
+    def restore(field, space, entries: List[Dict]) -> None:
+        """Rebuild the dialog of ``field`` and the variables of ``space`` from the log lines."""
+        field.load_turns(turn for entry in entries for turn in entry['dialog'])
+        # Variables never written keep the defaults of the space
+        variables, versions, unknown = dict(space.variables), dict(), dict()
+        for entry in entries:
+            variables.update(entry['space'])
+            versions.update(dict.fromkeys(entry['space'], entry['version']))
+            unknown.update(entry.get('unknown', {}))
+        version = entries[-1]['version'] if entries else 0
+        space.load_state_dict({'variables': variables, 'version': version, 'versions': versions, 'unknown': unknown})
+
+    def open(self, field, space) -> None:
+        """Start logging the turns of ``field`` and the writes of ``space``, after `load` and `restore`."""
+        self._fh = self.log_path.open('ab' if self.n_entries else 'wb')
+        self._field = field
+        self._n_turns = len(field.dialog) if self.n_entries else 0
+        # The first line of a new log holds every variable written so far
+        self._pending = dict() if self.n_entries else space.changed_since(0)
+        self._space = space
+        self._unknown = dict(space.unknown) if self.n_entries else dict()
+        self._unsubscribe = space.subscribe(self._written)
+
+    def _written(self, name, value, version) -> None:
+        self._pending[name] = value
+
+    def commit(self, header: Dict, **fields) -> None:
+        dialog = [[turn.time, turn.agent_name, turn.utterance]
+                  for turn in self._field.dialog.tail(len(self._field.dialog) - self._n_turns)]
+        entry = dict(fields, dialog=dialog, space=self._pending, version=self._space.version)
+        # Undeclared keys are logged when their value changes
+        unknown = {k: v for k, v in self._space.unknown.items()
+                   if k not in self._unknown or self._unknown[k] != v}
+        if unknown:
+            entry['unknown'] = unknown
+            self._unknown.update(unknown)
+        self._fh.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8') + b'\n')
+        # The line is on disk before the header counting it
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.n_entries += 1
+        self._n_turns = len(self._field.dialog)
+        self._pending = dict()
+        save_checkpoint(self.header_path, dict(header, entries=self.n_entries), fsync=False)
+
+    def update(self, header: Dict) -> None:
+        """Replace the header only, e.g. to mark the session completed."""
+        save_checkpoint(self.header_path, dict(header, entries=self.n_entries))
+
+    def close(self) -> None:
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -0,0 +1,161 @@
+import re
+import logging
+import weakref
+from functools import lru_cache
+from typing import Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Per-message formatting tokens added by the chat format
+MESSAGE_OVERHEAD = 4
+_WORD_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+
+def get_tokenizer(model: str = None) -> Callable[[str], int]:
+    """
+    Returns a function counting the tokens of a string.
+    Uses tiktoken when it is installed, otherwise a word/punctuation approximation.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        logger.info('tiktoken is not installed, token counts are approximated')
+        return approximate_tokens
+
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except (KeyError, AttributeError):
+            # Unknown model name, or no model (encoding_for_model(None) raises AttributeError)
+            encoding = tiktoken.get_encoding('cl100k_base')
+    except Exception as err:
+        # Encodings are downloaded on first use
+        logger.warning(f'tiktoken encoding unavailable ({err!r}), token counts are approximated')
+        return approximate_tokens
+    return lambda text: len(encoding.encode(text))
+
+
+def approximate_tokens(text: str) -> int:
+    return len(_WORD_PATTERN.findall(text))
+
+
+def first_sentence_summary(previous: str, turns: Sequence) -> str:
+    """Default summarizer : appends the first sentence of every newly dropped turn."""
+    lines = [previous] if previous else []
+    for agent_name, utterance in turns:
+        sentence = re.split(r'(?<=[.!?])\s', str(utterance).strip(), maxsplit=1)[0]
+        lines.append(f'{agent_name}: {sentence}')
+    return '\n'.join(lines)
+
+
+class ContextBuilder:
+    """
+    Packs the most recent turns of a dialog into a token budget.
+
+    The budget covers the whole request (system prompt, history and user prompt).
+    With a ``summarizer``, turns that no longer fit are folded into a running summary,
+    cached per agent and only extended with the newly dropped turns; it is sent as a
+    system message of at most ``summary_budget`` tokens (a quarter of the budget by
+    default) and only takes from the recent turns the tokens it uses (see `fit`). The last
+    turn is always kept. A builder can be shared by
+    several fields, summaries are kept per dialog. Tokens are counted with the tokenizer of
+    the ``model`` passed to each method (the model of the agent called), ``model`` by default.
+    """
+    SUMMARY_HEADER = 'Summary of the earlier conversation:\n'
+
+    def __init__(self,
+                 token_budget: int,
+                 model: str = None,
+                 summarizer: Callable = None,
+                 summary_budget: int = None,
+                 tokenizer: Callable[[str], int] = None) -> None:
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        self.summary_budget = 0
+        if summarizer is not None:
+            self.summary_budget = summary_budget if summary_budget is not None else token_budget // 4
+        self.model = model
+        self.tokenizer = tokenizer
+        # model -> memoized token counter
+        self._counters = dict()
+        self.count = self.counter(model)
+
+        # dialog -> agent name -> (number of summarized turns, summary)
+        self._summaries = weakref.WeakKeyDictionary()
+
+    def counter(self, model: str = None) -> Callable[[str], int]:
+        """Memoized token counter of ``model``, of the builder's model if None."""
+        model = model or self.model
+        count = self._counters.get(model)
+        if count is None:
+            count = self._counters.setdefault(model, lru_cache(maxsize=8192)(self.tokenizer or get_tokenizer(model)))
+        return count
+
+    def count_messages(self, msgs: List[Dict], model: str = None) -> int:
+        count = self.counter(model)
+        return sum(count(str(m['content'])) + MESSAGE_OVERHEAD for m in msgs)
+
+    def pack(self, history: List[Dict], reserved: int, model: str = None) -> int:
+        """Number of the most recent ``history`` messages fitting next to ``reserved`` tokens, at least one."""
+        count = self.counter(model)
+        available = self.token_budget - reserved
+        n_kept = 0
+        for msg in reversed(history):
+            available -= count(str(msg['content'])) + MESSAGE_OVERHEAD
+            if available < 0:
+                break
+            n_kept += 1
+        return max(n_kept, min(len(history), 1))
+
+    def fit(self, agent_name: str, dialog, history: List[Dict], reserved: int, model: str = None) -> Tuple[int, str]:
+        """
+        Number of the most recent ``history`` messages kept and the summary of the earlier turns
+        of ``dialog``. The summary is measured once rendered : the turns it displaces are folded
+        into it in turn, until the kept turns fit next to it.
+        """
+        n_kept = self.pack(history, reserved, model)
+        summary = ''
+        while self.summarizer is not None and n_kept < len(dialog):
+            summary = self.summary(agent_name, dialog, len(dialog) - n_kept, model)
+            used = self.count_messages([{'content': self.SUMMARY_HEADER + summary}], model) if summary else 0
+            n_fit = self.pack(history, reserved + used, model)
+            if n_fit >= n_kept:
+                break
+            n_kept = n_fit
+        return n_kept, summary
+
+    def summary(self, agent_name: str, dialog, n_turns: int, model: str = None) -> str:
+        """Running summary of the first ``n_turns`` turns of ``dialog``, as seen by ``agent_name``."""
+        if self.summarizer is None or n_turns == 0:
+            return ''
+        summaries = self._summaries.setdefault(dialog, dict())
+        n_done, summary = summaries.get(agent_name, (0, ''))
+        if n_turns < n_done:
+            n_done, summary = 0, ''
+        if n_turns > n_done:
+            summary = self.summarizer(summary, [dialog[pos] for pos in range(n_done, n_turns)])
+            summary = self.truncate(summary, model)
+            summaries[agent_name] = (n_turns, summary)
+        return summary
+
+    def truncate(self, summary: str, model: str = None) -> str:
+        """Drop the oldest lines of the summary until it fits in the summary budget."""
+        count = self.counter(model)
+        lines = summary.split('\n')
+        while len(lines) > 1 and count(self.SUMMARY_HEADER + '\n'.join(lines)) + MESSAGE_OVERHEAD > self.summary_budget:
+            lines.pop(0)
+        return '\n'.join(lines)
+
+
+def add_context_arguments(parser) -> None:
+    parser.add_argument('--token_budget', type=int, default=None,
+                        help='Token budget of each request, the oldest turns are dropped first')
+    parser.add_argument('--summarize_context', action='store_true',
+                        help='Fold the turns dropped by --token_budget into a running summary')
+
+
+def context_from_args(args):
+    if args.token_budget is None:
+        return None
+    summarizer = first_sentence_summary if args.summarize_context else None
+    return ContextBuilder(args.token_budget, summarizer=summarizer)
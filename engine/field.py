@@ -1,37 +1,94 @@
 import os
+import copy
+import asyncio
 import logging
-import pandas as pd
+import weakref
 
-from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import prompts
 from engine.space import Space
 from engine.agent import Agent, HumanAgent
+from engine.turnlog import TurnLog
+from engine.cache import ResponseCache
+from engine.provider import Provider
+from engine.context import ContextBuilder
+from engine.scheduler import RequestScheduler
+from engine.instrument import Instrument
 
 logger = logging.getLogger(__name__)
-logger.addHandler(logging.FileHandler(f'./logs/{__name__}.log', 'w', 'utf-8'))
 
 class Field:
     PRIMARY_KEY_FORMAT = 'STEP:{time}'
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 validate: bool = False,
+                 cache: ResponseCache = None,
+                 provider: Provider = None,
+                 context: ContextBuilder = None,
+                 scheduler: RequestScheduler = None,
+                 instrument: Instrument = None) -> None:
         self.agents = dict()
-        self.dialog = pd.DataFrame()
+        # Integer agent ids, in order of addition : self.agent_names[agent_id]
+        self.agent_ids = dict()
+        self.agent_names = []
+        self.dialog = TurnLog()
         self.key_agents = []
 
-    def add_agent(self, agent_name, prompt_fname=None, shared_llama=None, human=False):
+        # agent name -> deque of the last history messages as seen by that agent
+        self.buffers = dict()
+        # Opt-in O(n) consistency check after every add_chat, for debugging
+        self.validate = validate
+        # Response cache shared by every LLM agent of the field
+        self.cache = cache
+        # Overrides the provider of every LLM agent (e.g. mock or replay backends)
+        self.provider = provider
+        # Optional token budget applied on top of message_len
+        self.context = context
+        # Rate limits and retries, shared with the other fields of the process
+        self.scheduler = scheduler
+        # Timing spans and per-call events, disabled without a sink
+        self.instrument = instrument if instrument is not None else Instrument()
+        # space -> agent name -> (space version, system prompt, user prompt), dropped with the space
+        self._prompts = weakref.WeakKeyDictionary()
+
+    def add_agent(self, agent_name, prompt_fname=None, shared_llama=None, human=False, human_channel=None):
+        """
+        ``shared_llama`` : provider of the agents whose prompt sets ``api_inps.provider: llama``,
+        by default a `LocalProvider` sharing one model per process. ``self.provider`` overrides both.
+        ``human_channel`` : where a human agent answers instead of stdin (see `engine.server`).
+        """
         if human:            
-            new = HumanAgent(name=agent_name)
+            new = HumanAgent(name=agent_name, channel=human_channel)
         else:
+            # Imported here : the prompt registry is only needed by LLM agents
+            import prompts
             prompt_script = prompts.prompt_dict[prompt_fname]
             self.key_agents.append((prompt_fname, agent_name))
-            if prompt_script['api_inps'].get('provider', 'openai') == 'llama':
-                raise NotImplementedError('이 버전은 Llama를 지원하지 않습니다.')
-            else:
-                new = Agent(prompt_script=prompt_script)
+            provider = self.provider
+            if provider is None and prompt_script['api_inps'].get('provider', 'openai') == 'llama':
+                from engine.local import LocalProvider
+                provider = shared_llama if shared_llama is not None else LocalProvider()
+            new = Agent(prompt_script=prompt_script,
+                        cache=self.cache,
+                        provider=provider,
+                        scheduler=self.scheduler)
 
         self.key_agents.append((prompt_fname, agent_name))
         self.agents[agent_name] = new
+        if agent_name not in self.agent_ids:
+            self.agent_ids[agent_name] = len(self.agent_names)
+            self.agent_names.append(agent_name)
+        return self.agent_ids[agent_name]
+
+    def agent_id(self, agent_name):
+        """Id of an enrolled agent, None for speakers that are not agents of the field."""
+        return self.agent_ids.get(agent_name)
+
+    def last_speaker_id(self):
+        if len(self.dialog) == 0:
+            return None
+        return self.agent_ids.get(self.dialog[-1].agent_name)
 
     def get_agent_with_key(self, prompt_fname):
         key_to_agent_name = {x[0]:x[1] for x in self.key_agents}
@@ -40,45 +97,121 @@ class Field:
     def delete_agent(self):
         raise NotImplementedError()
 
+    @property
+    def index(self):
+        return [Field.PRIMARY_KEY_FORMAT.format(time=turn.time) for turn in self.dialog]
+
+    @staticmethod
+    def parse_primary_key(primary_key):
+        prefix, suffix = Field.PRIMARY_KEY_FORMAT.split('{time}')
+        assert primary_key.startswith(prefix) and primary_key.endswith(suffix), f'Invalid primary key {primary_key}'
+        return int(primary_key[len(prefix):len(primary_key) - len(suffix)])
+
     def search_last_index_time(self):
-        indices = self.dialog.index
-        if len(indices) == 0:
-            time = 0
-        else:
-            indices_times = list(map(lambda x: int(x.split(':')[-1]), indices))
-            time = max(indices_times)
-        return time
+        return self.dialog.last_time
     
     def add_chat(self, agent_name, utterance):
         time = self.search_last_index_time() + 1
-        primary_key = Field.PRIMARY_KEY_FORMAT.format(time=time)
-        self.dialog.loc[primary_key, agent_name] = utterance
+        self.dialog.append(time, agent_name, utterance)
+
+        # Message dicts are shared between buffers and must not be mutated
+        as_user = {'role': 'user', 'content': utterance}
+        as_assistant = {'role': 'assistant', 'content': utterance}
+        for buffer_owner, buffer in self.buffers.items():
+            buffer.append(as_user if buffer_owner == agent_name else as_assistant)
 
-        # Sanity check
-        indices_times = list(map(lambda x: int(x.split(':')[-1]), self.dialog.index))
-        for sorted_idx, org_idx in zip(sorted(indices_times), indices_times):
-            assert sorted_idx == org_idx
+        if self.validate:
+            self.dialog.validate()
+            assert self.dialog.position(time) == len(self.dialog) - 1
 
     def delete_chat(self):
         raise NotImplementedError()
 
-    def get_chat(self, primary_key):
-        assert primary_key in self.dialog.index, f'{primary_key} not in {self.dialog.index}'
-        chat = self.dialog.loc[primary_key].dropna()
+    def state_dict(self):
+        """Serializable state of the dialog, agents are rebuilt by the caller."""
+        return {'dialog': self.dialog.state_dict()}
+
+    def load_state_dict(self, state):
+        self.dialog = TurnLog.from_state_dict(state['dialog'])
+        self.buffers = dict()
+
+    def load_turns(self, turns):
+        """Replace the dialog with the ``(time, agent_name, utterance)`` turns, see `CheckpointLog`."""
+        self.dialog = TurnLog()
+        for time, agent_name, utterance in turns:
+            self.dialog.append(time, agent_name, utterance)
+        self.buffers = dict()
+
+    def fork(self):
+        """
+        Field continuing independently from the current dialog. The turns so far are shared
+        with this field (see `TurnLog.fork`), as are the agents, cache, provider, scheduler
+        and instrument; the history buffers are copied and the prompt memo starts empty, so
+        that forks run in other threads never share it.
+        """
+        child = copy.copy(self)
+        child.dialog = self.dialog.fork()
+        child._prompts = weakref.WeakKeyDictionary()
+        child.buffers = {name: deque(buffer, maxlen=buffer.maxlen) for name, buffer in self.buffers.items()}
+        child.agents = dict(self.agents)
+        child.agent_ids = dict(self.agent_ids)
+        child.agent_names = list(self.agent_names)
+        child.key_agents = list(self.key_agents)
+        return child
+
+    def get_history(self, agent_name, message_len):
+        """
+        The last ``message_len`` turns as messages seen by ``agent_name`` : its own utterances
+        with the 'user' role, the others with the 'assistant' role.
+        Served from a per-agent buffer updated by `add_chat`, rebuilt only when the window grows.
+        """
+        if message_len <= 0:
+            return []
+
+        buffer = self.buffers.get(agent_name)
+        if buffer is None or buffer.maxlen < message_len:
+            buffer = deque(maxlen=message_len)
+            for turn in self.dialog.tail(message_len):
+                role = 'user' if turn.agent_name == agent_name else 'assistant'
+                update_msg(buffer, role, turn.utterance)
+            self.buffers[agent_name] = buffer
+
+        history = list(buffer)
+        if len(history) > message_len:
+            history = history[-message_len:]
+        return history
 
-        agent_name = chat.index[0]
-        agent_utterance = chat[agent_name]
+    def get_chat(self, primary_key):
+        try:
+            pos = self.dialog.position(Field.parse_primary_key(primary_key))
+        except KeyError:
+            raise AssertionError(f'{primary_key} not in {self.index}')
+        agent_name, agent_utterance = self.dialog[pos]
         return agent_name, agent_utterance
     
     def get_last_chat(self):
-        time = self.search_last_index_time()
-        primary_key = Field.PRIMARY_KEY_FORMAT.format(time=time)
-        return self.get_chat(primary_key)
+        assert len(self.dialog) > 0, 'No chat in the dialog'
+        agent_name, agent_utterance = self.dialog[-1]
+        return agent_name, agent_utterance
     
     def get_agent_inputs(self):
         res = list(map(lambda agent: agent.user_inputs, self.agents.values()))
         return res
 
+    def get_agent_readers(self):
+        """Variables read by the prompts of each agent, the ``readers`` of a `Space`."""
+        return {name: list(dict.fromkeys(list(getattr(agent, 'system_inputs', [])) + list(agent.user_inputs)))
+                for name, agent in self.agents.items()}
+
+    def get_parse_stats(self):
+        """Parsed, repaired, failed and re-requested responses summed over the agents."""
+        res = dict()
+        for agent in self.agents.values():
+            if hasattr(agent, 'get_parse_stats'):
+                for k, v in agent.get_parse_stats().items():
+                    res[k] = res.get(k, 0) + v
+        return res
+
     def view_agents(self):
         """
         View detailed information of enrolled agents
@@ -91,63 +224,197 @@ class Field:
 
     def view_dialog(self):
         res = []
-        for idx in self.dialog.index:
-            agent_name, agent_utterance = self.get_chat(idx)
+        for agent_name, agent_utterance in self.dialog:
             res.append(f'{agent_name}:{agent_utterance}')
             if 'Therapist' in agent_name:
                 res.append('\n')
         return '\n'.join(res)
+
+    def to_dataframe(self):
+        return self.dialog.to_dataframe(Field.PRIMARY_KEY_FORMAT)
     
-    def run(self, agent_name, var_space: Space, message_len:int, capture_debug: bool = False):
+    def build_request(self, agent_name, var_space: Space, message_len:int, capture_debug: bool = False):
+        """
+        Assemble the message list sent to ``agent_name``.
+        Returns the agent, the messages and the debug payload (None unless ``capture_debug``).
+        """
         agent = self.agents[agent_name]
 
         msgs = []
         prompt_sys=None
-        if agent.system_prompt is not None:
-            prompt_sys = agent.get_sys_prompt(var_space)
-            update_msg(msgs, 'system', prompt_sys)
-
-        prompt_usr = agent.get_message(var_space)
+        with self.instrument.span('prompt', agent=agent_name):
+            prompt_sys, prompt_usr = self.render_prompts(agent_name, agent, var_space)
+            if agent.system_prompt is not None:
+                update_msg(msgs, 'system', prompt_sys)
 
-        if message_len > 0:
-            previous_chats = self.dialog.iloc[-message_len:]
-            for line_idx in range(len(previous_chats)):
-                line = previous_chats.iloc[line_idx]
-                
-                if (agent_name in previous_chats.columns) and (str(line[agent_name]).lower() != 'nan'):
-                    role = 'user'
-                    chat = line[agent_name]
-                else:
-                    role = 'assistant'
-                    chat = line.dropna().item()
+        with self.instrument.span('history', agent=agent_name) as span:
+            history = self.get_history(agent_name, message_len)
 
-                update_msg(msgs, role, chat)
+            if self.context is not None:
+                model = agent_model(agent)
+                reserved = self.context.count_messages(msgs, model)
+                if not isinstance(agent, HumanAgent):
+                    reserved += self.context.count_messages([{'content': prompt_usr}], model)
+                n_kept, summary = self.context.fit(agent_name, self.dialog, history, reserved, model)
+                history = history[len(history) - n_kept:]
+                if summary:
+                    update_msg(msgs, 'system', ContextBuilder.SUMMARY_HEADER + summary)
+            msgs.extend(history)
+            span['turns'] = len(history)
 
         if capture_debug:
-            space_snapshot = deepcopy(var_space.values)
+            space_snapshot = var_space.snapshot()
         else:
             space_snapshot = None
 
         if not isinstance(agent, HumanAgent):
             update_msg(msgs, 'user', prompt_usr)
 
-        if capture_debug:
-            messages_snapshot = deepcopy(msgs)
-        else:
-            messages_snapshot = None
-
-        response_json, response_info = agent.request(msgs)
+        if self.context is not None:
+            logger.info(f'{agent_name} prompt : {self.context.count_messages(msgs, agent_model(agent))} tokens, {len(history)} turns')
 
+        debug_payload = None
         if capture_debug:
+            # No deep copies : the snapshot is copy-on-write and message dicts are never mutated
             debug_payload = {
                 'space_values': space_snapshot,
-                'messages': messages_snapshot if messages_snapshot is not None else deepcopy(msgs),
+                'messages': list(msgs),
                 'system_prompt': prompt_sys,
                 'user_prompt': prompt_usr,
             }
+        return agent, msgs, debug_payload
+
+    def render_prompts(self, agent_name, agent, var_space: Space):
+        """
+        System and user prompts of ``agent_name``, rendered again only when a variable it reads
+        (`Space.read_by`) was written since the previous rendering for ``var_space``.
+        """
+        memo = self._prompts.setdefault(var_space, dict())
+        names = var_space.read_by(agent_name)
+        last = memo.get(agent_name)
+        # Spaces declaring no readers for the agent are rendered every time
+        if last is not None and names and last[0] <= var_space.version and not var_space.changed_since(last[0], names):
+            return last[1], last[2]
+
+        prompt_sys = agent.get_sys_prompt(var_space)
+        prompt_usr = agent.get_message(var_space)
+        memo[agent_name] = (var_space.version, prompt_sys, prompt_usr)
+        return prompt_sys, prompt_usr
+
+    def run(self, agent_name, var_space: Space, message_len:int, capture_debug: bool = False, on_token=None):
+        """``on_token(delta, stream)`` receives the chunks of agents streaming their completion."""
+        agent, msgs, debug_payload = self.build_request(agent_name, var_space, message_len, capture_debug)
+        response_json, response_info = self.complete(agent_name, agent, msgs, on_token=on_token)
+
+        if capture_debug:
             return response_json, response_info, debug_payload
+        return response_json, response_info
+
+    async def arun(self, agent_name, var_space: Space, message_len:int, capture_debug: bool = False, on_token=None):
+        """Same as `run`, awaiting the agent's request instead of blocking on it."""
+        agent, msgs, debug_payload = self.build_request(agent_name, var_space, message_len, capture_debug)
+        response_json, response_info = await self.acomplete(agent_name, agent, msgs, on_token=on_token)
 
+        if capture_debug:
+            return response_json, response_info, debug_payload
         return response_json, response_info
 
+    def branch(self, agent_name, var_space: Space, message_len:int, k:int, use_n: bool = False, capture_debug: bool = False):
+        """
+        ``k`` candidate responses of ``agent_name`` to the same request, each with its own fork
+        of this field and of ``var_space`` to continue from. The requests are sent concurrently,
+        or as a single call with the ``n`` parameter of the API when ``use_n``.
+        Returns ``(field, space, response, info)`` tuples, followed by the debug payload with
+        ``capture_debug``; fewer than ``k`` when candidates of an ``n`` call cannot be parsed.
+        """
+        agent, msgs, debug_payload = self.build_request(agent_name, var_space, message_len, capture_debug)
+        if isinstance(agent, HumanAgent):
+            raise ValueError(f'{agent_name} is a human agent, its turns cannot be branched')
+
+        if use_n:
+            candidates = self.complete_n(agent_name, agent, msgs, k)
+        else:
+            with ThreadPoolExecutor(max_workers=k, thread_name_prefix='branch') as executor:
+                futures = [executor.submit(self.complete, agent_name, agent, msgs, i) for i in range(k)]
+                candidates = [future.result() for future in futures]
+        return self.spawn(var_space, candidates, debug_payload, capture_debug)
+
+    async def abranch(self, agent_name, var_space: Space, message_len:int, k:int, use_n: bool = False, capture_debug: bool = False):
+        """Same as `branch`, the candidates being awaited together."""
+        agent, msgs, debug_payload = self.build_request(agent_name, var_space, message_len, capture_debug)
+        if isinstance(agent, HumanAgent):
+            raise ValueError(f'{agent_name} is a human agent, its turns cannot be branched')
+
+        if use_n:
+            candidates = await self.acomplete_n(agent_name, agent, msgs, k)
+        else:
+            candidates = await asyncio.gather(*(self.acomplete(agent_name, agent, msgs, i) for i in range(k)))
+        return self.spawn(var_space, candidates, debug_payload, capture_debug)
+
+    def spawn(self, var_space: Space, candidates, debug_payload, capture_debug: bool):
+        res = []
+        for response_json, response_info in candidates:
+            branch = (self.fork(), var_space.fork(), response_json, response_info)
+            res.append(branch + (debug_payload,) if capture_debug else branch)
+        return res
+
+    def complete(self, agent_name, agent, msgs, candidate=0, on_token=None):
+        """Send messages built by `build_request`; split from `run` so that requests can be built ahead."""
+        # Human agents take neither option
+        kwargs = request_kwargs(candidate, on_token)
+        with self.instrument.span('request', agent=agent_name):
+            response_json, response_info = agent.request(msgs, **kwargs)
+        self.add_context_info(agent, response_info, msgs)
+        self.record_call(agent_name, agent, response_info)
+        return response_json, response_info
+
+    async def acomplete(self, agent_name, agent, msgs, candidate=0, on_token=None):
+        kwargs = request_kwargs(candidate, on_token)
+        with self.instrument.span('request', agent=agent_name):
+            response_json, response_info = await agent.arequest(msgs, **kwargs)
+        self.add_context_info(agent, response_info, msgs)
+        self.record_call(agent_name, agent, response_info)
+        return response_json, response_info
+
+    def complete_n(self, agent_name, agent, msgs, n):
+        with self.instrument.span('request', agent=agent_name, n=n):
+            candidates = agent.request_n(msgs, n)
+        for _, response_info in candidates:
+            self.add_context_info(agent, response_info, msgs)
+            self.record_call(agent_name, agent, response_info)
+        return candidates
+
+    async def acomplete_n(self, agent_name, agent, msgs, n):
+        with self.instrument.span('request', agent=agent_name, n=n):
+            candidates = await agent.arequest_n(msgs, n)
+        for _, response_info in candidates:
+            self.add_context_info(agent, response_info, msgs)
+            self.record_call(agent_name, agent, response_info)
+        return candidates
+
+    def add_context_info(self, agent, response_info, msgs):
+        if self.context is not None:
+            # Token counts are memoized, this does not re-tokenize the prompt
+            response_info['context_tokens'] = self.context.count_messages(msgs, agent_model(agent))
+
+    def record_call(self, agent_name, agent, response_info):
+        if self.instrument.enabled:
+            model = agent_model(agent) or 'human'
+            provider = getattr(getattr(agent, 'provider', None), 'name', None)
+            self.instrument.llm_call(agent_name, model, response_info, provider=provider, turn=len(self.dialog))
+
+def agent_model(agent):
+    """Model called by ``agent``, None for a human."""
+    return agent.api_kwargs.get('model') if hasattr(agent, 'api_kwargs') else None
+
+
+def request_kwargs(candidate, on_token):
+    kwargs = dict()
+    if candidate:
+        kwargs['candidate'] = candidate
+    if on_token is not None:
+        kwargs['on_token'] = on_token
+    return kwargs
+
 def update_msg(_msg, _role, _content):
     _msg.append({'role': _role, 'content':_content})        
@@ -0,0 +1,231 @@
+import sys
+import json
+import time
+import logging
+import argparse
+from pathlib import Path
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+EVENTS_FNAME = 'events.jsonl'
+
+# USD per million (prompt, completion) tokens
+PRICES = {
+    'gpt-4-0125-preview': (10., 30.),
+    'gpt-4-turbo': (10., 30.),
+    'gpt-4': (30., 60.),
+    'gpt-4o': (2.5, 10.),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-3.5-turbo': (0.5, 1.5),
+}
+
+# Numeric fields of the response info copied to the llm_call events
+CALL_FIELDS = ('prompt_tokens', 'completion_tokens', 'latency', 'ttft', 'early_stop', 'cached', 'attempts', 'retries',
+               'context_tokens')
+
+
+class MemorySink:
+    """Keeps the events in a list, for tests and notebooks."""
+
+    def __init__(self) -> None:
+        self.events: List[Dict] = []
+
+    def emit(self, event: Dict) -> None:
+        self.events.append(event)
+
+    def close(self) -> None:
+        pass
+
+
+class JsonlSink:
+    """Appends one compact json line per event, flushed right away."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fh = self.path.open('a', encoding='utf-8')
+
+    def emit(self, event: Dict) -> None:
+        self.fh.write(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+class Instrument:
+    """
+    Emits timing spans and events to a sink (any object with ``emit(event)``).
+
+    Every event carries the ``tags`` of the instrument (e.g. the scenario), `bind` derives
+    an instrument with more tags on the same sink. Without a sink nothing is recorded and
+    spans only cost two clock reads.
+    """
+
+    def __init__(self, sink=None, **tags) -> None:
+        self.sink = sink
+        self.tags = tags
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+
+    def bind(self, **tags) -> 'Instrument':
+        return Instrument(self.sink, **dict(self.tags, **tags))
+
+    def emit(self, event: str, **fields) -> None:
+        if self.sink is not None:
+            self.sink.emit(dict(self.tags, event=event, time=time.time(), **fields))
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Dict]:
+        """Time the block; the yielded dict can be filled with attributes known at the end of it."""
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            if self.sink is not None:
+                self.emit('span', name=name, seconds=time.perf_counter() - start, **attrs)
+
+    def llm_call(self, agent_name: str, model: str, response_info: Dict, **fields) -> None:
+        info = {k: response_info[k] for k in CALL_FIELDS if isinstance(response_info.get(k), (int, float))}
+        self.emit('llm_call', agent=agent_name, model=model, **info, **fields)
+
+    def close(self) -> None:
+        if self.sink is not None:
+            self.sink.close()
+
+
+def add_instrument_arguments(parser) -> None:
+    parser.add_argument('--record_events', action='store_true',
+                        help=f'Write timing and token events of every turn to {EVENTS_FNAME}')
+
+
+def instrument_from_args(args, run_dir: Path, **tags) -> Instrument:
+    if not args.record_events:
+        return Instrument(**tags)
+    return Instrument(JsonlSink(Path(run_dir) / EVENTS_FNAME), **tags)
+
+
+def iter_events(paths: Iterable) -> Iterator[Dict]:
+    """Events of the given files, or of every events file below the given directories."""
+    for path in map(Path, paths):
+        files = sorted(path.rglob(EVENTS_FNAME)) if path.is_dir() else [path]
+        for fpath in files:
+            with fpath.open('r', encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        yield json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        logger.warning(f'Skip a truncated line of {fpath}')
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear interpolation between the closest ranks, as numpy's default."""
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    rank = (len(values) - 1) * q
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def call_cost(event: Dict) -> Optional[float]:
+    """USD cost of a call, 0 for cached ones and for the mock, replay and local providers."""
+    if event.get('cached') or event.get('provider', 'openai') != 'openai':
+        return 0.
+    price = PRICES.get(event.get('model'))
+    if price is None:
+        return None
+    return (event.get('prompt_tokens', 0) * price[0] + event.get('completion_tokens', 0) * price[1]) / 1e6
+
+
+def summarize(events: Iterable[Dict], by: List[str]) -> List[Dict]:
+    """
+    One row per group of ``by`` tags : p50/p95 latency of the LLM calls (and time to first
+    token of streamed ones), tokens per turn, cache hits, retries and cost, then p50/p95/total
+    seconds of every span name.
+    """
+    calls = defaultdict(list)
+    spans = defaultdict(list)
+    for event in events:
+        group = tuple(event.get(k) for k in by)
+        if event.get('event') == 'llm_call':
+            calls[group].append(event)
+        elif event.get('event') == 'span':
+            spans[group + (event['name'],)].append(event['seconds'])
+
+    rows = []
+    for group in sorted(calls, key=str):
+        group_calls = calls[group]
+        latencies = [c['latency'] for c in group_calls if 'latency' in c and not c.get('cached')]
+        costs = [call_cost(c) for c in group_calls]
+        rows.append(dict(
+            zip(by, group),
+            kind='llm_call',
+            n=len(group_calls),
+            p50=percentile(latencies, .5),
+            p95=percentile(latencies, .95),
+            prompt_tokens_per_turn=sum(c.get('prompt_tokens', 0) for c in group_calls) / len(group_calls),
+            completion_tokens_per_turn=sum(c.get('completion_tokens', 0) for c in group_calls) / len(group_calls),
+            cache_hits=sum(bool(c.get('cached')) for c in group_calls),
+            retries=sum(c.get('retries', 0) for c in group_calls),
+            cost=None if None in costs else sum(costs),
+        ))
+        ttfts = [c['ttft'] for c in group_calls if 'ttft' in c]
+        if ttfts:
+            rows[-1].update(ttft_p50=percentile(ttfts, .5), ttft_p95=percentile(ttfts, .95),
+                            early_stops=sum(bool(c.get('early_stop')) for c in group_calls))
+    for key in sorted(spans, key=str):
+        seconds = spans[key]
+        rows.append(dict(
+            zip(by, key[:-1]),
+            kind=key[-1],
+            n=len(seconds),
+            p50=percentile(seconds, .5),
+            p95=percentile(seconds, .95),
+            total=sum(seconds),
+        ))
+    return rows
+
+
+def format_report(rows: List[Dict]) -> str:
+    columns = list(dict.fromkeys(k for row in rows for k in row))
+
+    def fmt(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f'{value:.4f}'
+        return str(value)
+
+    table = [columns] + [[fmt(row.get(c)) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.ljust(w) for cell, w in zip(line, widths)) for line in table)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Summarize the events recorded with --record_events')
+    parser.add_argument('paths', nargs='+', help=f'{EVENTS_FNAME} files or directories holding them')
+    parser.add_argument('--by', nargs='*', default=['scenario', 'agent', 'model'],
+                        help='Event tags the report is grouped by')
+    parser.add_argument('--csv', type=str, default=None, help='Also write the report to this csv file')
+    args = parser.parse_args(argv)
+
+    rows = summarize(iter_events(args.paths), args.by)
+    sys.stdout.write(format_report(rows) + '\n')
+    if args.csv is not None:
+        import csv
+        columns = list(dict.fromkeys(k for row in rows for k in row))
+        with open(args.csv, 'w', encoding='utf-8', newline='') as fh:
+            writer = csv.DictWriter(fh, fieldnames=columns, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
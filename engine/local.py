@@ -0,0 +1,311 @@
+import queue
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from engine.provider import Provider, make_response
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_NEW_TOKENS = 512
+
+
+class _Sequence:
+    """A generation request, from its prefill to its last token."""
+    __slots__ = ('prompt_ids', 'prefix_ids', 'temperature', 'top_p', 'max_new_tokens', 'stop',
+                 'future', 'cache', 'length', 'generated')
+
+    def __init__(self, prompt_ids, prefix_ids, temperature, top_p, max_new_tokens, stop) -> None:
+        self.prompt_ids = prompt_ids
+        self.prefix_ids = prefix_ids
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop
+        self.future = Future()
+        # Legacy KV cache of the sequence : one (key, value) pair of [1, heads, length, dim] per layer
+        self.cache = None
+        self.length = 0
+        self.generated: List[int] = []
+
+
+class LocalEngine:
+    """
+    A causal LM loaded once per process (see `get_engine`), serving the generation requests
+    of every agent and field of the process with continuous batching.
+
+    Requests are tokenized by `submit` on the caller's thread and queued for a worker
+    thread, which admits them between two decoding steps. Each step is a single forward
+    pass over the last token of every active sequence; a finished sequence leaves the
+    batch right away and a queued one takes its place, so short answers never wait for
+    long ones. The KV cache of the leading system messages is kept in an LRU prefix cache
+    and shared by the requests starting with them, which then only prefill their turns.
+    """
+
+    def __init__(self, model_name: str, device: str = 'cpu', max_batch: int = 8, prefix_cache_size: int = 16) -> None:
+        try:
+            import torch
+            import transformers
+        except ImportError as err:
+            raise ImportError('The local provider needs torch and transformers : pip install torch transformers') from err
+        self.torch = torch
+        self.transformers = transformers
+
+        self.model_name = model_name
+        self.device = device
+        self.max_batch = max_batch
+        self.prefix_cache_size = prefix_cache_size
+
+        logger.info(f'Load {model_name} on {device}')
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+        self.model = transformers.AutoModelForCausalLM.from_pretrained(model_name).to(device).eval()
+
+        eos = self.model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, list) else [eos]
+        self.eos_ids = {i for i in eos + [self.tokenizer.eos_token_id] if i is not None}
+
+        self.stats = dict(requests=0, steps=0, batched=0, prefix_hits=0, prefix_misses=0)
+        self._prefixes = OrderedDict()
+        self._queue = queue.Queue()
+        self._active: List[_Sequence] = []
+        self._closing = False
+        self._thread = threading.Thread(target=self._loop, name=f'local-{model_name}', daemon=True)
+        self._thread.start()
+
+    def encode(self, messages: List[Dict], add_generation_prompt: bool = True) -> List[int]:
+        if getattr(self.tokenizer, 'chat_template', None):
+            return list(self.tokenizer.apply_chat_template(messages, add_generation_prompt=add_generation_prompt))
+        # Base models : plain transcript
+        text = ''.join(f"{m['role']}: {m['content']}\n" for m in messages)
+        if add_generation_prompt:
+            text += 'assistant: '
+        return self.tokenizer.encode(text)
+
+    def submit(self, messages: List[Dict], temperature: float = 1., top_p: float = 1.,
+               max_tokens: Optional[int] = None, stop=None) -> Future:
+        """Queue a chat completion, the future resolves to (text, prompt tokens, completion tokens)."""
+        prompt_ids = self.encode(messages)
+        n_system = 0
+        while n_system < len(messages) - 1 and messages[n_system]['role'] == 'system':
+            n_system += 1
+        prefix_ids = None
+        if n_system:
+            prefix_ids = self.encode(messages[:n_system], add_generation_prompt=False)
+            # Templates may tokenize the boundary differently, the prefix is only reused when it matches
+            if prompt_ids[:len(prefix_ids)] != prefix_ids or len(prefix_ids) >= len(prompt_ids):
+                prefix_ids = None
+
+        seq = _Sequence(prompt_ids, prefix_ids, temperature, top_p,
+                        max_tokens or DEFAULT_MAX_NEW_TOKENS, [stop] if isinstance(stop, str) else stop)
+        self.stats['requests'] += 1
+        self._queue.put(seq)
+        return seq.future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _loop(self) -> None:
+        with self.torch.inference_mode():
+            while not (self._closing and not self._active):
+                if not self._active:
+                    self._admit(self._queue.get())
+                while len(self._active) < self.max_batch and not self._closing:
+                    try:
+                        self._admit(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if self._active:
+                    try:
+                        self._step()
+                    except Exception as err:
+                        logger.exception('Decoding step failed')
+                        for seq in self._active:
+                            seq.future.set_exception(err)
+                        self._active = []
+        # Requests queued after close
+        while not self._queue.empty():
+            seq = self._queue.get_nowait()
+            if seq is not None:
+                seq.future.set_exception(RuntimeError(f'{self.model_name} engine is closed'))
+
+    def _admit(self, seq: Optional[_Sequence]) -> None:
+        if seq is None:
+            self._closing = True
+            return
+        try:
+            logits = self._prefill(seq)
+        except Exception as err:
+            seq.future.set_exception(err)
+            return
+        if not self._append(seq, self._sample(logits, [seq])[0]):
+            self._active.append(seq)
+
+    def _prefill(self, seq: _Sequence):
+        past, start = None, 0
+        if seq.prefix_ids is not None:
+            key = tuple(seq.prefix_ids)
+            past = self._prefixes.get(key)
+            if past is None:
+                self.stats['prefix_misses'] += 1
+                out = self._forward(seq.prefix_ids, None)
+                past = self._to_legacy(out.past_key_values)
+                self._prefixes[key] = past
+                if len(self._prefixes) > self.prefix_cache_size:
+                    self._prefixes.popitem(last=False)
+            else:
+                self.stats['prefix_hits'] += 1
+                self._prefixes.move_to_end(key)
+            start = len(seq.prefix_ids)
+
+        # The prefix tensors are shared : the model concatenates new entries instead of writing to them
+        out = self._forward(seq.prompt_ids[start:], past)
+        seq.cache = self._to_legacy(out.past_key_values)
+        seq.length = len(seq.prompt_ids)
+        return out.logits[:, -1, :]
+
+    def _forward(self, ids: List[int], past):
+        torch = self.torch
+        input_ids = torch.tensor([ids], device=self.device)
+        past_len = past[0][0].shape[2] if past is not None else 0
+        attention_mask = torch.ones((1, past_len + len(ids)), dtype=torch.long, device=self.device)
+        return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                          past_key_values=self._from_legacy(past), use_cache=True)
+
+    def _step(self) -> None:
+        """One decoding step of every active sequence, caches left-padded to the longest one."""
+        torch = self.torch
+        seqs = self._active
+        max_len = max(seq.length for seq in seqs)
+        pads = [max_len - seq.length for seq in seqs]
+
+        past = []
+        for layer in range(len(seqs[0].cache)):
+            keys, values = [], []
+            for seq, pad in zip(seqs, pads):
+                key, value = seq.cache[layer]
+                keys.append(torch.nn.functional.pad(key, (0, 0, pad, 0)))
+                values.append(torch.nn.functional.pad(value, (0, 0, pad, 0)))
+            past.append((torch.cat(keys), torch.cat(values)))
+
+        input_ids = torch.tensor([[seq.generated[-1]] for seq in seqs], device=self.device)
+        attention_mask = torch.ones((len(seqs), max_len + 1), dtype=torch.long, device=self.device)
+        for i, pad in enumerate(pads):
+            attention_mask[i, :pad] = 0
+        position_ids = torch.tensor([[seq.length] for seq in seqs], device=self.device)
+
+        out = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                         past_key_values=self._from_legacy(tuple(past)), use_cache=True)
+        self.stats['steps'] += 1
+        self.stats['batched'] += len(seqs)
+
+        new_past = self._to_legacy(out.past_key_values)
+        tokens = self._sample(out.logits[:, -1, :], seqs)
+        active = []
+        for i, (seq, pad, token) in enumerate(zip(seqs, pads, tokens)):
+            seq.cache = tuple((key[i:i + 1, :, pad:], value[i:i + 1, :, pad:]) for key, value in new_past)
+            seq.length += 1
+            if not self._append(seq, token):
+                active.append(seq)
+        self._active = active
+
+    def _sample(self, logits, seqs: List[_Sequence]) -> List[int]:
+        torch = self.torch
+        tokens = []
+        for row, seq in zip(logits.float(), seqs):
+            if seq.temperature <= 0:
+                tokens.append(int(row.argmax()))
+                continue
+            probs = torch.softmax(row / seq.temperature, dim=-1)
+            if seq.top_p < 1:
+                sorted_probs, order = probs.sort(descending=True)
+                keep = sorted_probs.cumsum(-1) - sorted_probs < seq.top_p
+                probs = torch.zeros_like(probs).scatter(0, order[keep], sorted_probs[keep])
+            tokens.append(int(torch.multinomial(probs, 1)))
+        return tokens
+
+    def _append(self, seq: _Sequence, token: int) -> bool:
+        """Add a token to the sequence, returns whether it is finished."""
+        finished = token in self.eos_ids
+        if not finished:
+            seq.generated.append(token)
+            finished = len(seq.generated) >= seq.max_new_tokens
+        text = None
+        if seq.stop and not finished:
+            text = self.tokenizer.decode(seq.generated, skip_special_tokens=True)
+            finished = any(s in text for s in seq.stop)
+        if finished:
+            if text is None:
+                text = self.tokenizer.decode(seq.generated, skip_special_tokens=True)
+            for s in seq.stop or []:
+                text = text.split(s)[0]
+            seq.cache = None
+            seq.future.set_result((text, len(seq.prompt_ids), len(seq.generated)))
+        return finished
+
+    def _to_legacy(self, cache) -> Tuple:
+        return cache.to_legacy_cache() if hasattr(cache, 'to_legacy_cache') else cache
+
+    def _from_legacy(self, past):
+        cache_cls = getattr(self.transformers, 'DynamicCache', None)
+        if past is None or cache_cls is None:
+            return past
+        return cache_cls.from_legacy_cache(past)
+
+
+_ENGINES: Dict[Tuple, LocalEngine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def get_engine(model_name: str, device: str = 'cpu', max_batch: int = 8) -> LocalEngine:
+    """The engine of ``model_name`` shared by the whole process, loaded on first use."""
+    key = (model_name, device)
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = _ENGINES[key] = LocalEngine(model_name, device=device, max_batch=max_batch)
+    return engine
+
+
+class LocalProvider(Provider):
+    """
+    Chat completions generated in-process by a `LocalEngine`, shared by every agent of the
+    process using the same model. Without ``model_name``, the model of each request
+    (``api_inps.model`` of the prompt) is loaded. The ``n`` parameter is served with
+    ``n`` sequences of the batch; ``response_format`` is not enforced, responses go through
+    the usual json repair.
+    """
+    name = 'local'
+
+    def __init__(self, model_name: Optional[str] = None, device: str = 'cpu', max_batch: int = 8) -> None:
+        self.model_name = model_name
+        self.device = device
+        self.max_batch = max_batch
+
+    def submit(self, messages: List[Dict], api_kwargs: Dict) -> List[Future]:
+        engine = get_engine(self.model_name or api_kwargs['model'], self.device, self.max_batch)
+        return [
+            engine.submit(messages,
+                          temperature=api_kwargs.get('temperature', 1.),
+                          top_p=api_kwargs.get('top_p', 1.),
+                          max_tokens=api_kwargs.get('max_tokens'),
+                          stop=api_kwargs.get('stop'))
+            for _ in range(api_kwargs.get('n', 1))
+        ]
+
+    @staticmethod
+    def collect(results: List[Tuple]) -> Dict:
+        return make_response([text for text, _, _ in results],
+                             prompt_tokens=results[0][1],
+                             completion_tokens=sum(n for _, _, n in results))
+
+    def create(self, messages: List[Dict], **api_kwargs) -> Dict:
+        return self.collect([future.result() for future in self.submit(messages, api_kwargs)])
+
+    async def acreate(self, messages: List[Dict], **api_kwargs) -> Dict:
+        # Awaiting the futures does not hold a thread per request : every session shares the worker
+        futures = self.submit(messages, api_kwargs)
+        return self.collect(await asyncio.gather(*map(asyncio.wrap_future, futures)))
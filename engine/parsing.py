@@ -0,0 +1,223 @@
+import re
+import json
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_FENCE_PATTERN = re.compile(r'```(?:json)?\s*(.*?)(?:```|$)', re.DOTALL)
+_TRAILING_COMMA_PATTERN = re.compile(r',\s*([}\]])')
+
+
+class ResponseParseError(ValueError):
+    pass
+
+
+def _close_truncated(text: str) -> str:
+    """Close the strings, arrays and objects left open by a truncated completion."""
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(',')
+    if text.endswith(':'):
+        text += 'null'
+    return text + ''.join(reversed(stack))
+
+
+def repair_json(text: str) -> Tuple[Dict, bool]:
+    """
+    Decode the json object of a completion, repairing the usual defects :
+    code fences, text around the object, trailing commas and truncated endings.
+    Returns the object and whether a repair was needed.
+    """
+    try:
+        payload = json.loads(text)
+        if isinstance(payload, dict):
+            return payload, False
+    except json.decoder.JSONDecodeError:
+        pass
+
+    candidate = text.strip()
+    fenced = _FENCE_PATTERN.search(candidate)
+    if fenced:
+        candidate = fenced.group(1).strip()
+    start = candidate.find('{')
+    if start < 0:
+        raise ResponseParseError(f'No json object in the response : {text[:200]!r}')
+    candidate = candidate[start:]
+
+    end = candidate.rfind('}')
+    attempts = [candidate[:end + 1]] if end >= 0 else []
+    attempts.append(_close_truncated(candidate))
+    for attempt in attempts:
+        attempt = _TRAILING_COMMA_PATTERN.sub(r'\1', attempt)
+        try:
+            payload = json.loads(attempt)
+        except json.decoder.JSONDecodeError:
+            continue
+        if isinstance(payload, dict):
+            return payload, True
+    raise ResponseParseError(f'Cannot repair the response : {text[:200]!r}')
+
+
+class ResponseParser:
+    """
+    Parses json completions and checks the keys a prompt declares in ``user.outs``.
+    Counts how many responses were parsed directly, repaired or rejected.
+    """
+
+    def __init__(self, required_keys: Iterable[str] = ()) -> None:
+        self.required_keys = list(required_keys or [])
+        self.stats = dict(ok=0, repaired=0, failed=0)
+
+    def parse(self, content) -> Tuple[Dict, str]:
+        if isinstance(content, dict):
+            payload, repaired = content, False
+        else:
+            try:
+                payload, repaired = repair_json(content)
+            except ResponseParseError:
+                self.stats['failed'] += 1
+                raise
+
+        missing = [k for k in self.required_keys if k not in payload]
+        if missing:
+            self.stats['failed'] += 1
+            raise ResponseParseError(f'{missing} missing in the response : {payload}')
+
+        status = 'repaired' if repaired else 'ok'
+        if repaired:
+            logger.info(f'Repaired response : {str(content)[:200]!r}')
+        self.stats[status] += 1
+        return payload, status
+
+
+class JsonStream:
+    """
+    Incremental scan of a json object received in chunks (`feed`).
+
+    Tracks the top-level keys whose value is complete, so that a streamed completion can
+    be closed as soon as every one of ``required_keys`` is (`done`), and exposes the
+    partial value of a string key while it is generated (`partial`).
+    """
+
+    def __init__(self, required_keys: Iterable[str] = ()) -> None:
+        self.required_keys = set(required_keys or [])
+        self.complete_keys = set()
+        self.text = ''
+
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._string_start = 0
+        # At depth 1 : reading a 'key', waiting for its 'value', or 'after' a string / nested value
+        self._state = 'key'
+        self._key = None
+        # key -> start of its string value in self.text
+        self._starts = dict()
+        # Length of the text when the stream became done
+        self._done_at = None
+
+    @property
+    def done(self) -> bool:
+        return bool(self.required_keys) and self.required_keys <= self.complete_keys
+
+    def feed(self, chunk: str) -> None:
+        offset = len(self.text)
+        self.text += chunk
+        for pos, char in enumerate(chunk, offset):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._close_string(pos)
+            elif self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+                    self._state = 'key'
+            elif char == '"':
+                self._in_string = True
+                self._string_start = pos + 1
+                if self._depth == 1 and self._state == 'value':
+                    self._starts[self._key] = pos + 1
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 1 and self._state == 'value':
+                    self._complete('after', pos)
+                elif self._depth == 0 and self._state == 'value':
+                    # Last value of the object, a number or literal
+                    self._complete('after', pos - 1)
+            elif self._depth == 1:
+                if char == ':':
+                    self._state = 'value'
+                elif char == ',':
+                    if self._state == 'value':
+                        self._complete('key', pos - 1)
+                    self._state = 'key'
+
+    def _close_string(self, pos: int) -> None:
+        raw = self.text[self._string_start:pos]
+        if self._state == 'key':
+            self._key = _decode_string(raw)
+        elif self._state == 'value':
+            self._complete('after', pos)
+
+    def _complete(self, state: str, end: int) -> None:
+        self.complete_keys.add(self._key)
+        self._state = state
+        if self._done_at is None and self.done:
+            self._done_at = end + 1
+
+    def partial(self, key: str) -> Optional[str]:
+        """Value of a string key as generated so far, None before it starts."""
+        start = self._starts.get(key)
+        if start is None:
+            return None
+        raw = self.text[start:]
+        if key in self.complete_keys:
+            raw = raw[:_string_end(raw)]
+        return _decode_string(raw.rstrip('\\'))
+
+    def closed_text(self) -> str:
+        """The text received until `done` (or so far), with the open strings, arrays and objects closed."""
+        return _close_truncated(self.text[:self._done_at])
+
+
+def _string_end(raw: str) -> int:
+    escaped = False
+    for pos, char in enumerate(raw):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            return pos
+    return len(raw)
+
+
+def _decode_string(raw: str) -> str:
+    try:
+        return json.loads(f'"{raw}"')
+    except json.decoder.JSONDecodeError:
+        return raw
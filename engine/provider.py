@@ -0,0 +1,229 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from collections import defaultdict, deque
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+from engine.artifacts import find_scenario_dirs, iter_artifacts
+
+logger = logging.getLogger(__name__)
+
+
+def make_response(content: Union[str, List[str]], prompt_tokens: int = 0, completion_tokens: int = 0) -> Dict:
+    """Build a response shaped like ``openai.ChatCompletion.create`` output, one choice per content."""
+    contents = [content] if isinstance(content, str) else content
+    return {
+        'choices': [{'index': i, 'message': {'role': 'assistant', 'content': c}} for i, c in enumerate(contents)],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens},
+    }
+
+
+def hash_messages(messages: List[Dict]) -> str:
+    content = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class Provider:
+    """
+    Backend serving chat completions to an :class:`engine.agent.Agent`.
+
+    `stream` yields the completion in chunks ``{'content': delta}``, a chunk may also carry
+    the ``usage`` of the call; closing the iterator abandons the completion. Backends without
+    streaming yield the whole completion at once.
+    """
+    name = None
+
+    def create(self, messages: List[Dict], **api_kwargs) -> Dict:
+        raise NotImplementedError()
+
+    async def acreate(self, messages: List[Dict], **api_kwargs) -> Dict:
+        return await asyncio.to_thread(self.create, messages, **api_kwargs)
+
+    def stream(self, messages: List[Dict], **api_kwargs) -> Iterator[Dict]:
+        response = self.create(messages, **api_kwargs)
+        yield {'content': response['choices'][0]['message']['content'], 'usage': response.get('usage')}
+
+    async def astream(self, messages: List[Dict], **api_kwargs) -> AsyncIterator[Dict]:
+        response = await self.acreate(messages, **api_kwargs)
+        yield {'content': response['choices'][0]['message']['content'], 'usage': response.get('usage')}
+
+
+class OpenAIProvider(Provider):
+    name = 'openai'
+
+    def create(self, messages: List[Dict], **api_kwargs) -> Dict:
+        from openai import ChatCompletion
+        return ChatCompletion.create(messages=messages, **api_kwargs)
+
+    async def acreate(self, messages: List[Dict], **api_kwargs) -> Dict:
+        from openai import ChatCompletion
+        return await ChatCompletion.acreate(messages=messages, **api_kwargs)
+
+    def stream(self, messages: List[Dict], **api_kwargs) -> Iterator[Dict]:
+        from openai import ChatCompletion
+        chunks = ChatCompletion.create(messages=messages, stream=True, **api_kwargs)
+        try:
+            for chunk in chunks:
+                yield self.read_chunk(chunk)
+        finally:
+            # Stopping early closes the connection
+            chunks.close()
+
+    async def astream(self, messages: List[Dict], **api_kwargs) -> AsyncIterator[Dict]:
+        from openai import ChatCompletion
+        chunks = await ChatCompletion.acreate(messages=messages, stream=True, **api_kwargs)
+        try:
+            async for chunk in chunks:
+                yield self.read_chunk(chunk)
+        finally:
+            await chunks.aclose()
+
+    @staticmethod
+    def read_chunk(chunk) -> Dict:
+        choices = chunk.get('choices') or [{}]
+        return {'content': choices[0].get('delta', {}).get('content'), 'usage': chunk.get('usage')}
+
+
+class MockProvider(Provider):
+    """
+    Synthetic backend for benchmarks and offline tests.
+
+    Unless a ``responder`` is given, it answers with a json object holding every key
+    the last user message asks for (``"Key": ...``), or ``keys`` when set. The ``n``
+    parameter of the API is honoured with one answer per choice.
+    """
+    name = 'mock'
+    KEY_PATTERN = re.compile(r'"(\w+)"\s*:')
+
+    def __init__(self, latency: float = 0., keys: Optional[List[str]] = None, responder: Callable = None) -> None:
+        self.latency = latency
+        self.keys = keys
+        self.responder = responder
+        self.n_calls = 0
+
+    def respond(self, messages: List[Dict]) -> str:
+        self.n_calls += 1
+        if self.responder is not None:
+            return self.responder(messages)
+
+        keys = self.keys
+        if keys is None:
+            user_content = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+            keys = list(dict.fromkeys(self.KEY_PATTERN.findall(user_content))) or ['Response']
+        return json.dumps({k: f'mock {k} #{self.n_calls}' for k in keys})
+
+    def usage(self, messages: List[Dict], contents: List[str]) -> Dict:
+        prompt_tokens = sum(len(str(m['content']).split()) for m in messages)
+        return dict(prompt_tokens=prompt_tokens, completion_tokens=sum(len(c.split()) for c in contents))
+
+    def complete(self, messages: List[Dict], n: int = 1) -> Dict:
+        contents = [self.respond(messages) for _ in range(n)]
+        return make_response(contents, **self.usage(messages, contents))
+
+    def create(self, messages: List[Dict], **api_kwargs) -> Dict:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.complete(messages, api_kwargs.get('n', 1))
+
+    async def acreate(self, messages: List[Dict], **api_kwargs) -> Dict:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self.complete(messages, api_kwargs.get('n', 1))
+
+    def chunks(self, messages: List[Dict]) -> List[str]:
+        """The completion split in chunks of about 4 characters, as a streaming API sends tokens."""
+        content = self.respond(messages)
+        return [content[i:i + 4] for i in range(0, len(content), 4)]
+
+    def stream(self, messages: List[Dict], **api_kwargs) -> Iterator[Dict]:
+        # The latency is spread over the chunks
+        chunks = self.chunks(messages)
+        for chunk in chunks:
+            if self.latency > 0:
+                time.sleep(self.latency / len(chunks))
+            yield {'content': chunk}
+
+    async def astream(self, messages: List[Dict], **api_kwargs) -> AsyncIterator[Dict]:
+        chunks = self.chunks(messages)
+        for chunk in chunks:
+            if self.latency > 0:
+                await asyncio.sleep(self.latency / len(chunks))
+            yield {'content': chunk}
+
+
+class ReplayProvider(Provider):
+    """
+    Serves responses recorded by ``run_clinical_conversation.run_scenario``.
+
+    Every artifact below ``artifact_dir`` (``artifacts.jsonl(.gz)`` or legacy
+    ``turn_XX_*.json`` files) is indexed by the hash of its ``request_messages``;
+    a request with identical messages is answered with the recorded ``response_payload``.
+    Identical requests recorded several times are replayed in order.
+    """
+    name = 'replay'
+
+    def __init__(self, artifact_dir: str, fallback: Provider = None) -> None:
+        self.artifact_dir = Path(artifact_dir)
+        self.fallback = fallback
+        self.records = defaultdict(deque)
+
+        for scenario_dir in find_scenario_dirs(self.artifact_dir):
+            for artifact in iter_artifacts(scenario_dir):
+                self.add_record(artifact)
+        logger.info(f'Loaded {sum(map(len, self.records.values()))} recorded responses from {self.artifact_dir}')
+
+    def add_record(self, artifact: Dict) -> None:
+        info = artifact.get('response_info', {})
+        payload = artifact['response_payload']
+        # Plain-text responses were recorded as strings, served back unchanged
+        content = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False)
+        response = make_response(content,
+                                 info.get('prompt_tokens', 0),
+                                 info.get('completion_tokens', 0))
+        self.records[hash_messages(artifact['request_messages'])].append(response)
+
+    def create(self, messages: List[Dict], **api_kwargs) -> Dict:
+        recorded = self.records.get(hash_messages(messages))
+        if recorded:
+            # Keep the last response around so that re-running the same request still works
+            return recorded.popleft() if len(recorded) > 1 else recorded[0]
+        if self.fallback is not None:
+            return self.fallback.create(messages, **api_kwargs)
+        raise KeyError(f'No recorded response in {self.artifact_dir} for the request')
+
+    async def acreate(self, messages: List[Dict], **api_kwargs) -> Dict:
+        recorded = self.records.get(hash_messages(messages))
+        if not recorded and self.fallback is not None:
+            return await self.fallback.acreate(messages, **api_kwargs)
+        return self.create(messages, **api_kwargs)
+
+
+PROVIDERS = ['openai', 'mock', 'replay', 'local']
+
+
+def add_provider_arguments(parser) -> None:
+    parser.add_argument('--provider', type=str, default='openai', choices=PROVIDERS)
+    parser.add_argument('--replay_dir', type=str, default=None, help='Recorded artifacts served by the replay provider')
+    parser.add_argument('--mock_latency', type=float, default=0., help='Synthetic latency (s) of the mock provider')
+    parser.add_argument('--local_model', type=str, default=None, help='Hugging Face model served by the local provider')
+    parser.add_argument('--local_device', type=str, default='cpu')
+    parser.add_argument('--local_max_batch', type=int, default=8, help='Sequences decoded together by the local provider')
+
+
+def provider_from_args(args) -> Optional[Provider]:
+    """Returns None for openai, agents then follow the provider of their prompt."""
+    if args.provider == 'mock':
+        return MockProvider(latency=args.mock_latency)
+    if args.provider == 'replay':
+        assert args.replay_dir is not None, '--replay_dir is required by the replay provider'
+        return ReplayProvider(args.replay_dir)
+    if args.provider == 'local':
+        assert args.local_model is not None, '--local_model is required by the local provider'
+        # Imported here : engine.local imports this module
+        from engine.local import LocalProvider
+        return LocalProvider(args.local_model, device=args.local_device, max_batch=args.local_max_batch)
+    return None
@@ -0,0 +1,226 @@
+import os
+import json
+import logging
+from pathlib import Path
+from urllib.parse import quote, unquote
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIRNAME = 'results'
+FORMATS = ('auto', 'parquet', 'csv', 'off')
+# Typed columns of the turn rows, every other column is a string
+NUMERIC_COLUMNS = {
+    'turn': 'int64',
+    'node': 'int64',
+    'parent': 'int64',
+    'seed': 'int64',
+    'prompt_tokens': 'int64',
+    'completion_tokens': 'int64',
+    'retries': 'int64',
+    'attempts': 'int64',
+    'latency': 'float64',
+    'ttft': 'float64',
+    'cached': 'bool',
+    'early_stop': 'bool',
+}
+
+
+def has_pyarrow() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ResultsStore:
+    """
+    Dataset of the turn rows of many runs, partitioned like ``root/persona=.../seed=.../<run>.parquet``.
+
+    Each run writes one part file (`write`), so concurrent runs never share a file and a
+    rerun replaces its own part. Partition values are also stored as columns of the part.
+    With Parquet, the numeric columns (`NUMERIC_COLUMNS`) keep their types, ``static``
+    columns, repeated on every turn of a run, are dictionary-encoded, and the other string
+    columns are dictionary-encoded per page by the writer. Without ``pyarrow``, parts are
+    written as CSV files; `load_results` reads both.
+    """
+
+    def __init__(self, root: Path, fmt: str = 'auto') -> None:
+        if fmt not in FORMATS[:-1]:
+            raise ValueError(f'Unknown results format {fmt}, expected one of {FORMATS[:-1]}')
+        if fmt == 'auto':
+            fmt = 'parquet' if has_pyarrow() else 'csv'
+        elif fmt == 'parquet' and not has_pyarrow():
+            raise ImportError('Parquet results need pyarrow (pip install pyarrow), or use --results_format csv')
+        self.root = Path(root)
+        self.fmt = fmt
+
+    def __repr__(self) -> str:
+        return f'ResultsStore(root={self.root}, fmt={self.fmt})'
+
+    def part_path(self, partition: Dict, name: str) -> Path:
+        part_dir = self.root.joinpath(*(f'{k}={quote(str(v), safe="")}' for k, v in partition.items()))
+        return part_dir / f'{name}.{self.fmt}'
+
+    def write(self, rows: List[Dict], partition: Dict, name: str = 'part', static: Iterable[str] = ()) -> Path:
+        """Write the rows of a run under its ``partition`` values, returns the part path."""
+        path = self.part_path(partition, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        frame = to_frame([dict(partition, **row) for row in rows])
+
+        # Written aside then renamed, so readers never see a partial part
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        if self.fmt == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(to_table(frame, set(static) | set(partition)), tmp_path, use_dictionary=True, compression='zstd')
+        else:
+            frame.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        logger.debug(f'{len(frame)} rows written to {path}')
+        return path
+
+
+def to_frame(rows: List[Dict]) -> pd.DataFrame:
+    """Rows as a frame of typed numeric columns and string columns (lists and dicts as json)."""
+    frame = pd.DataFrame(rows)
+    for column in frame.columns:
+        dtype = NUMERIC_COLUMNS.get(column)
+        if dtype == 'bool':
+            frame[column] = frame[column].map(_to_bool).astype('boolean')
+        elif dtype is not None:
+            frame[column] = pd.to_numeric(frame[column], errors='coerce').astype('Int64' if dtype == 'int64' else dtype)
+        else:
+            frame[column] = frame[column].map(_to_str).astype('string')
+    return frame
+
+
+def _to_bool(value) -> Optional[bool]:
+    if isinstance(value, str):
+        return {'true': True, 'false': False}.get(value.lower())
+    return None if value is None or value != value else bool(value)
+
+
+def _to_str(value) -> Optional[str]:
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def to_table(frame: pd.DataFrame, static: Iterable[str] = ()):
+    import pyarrow as pa
+
+    static = set(static)
+    fields = []
+    for column in frame.columns:
+        dtype = NUMERIC_COLUMNS.get(column)
+        if dtype is not None:
+            fields.append(pa.field(column, {'int64': pa.int64(), 'float64': pa.float64(), 'bool': pa.bool_()}[dtype]))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    table = pa.Table.from_pandas(frame, schema=pa.schema(fields), preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        if name in static and NUMERIC_COLUMNS.get(name) is None:
+            table = table.set_column(i, name, table.column(i).dictionary_encode())
+    return table
+
+
+def iter_parts(root: Path, filters: Dict = None) -> Iterator[Tuple[Path, Dict]]:
+    """
+    Part files below ``root`` with their partition values. Directories whose partition value
+    does not match ``filters`` (a value or a list of values per column) are not listed.
+    """
+    filters = {k: {str(v) for v in (vs if isinstance(vs, (list, tuple, set)) else [vs])}
+               for k, vs in (filters or {}).items()}
+
+    def walk(path: Path, partition: Dict) -> Iterator[Tuple[Path, Dict]]:
+        for entry in sorted(os.scandir(path), key=lambda e: e.name):
+            if entry.is_dir():
+                key, sep, value = entry.name.partition('=')
+                if not sep:
+                    continue
+                value = unquote(value)
+                if key in filters and value not in filters[key]:
+                    continue
+                yield from walk(Path(entry.path), dict(partition, **{key: value}))
+            elif entry.name.endswith(('.parquet', '.csv')) and not entry.name.startswith('.'):
+                yield Path(entry.path), partition
+
+    root = Path(root)
+    if root.is_dir():
+        yield from walk(root, dict())
+
+
+def load_results(root: Path, columns: List[str] = None, filters: Dict = None) -> pd.DataFrame:
+    """
+    Turn rows of every run below ``root`` as one frame.
+
+    ``filters`` maps columns to a value or a list of accepted values : partition columns prune
+    directories before any file is opened, the other columns are filtered while reading.
+    ``columns`` restricts the columns read from the parts.
+    """
+    parts = [path for path, _ in iter_parts(root, filters)]
+    parquet_parts = [str(p) for p in parts if p.suffix == '.parquet']
+    csv_parts = [p for p in parts if p.suffix == '.csv']
+
+    frames = []
+    if parquet_parts:
+        frames.append(_read_parquet(parquet_parts, columns, filters))
+    if csv_parts:
+        wanted = None if columns is None else set(columns) | set(filters or {})
+        frame = to_frame(pd.concat([pd.read_csv(p, dtype=str, keep_default_na=False, na_values=[''],
+                                                usecols=lambda c: wanted is None or c in wanted) for p in csv_parts],
+                                   ignore_index=True))
+        for key, values in (filters or {}).items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            if key not in frame.columns:
+                frame = frame.iloc[:0]
+                continue
+            frame = frame[frame[key].astype(str).isin({str(v) for v in values})]
+        frames.append(frame if columns is None else frame[[c for c in columns if c in frame.columns]])
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def _read_parquet(paths: List[str], columns: Optional[List[str]], filters: Optional[Dict]) -> pd.DataFrame:
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as err:
+        raise ImportError('Reading Parquet results needs pyarrow (pip install pyarrow)') from err
+
+    # Runs may have different columns (e.g. a router adds selected_therapist) : read under the union
+    schema = pa.unify_schemas([pq.read_schema(p) for p in paths])
+    dataset = ds.dataset(paths, schema=schema, format='parquet')
+    expression = None
+    for key, values in (filters or {}).items():
+        values = list(values) if isinstance(values, (list, tuple, set)) else [values]
+        if key not in schema.names:
+            return pd.DataFrame(columns=columns)
+        value_type = schema.field(key).type
+        if pa.types.is_dictionary(value_type):
+            value_type = value_type.value_type
+        condition = ds.field(key).isin(pa.array(values).cast(value_type))
+        expression = condition if expression is None else expression & condition
+    if columns is not None:
+        columns = [c for c in columns if c in schema.names]
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def add_results_arguments(parser) -> None:
+    parser.add_argument('--results_dir', type=str, default=None,
+                        help=f'Partitioned dataset of the turn rows (default : {RESULTS_DIRNAME}/ in the output directory)')
+    parser.add_argument('--results_format', type=str, default='auto', choices=FORMATS,
+                        help='parquet (needs pyarrow), csv, auto (parquet if pyarrow is installed) or off')
+
+
+def results_from_args(args, output_dir: Path) -> Optional[ResultsStore]:
+    if args.results_format == 'off':
+        return None
+    return ResultsStore(args.results_dir or Path(output_dir) / RESULTS_DIRNAME, fmt=args.results_format)
@@ -0,0 +1,217 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _retryable_errors():
+    errors = [TimeoutError, ConnectionError, asyncio.TimeoutError]
+    try:
+        from openai import error
+        errors += [error.RateLimitError, error.APIError, error.Timeout,
+                   error.ServiceUnavailableError, error.APIConnectionError, error.TryAgain]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+
+RETRYABLE_ERRORS = _retryable_errors()
+
+
+def estimate_tokens(messages: List[Dict], api_kwargs: Dict) -> int:
+    """Cheap upper-ish estimate (4 characters per token) used to debit the token bucket up front."""
+    prompt = sum(len(str(m['content'])) for m in messages) // 4 + 4 * len(messages)
+    return prompt + api_kwargs.get('max_tokens', 0)
+
+
+class TokenBucket:
+    """
+    Bucket refilled at ``rate`` units per minute, holding at most ``capacity`` units.
+    `reserve` debits immediately and returns how long the caller must wait, so that
+    concurrent callers queue up without holding the lock while they sleep.
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        self.rate = rate / 60.
+        self.capacity = capacity if capacity is not None else rate
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            # A single request larger than the bucket can still go through once it is full
+            amount = min(amount, self.capacity)
+            self.level -= amount
+            return 0. if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Give back (or take, if negative) ``amount`` once the actual usage is known."""
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RequestScheduler:
+    """
+    Rate limiting, retries and timeouts around provider calls.
+
+    Every model gets a requests-per-minute and a tokens-per-minute bucket; limits come from
+    `set_limits` (e.g. ``api_inps.rate_limit`` of a prompt) or the scheduler defaults.
+    Retryable errors are retried with full-jitter exponential backoff, honouring the
+    ``Retry-After`` header when the API sends one. One scheduler can be shared by every
+    field of a process so that concurrent scenarios draw from the same quota.
+    """
+
+    def __init__(self,
+                 rpm: Optional[float] = None,
+                 tpm: Optional[float] = None,
+                 max_retries: int = 5,
+                 base_delay: float = 1.,
+                 max_delay: float = 60.,
+                 timeout: Optional[float] = None) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+        self.limits = dict()
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        # Own generator : jitter must not consume the seeded global random stream
+        self._random = random.Random()
+        self.stats = dict(requests=0, retries=0, failures=0, timeouts=0, throttled_seconds=0.)
+
+    def set_limits(self, model: str, rpm: Optional[float] = None, tpm: Optional[float] = None) -> None:
+        """Per-model limits, ignored if the model already has buckets."""
+        with self._lock:
+            self.limits.setdefault(model, (rpm, tpm))
+
+    def _get_buckets(self, model: str):
+        with self._lock:
+            if model not in self._buckets:
+                rpm, tpm = self.limits.get(model, (None, None))
+                rpm = rpm if rpm is not None else self.rpm
+                tpm = tpm if tpm is not None else self.tpm
+                self._buckets[model] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            return self._buckets[model]
+
+    def _reserve(self, model: str, tokens: int) -> float:
+        request_bucket, token_bucket = self._get_buckets(model)
+        delay = 0.
+        if request_bucket is not None:
+            delay = max(delay, request_bucket.reserve(1))
+        if token_bucket is not None:
+            delay = max(delay, token_bucket.reserve(tokens))
+        if delay > 0:
+            self.stats['throttled_seconds'] += delay
+        return delay
+
+    def _settle(self, model: str, estimate: int, response) -> None:
+        _, token_bucket = self._get_buckets(model)
+        if token_bucket is None:
+            return
+        try:
+            usage = response['usage']
+            actual = usage['prompt_tokens'] + usage['completion_tokens']
+        except (KeyError, TypeError):
+            return
+        token_bucket.refund(estimate - actual)
+
+    def _backoff(self, attempt: int, err: Exception) -> float:
+        retry_after = None
+        headers = getattr(err, 'headers', None) or {}
+        try:
+            retry_after = float(headers.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.)
+
+    def _on_error(self, attempt: int, err: Exception) -> float:
+        if isinstance(err, (TimeoutError, asyncio.TimeoutError)):
+            self.stats['timeouts'] += 1
+        if attempt >= self.max_retries:
+            self.stats['failures'] += 1
+            raise err
+        self.stats['retries'] += 1
+        delay = self._backoff(attempt, err)
+        logger.warning(f'{type(err).__name__} : {err}. Retry {attempt + 1}/{self.max_retries} in {delay:.1f}s')
+        return delay
+
+    def call(self, create: Callable, messages: List[Dict], api_kwargs: Dict, info: Dict = None):
+        """Call ``create``, within the limits and with retries. ``info`` receives the number of retries."""
+        model = api_kwargs['model']
+        estimate = estimate_tokens(messages, api_kwargs)
+        if self.timeout is not None:
+            api_kwargs = dict(api_kwargs, request_timeout=self.timeout)
+
+        attempt = 0
+        while True:
+            delay = self._reserve(model, estimate)
+            if delay > 0:
+                time.sleep(delay)
+            self.stats['requests'] += 1
+            try:
+                response = create(messages, **api_kwargs)
+            except RETRYABLE_ERRORS as err:
+                time.sleep(self._on_error(attempt, err))
+                attempt += 1
+                continue
+            self._settle(model, estimate, response)
+            if info is not None:
+                info['retries'] = attempt
+            return response
+
+    async def acall(self, acreate: Callable, messages: List[Dict], api_kwargs: Dict, info: Dict = None):
+        model = api_kwargs['model']
+        estimate = estimate_tokens(messages, api_kwargs)
+        if self.timeout is not None:
+            api_kwargs = dict(api_kwargs, request_timeout=self.timeout)
+
+        attempt = 0
+        while True:
+            delay = self._reserve(model, estimate)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.stats['requests'] += 1
+            try:
+                response = await asyncio.wait_for(acreate(messages, **api_kwargs), self.timeout)
+            except RETRYABLE_ERRORS as err:
+                await asyncio.sleep(self._on_error(attempt, err))
+                attempt += 1
+                continue
+            self._settle(model, estimate, response)
+            if info is not None:
+                info['retries'] = attempt
+            return response
+
+    def __repr__(self) -> str:
+        stats = dict(self.stats, throttled_seconds=round(self.stats['throttled_seconds'], 2))
+        return f'RequestScheduler(rpm={self.rpm}, tpm={self.tpm}, stats={stats})'
+
+
+def add_scheduler_arguments(parser) -> None:
+    parser.add_argument('--rpm', type=float, default=None, help='Requests per minute allowed per model')
+    parser.add_argument('--tpm', type=float, default=None, help='Tokens per minute allowed per model')
+    parser.add_argument('--max_retries', type=int, default=5)
+    parser.add_argument('--request_timeout', type=float, default=None, help='Seconds before a request is retried')
+
+
+def scheduler_from_args(args, share: int = 1) -> RequestScheduler:
+    """``share`` splits the limits between that many processes drawing from the same quota."""
+    rpm = args.rpm / share if args.rpm is not None else None
+    tpm = args.tpm / share if args.tpm is not None else None
+    return RequestScheduler(rpm=rpm, tpm=tpm, max_retries=args.max_retries, timeout=args.request_timeout)
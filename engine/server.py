@@ -0,0 +1,278 @@
+import json
+import uuid
+import asyncio
+import logging
+from urllib.parse import parse_qs, urlsplit
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1 << 20
+# Seconds a client waits for new events before an empty answer
+POLL_SECONDS = 25.
+# Seconds an ended session stays listed, for its client to read the last events
+KEEP_ENDED_SECONDS = 600.
+
+
+class SessionChannel:
+    """
+    Human side of a :class:`ServerSession`, given to a `HumanAgent` : `ask` publishes the
+    turn request and waits for the reply the session's client posts, without blocking the
+    other sessions.
+    """
+
+    def __init__(self, session: 'ServerSession') -> None:
+        self.session = session
+
+    async def ask(self, messages: List[Dict]) -> str:
+        context = messages[-1]['content'] if messages else None
+        self.session.awaiting = True
+        self.session.publish('your_turn', context=context)
+        try:
+            return await self.session.inbox.get()
+        finally:
+            self.session.awaiting = False
+
+
+class ServerSession:
+    """A conversation hosted by the server, with the events its client polls."""
+
+    def __init__(self, params: Dict) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.params = params
+        self.status = 'running'
+        self.awaiting = False
+        self.events: List[Dict] = []
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Condition()
+        # The event loop only keeps weak references to tasks
+        self._notifications = set()
+
+    def publish(self, event: str, **fields) -> None:
+        """Record an event for the client; callable from the session's coroutines."""
+        self.events.append(dict(fields, seq=len(self.events), event=event))
+        task = asyncio.get_running_loop().create_task(self._notify())
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_events(self, since: int, timeout: float) -> List[Dict]:
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait_for(lambda: len(self.events) > since), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.events[since:]
+
+    def summary(self) -> Dict:
+        return dict(id=self.id, status=self.status, awaiting=self.awaiting, events=len(self.events), params=self.params)
+
+
+class SessionServer:
+    """
+    Local asyncio HTTP server hosting concurrent conversations with human participants.
+
+    ``run_session(params, channel, publish)`` runs one conversation : its human agents answer
+    through ``channel`` (see `SessionChannel`) and ``publish(event, **fields)`` shows turns to the
+    session's client. Sessions run as tasks of one event loop, so the LLM turns of every session
+    are in flight together while humans type.
+
+    JSON API : ``POST /sessions`` starts a session with the params of the body,
+    ``GET /sessions`` lists them, ``GET /sessions/<id>/events?since=<seq>`` long-polls the events
+    after ``seq``, ``POST /sessions/<id>/messages`` posts the human's ``{"text": ...}`` and
+    ``DELETE /sessions/<id>`` stops a session. ``GET /`` serves a minimal chat page.
+    ``check_params(params)`` raises ValueError to refuse a session (400) before it starts.
+    Ended sessions are forgotten after ``keep_ended`` seconds.
+    """
+
+    def __init__(self, run_session: Callable[[Dict, SessionChannel, Callable], Awaitable], max_sessions: int = None,
+                 keep_ended: float = KEEP_ENDED_SECONDS, check_params: Callable[[Dict], None] = None) -> None:
+        self.run_session = run_session
+        self.check_params = check_params
+        self.max_sessions = max_sessions
+        self.keep_ended = keep_ended
+        self.sessions: Dict[str, ServerSession] = dict()
+
+    def start(self, params: Dict) -> ServerSession:
+        if self.check_params is not None:
+            self.check_params(params)
+        running = sum(s.status == 'running' for s in self.sessions.values())
+        if self.max_sessions is not None and running >= self.max_sessions:
+            raise OverflowError(f'{running} sessions already running')
+        session = ServerSession(params)
+        self.sessions[session.id] = session
+        session.task = asyncio.get_running_loop().create_task(self._run(session))
+        logger.info(f'Session {session.id} started : {params}')
+        return session
+
+    async def _run(self, session: ServerSession) -> None:
+        try:
+            result = await self.run_session(session.params, SessionChannel(session), session.publish)
+        except asyncio.CancelledError:
+            session.status = 'stopped'
+            session.publish('stopped')
+        except Exception as err:
+            logger.exception(f'Session {session.id} failed')
+            session.status = 'failed'
+            session.publish('failed', error=repr(err))
+        else:
+            session.status = 'finished'
+            session.publish('finished', result=result)
+        finally:
+            # The task (and the traceback of a failure) references the session's field and agents
+            session.task = None
+            asyncio.get_running_loop().call_later(self.keep_ended, self.sessions.pop, session.id, None)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await read_request(reader)
+            status, payload = await self.route(method, path, body)
+        except (ValueError, json.decoder.JSONDecodeError) as err:
+            status, payload = 400, {'error': str(err)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as err:
+            logger.exception('Request failed')
+            status, payload = 500, {'error': repr(err)}
+        try:
+            await write_response(writer, status, payload)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes) -> Tuple[int, object]:
+        url = urlsplit(path)
+        parts = [p for p in url.path.split('/') if p]
+        query = parse_qs(url.query)
+
+        if method == 'GET' and not parts:
+            return 200, CHAT_PAGE
+        if parts[:1] != ['sessions']:
+            return 404, {'error': f'No route for {method} {url.path}'}
+        if len(parts) == 1:
+            if method == 'GET':
+                return 200, [s.summary() for s in self.sessions.values()]
+            if method == 'POST':
+                try:
+                    session = self.start(read_object(body))
+                except OverflowError as err:
+                    return 503, {'error': str(err)}
+                return 201, session.summary()
+            return 405, {'error': f'{method} not allowed'}
+
+        session = self.sessions.get(parts[1])
+        if session is None:
+            return 404, {'error': f'No session {parts[1]}'}
+        if len(parts) == 2:
+            if method == 'GET':
+                return 200, session.summary()
+            if method == 'DELETE':
+                if session.task is not None:
+                    session.task.cancel()
+                return 200, session.summary()
+            return 405, {'error': f'{method} not allowed'}
+        if parts[2] == 'events' and method == 'GET':
+            since = int(query.get('since', ['0'])[0])
+            wait = min(float(query.get('wait', [POLL_SECONDS])[0]), POLL_SECONDS)
+            return 200, await session.wait_events(since, wait)
+        if parts[2] == 'messages' and method == 'POST':
+            if not session.awaiting:
+                return 409, {'error': 'The session is not waiting for a message'}
+            text = read_object(body).get('text')
+            if not isinstance(text, str) or not text.strip():
+                return 400, {'error': 'A non-empty "text" is required'}
+            # A second post before the agent reads this one is refused
+            session.awaiting = False
+            await session.inbox.put(text)
+            return 202, session.summary()
+        return 405, {'error': f'{method} not allowed'}
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8000) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'Session server listening on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+def read_object(body: bytes) -> Dict:
+    payload = json.loads(body or b'{}')
+    if not isinstance(payload, dict):
+        raise ValueError('The request body must be a json object')
+    return payload
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+    request_line = (await reader.readline()).decode('latin-1').strip()
+    if not request_line:
+        raise ConnectionError('Empty request')
+    method, path, _ = request_line.split(' ', 2)
+    headers = dict()
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError(f'Request body over {MAX_BODY_BYTES} bytes')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path, body
+
+
+async def write_response(writer: asyncio.StreamWriter, status: int, payload) -> None:
+    if isinstance(payload, str):
+        body, content_type = payload.encode('utf-8'), 'text/html; charset=utf-8'
+    else:
+        body, content_type = json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json'
+    head = (f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}\r\n'
+            f'Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+
+HTTP_REASONS = {200: 'OK', 201: 'Created', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 409: 'Conflict', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+CHAT_PAGE = '''<!doctype html>
+<html><head><meta charset="utf-8"><title>Session</title>
+<style>body{font-family:sans-serif;max-width:50em;margin:2em auto}#log p{margin:.4em 0}
+#partial{color:#888}textarea{width:100%}</style></head>
+<body><h3>Session <span id="sid"></span> <small id="status"></small></h3>
+<div id="log"></div><p id="partial"></p>
+<textarea id="text" rows="3" disabled></textarea><button id="send" disabled>Send</button>
+<script>
+const params = Object.fromEntries(new URLSearchParams(location.search));
+let sid = params.session, since = 0;
+const $ = id => document.getElementById(id);
+function line(who, text) { const p = document.createElement('p'); p.innerHTML = '<b></b> '; p.firstChild.textContent = who + ':'; p.append(text); $('log').append(p); }
+async function poll() {
+  while (true) {
+    const events = await (await fetch(`/sessions/${sid}/events?since=${since}`)).json();
+    for (const e of events) {
+      since = e.seq + 1;
+      if (e.event === 'turn') { $('partial').textContent = ''; line(e.agent, e.utterance); }
+      else if (e.event === 'partial') $('partial').textContent = e.text;
+      else if (e.event === 'your_turn') { $('text').disabled = $('send').disabled = false; $('text').focus(); }
+      else if (['finished', 'failed', 'stopped'].includes(e.event)) { $('status').textContent = e.event; return; }
+    }
+  }
+}
+$('send').onclick = async () => {
+  $('text').disabled = $('send').disabled = true;
+  await fetch(`/sessions/${sid}/messages`, {method: 'POST', body: JSON.stringify({text: $('text').value})});
+  $('text').value = '';
+};
+(async () => {
+  if (!sid) { sid = (await (await fetch('/sessions', {method: 'POST', body: JSON.stringify(params)})).json()).id;
+              history.replaceState(null, '', `?session=${sid}`); }
+  $('sid').textContent = sid; poll();
+})();
+</script></body></html>
+'''
@@ -1,29 +1,222 @@
 import logging
-from typing import List, Dict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
 
 
 logger = logging.getLogger(__name__)
 
 
+class SpaceSnapshot(Mapping):
+    """Read-only view of the variables of a :class:`Space` at a given version."""
+    __slots__ = ('version', '_values')
+
+    def __init__(self, version: int, values: Dict) -> None:
+        self.version = version
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def to_dict(self) -> Dict:
+        return dict(self._values)
+
+
+class Var:
+    """Declared variable of a :class:`Space` : the type its values are coerced to, its default and the agents reading it."""
+    __slots__ = ('name', 'type', 'default', 'readers')
+
+    def __init__(self, name: str, type: type = None, default: Any = '', readers: Iterable[str] = ()) -> None:
+        self.name = name
+        self.type = type
+        self.default = default
+        self.readers = tuple(readers)
+
+    def coerce(self, value):
+        if self.type is None or value is None or isinstance(value, self.type):
+            return value
+        try:
+            return self.type(value)
+        except (TypeError, ValueError):
+            logger.warning('%s expects %s, got %r : kept as is', self.name, self.type.__name__, value)
+            return value
+
+    def __repr__(self) -> str:
+        return f'Var({self.name!r}, type={getattr(self.type, "__name__", None)}, default={self.default!r}, readers={self.readers})'
+
+
 class Space:
-    def __init__(self, scope: List[str]) -> None:
-        self.variables = {k:'' for k in scope}
+    """
+    Variables shared by the agents of a conversation.
+
+    ``scope`` declares the variables, by name or as :class:`Var` (type, default, readers);
+    ``readers`` maps agent names to the variables their prompts read (see `Field.get_agent_readers`).
+    Every effective write increments `version` and records the version of the variable
+    (`version_of`), so that consumers can tell which variables changed since a version
+    (`changed_since`) or be called back on the writes of given variables (`subscribe`).
+    `sync` only writes declared variables; other keys (e.g. extra keys of a model's json
+    response) are kept in `unknown`.
+    """
+
+    def __init__(self, scope: Iterable[Union[str, Var]], readers: Dict[str, Iterable[str]] = None) -> None:
+        self.schema: Dict[str, Var] = dict()
+        for var in scope:
+            var = var if isinstance(var, Var) else Var(var)
+            self.schema.setdefault(var.name, var)
+        for agent_name, names in (readers or {}).items():
+            for name in names:
+                var = self.schema.get(name) or Var(name)
+                if agent_name not in var.readers:
+                    # Copied, the declared Var may be shared with other spaces
+                    var = Var(var.name, var.type, var.default, var.readers + (agent_name,))
+                self.schema[name] = var
+        self.variables = {name: var.default for name, var in self.schema.items()}
+
+        # Incremented by every effective write; self.changes[v-1-self._base] is the name written at version v
+        self.version = 0
+        self.changes = []
+        # Version of the last write of each variable, absent if never written
+        self.versions: Dict[str, int] = dict()
+        # Last value of every undeclared key passed to sync
+        self.unknown: Dict[str, Any] = dict()
+        # Callbacks per variable name, None for every variable
+        self._subscribers: Dict[Optional[str], List[Callable]] = dict()
+        # True while self.variables is referenced by a snapshot, the next write copies it
+        self._shared = False
+        # Versions up to _base were written in the space this one was forked from
+        self._parent = None
+        self._base = 0
 
     def __getitem__(self, idx):
         return self.variables[idx]
     
     def __setitem__(self, key, value):
+        var = self.schema.get(key)
+        if var is not None and var.type is not None:
+            value = var.coerce(value)
+        if key in self.variables:
+            old = self.variables[key]
+            if old is value or (type(old) is type(value) and old == value):
+                return
+        if self._shared:
+            self.variables = dict(self.variables)
+            self.versions = dict(self.versions)
+            self._shared = False
         self.variables[key] = value
+        self.version += 1
+        self.versions[key] = self.version
+        self.changes.append(key)
+        if self._subscribers:
+            for callback in self._subscribers.get(key, []) + self._subscribers.get(None, []):
+                callback(key, value, self.version)
+
+    def version_of(self, name: str) -> int:
+        """Version of the last write of ``name``, 0 if it still holds its default."""
+        return self.versions.get(name, 0)
+
+    def changed_since(self, version: int, names: Iterable[str] = None) -> Dict:
+        """Current values of the variables (among ``names``) written after ``version``."""
+        names = self.versions if names is None else names
+        return {name: self.variables[name] for name in names if self.versions.get(name, 0) > version}
+
+    def subscribe(self, callback: Callable[[str, Any, int], None], names: Iterable[str] = None) -> Callable[[], None]:
+        """
+        Call ``callback(name, value, version)`` after every effective write of ``names`` (every
+        variable if None). Returns the function removing the subscription. Forks do not inherit it.
+        """
+        keys = [None] if names is None else list(names)
+        for key in keys:
+            # Lists are replaced, not mutated, so a callback may unsubscribe during a notification
+            self._subscribers[key] = self._subscribers.get(key, []) + [callback]
+
+        def unsubscribe() -> None:
+            for key in keys:
+                remaining = [cb for cb in self._subscribers.get(key, []) if cb is not callback]
+                if remaining:
+                    self._subscribers[key] = remaining
+                else:
+                    self._subscribers.pop(key, None)
+        return unsubscribe
+
+    def read_by(self, agent_name: str) -> List[str]:
+        """Declared variables read by ``agent_name``."""
+        return [name for name, var in self.schema.items() if agent_name in var.readers]
+
+    def snapshot(self) -> SpaceSnapshot:
+        """Copy-on-write snapshot : O(1) now, one shallow dict copy at the next write."""
+        self._shared = True
+        return SpaceSnapshot(self.version, self.variables)
+
+    def fork(self) -> 'Space':
+        """
+        Independent space starting from the current values, in O(1) : the variables are
+        shared copy-on-write and the change log of this space is read up to the fork.
+        """
+        child = self.__class__.__new__(self.__class__)
+        child.__dict__.update(self.__dict__)
+        self._shared = True
+        child._shared = True
+        child.changes = []
+        child.unknown = dict(self.unknown)
+        child._subscribers = dict()
+        child._parent = self
+        child._base = self.version
+        return child
+
+    def _written(self, since: int, until: int) -> List[str]:
+        """Names written at versions (since, until], following the spaces this one was forked from."""
+        names = []
+        if since < self._base and self._parent is None:
+            # Restored from a checkpoint : the order of the writes before it is not kept
+            names = [name for name, version in self.versions.items() if since < version <= min(until, self._base)]
+        elif since < self._base:
+            names = self._parent._written(since, min(until, self._base))
+        return names + self.changes[max(since - self._base, 0):max(until - self._base, 0)]
+
+    def delta(self, previous: Optional[SpaceSnapshot], current: SpaceSnapshot) -> Dict:
+        """Variables written between two snapshots of this space, with their values in ``current``."""
+        since = previous.version if previous is not None else 0
+        if since == 0:
+            return current.to_dict()
+        names = dict.fromkeys(self._written(since, current.version))
+        return {name: current[name] for name in names if name in current}
+
+    def state_dict(self) -> Dict:
+        """Values and versions of the variables; the change log is not kept, see `_written`."""
+        return {'variables': dict(self.variables), 'version': self.version, 'versions': dict(self.versions),
+                'unknown': dict(self.unknown)}
+
+    def load_state_dict(self, state: Dict) -> None:
+        self.variables = dict(state['variables'])
+        self.version = state['version']
+        self.versions = dict(state['versions'])
+        self.unknown = dict(state.get('unknown', {}))
+        self.changes = []
+        self._shared = False
+        self._parent = None
+        self._base = self.version
 
     def sync(self, new_vals: Dict):
-        for var_name in self.names:
-            if var_name in new_vals.keys():
-                logger.debug(f'Update {var_name} : {self[var_name]} --> {new_vals[var_name]}')
-                self[var_name] = new_vals[var_name]
+        """Write the declared variables of ``new_vals``, in O(len(new_vals)); other keys go to `unknown`."""
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for var_name, value in new_vals.items():
+            if var_name not in self.variables:
+                if var_name not in self.unknown:
+                    logger.info('Undeclared variable %s kept apart', var_name)
+                self.unknown[var_name] = value
+                continue
+            if debug:
+                logger.debug('Update %s : %s --> %s', var_name, self.variables[var_name], value)
+            self[var_name] = value
 
     @property
     def names(self):
-        return list(self.variables.keys())
+        return self.variables.keys()
 
     @property
     def values(self):
@@ -36,8 +229,6 @@ class Space:
                 res += f'{k}:{v}\n'
         return res
 
-class DiagnosisSpace(Space):
-    def __init__(self, keys) -> None:
-        super().__init__(keys)
-        for key in keys:
-            self.variables[key] = ""
\ No newline at end of file
+
+# Kept for the code importing it, a Space with the same constructor
+DiagnosisSpace = Space
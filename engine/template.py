@@ -0,0 +1,45 @@
+from string import Formatter
+from typing import Iterable, Mapping
+
+_MISSING = object()
+
+
+class PromptTemplate:
+    """
+    A prompt format string parsed once.
+
+    ``fields`` lists the variables the template needs; ``render`` only looks those up and
+    returns the previous rendering when none of them changed since the last call.
+    """
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        self.fields = tuple(dict.fromkeys(i[1] for i in Formatter().parse(template) if i[1] is not None))
+
+        # (inputs, rendered) of the last call, replaced as one tuple : threads rendering the
+        # template shared by forked agents never pair the inputs of one with the text of another
+        self._last = None
+
+    def missing(self, scope: Iterable[str]):
+        scope = set(scope)
+        return [field for field in self.fields if field not in scope]
+
+    def validate(self, scope: Iterable[str]) -> None:
+        missing = self.missing(scope)
+        if missing:
+            raise KeyError(f'{missing} required by the prompt are not in the space')
+
+    def render(self, values: Mapping) -> str:
+        inputs = tuple(values.get(field, _MISSING) for field in self.fields)
+        last = self._last
+        if last is not None and inputs == last[0]:
+            return last[1]
+
+        kwargs = {field: value for field, value in zip(self.fields, inputs) if value is not _MISSING}
+        rendered = self.template.format(**kwargs)
+
+        self._last = (inputs, rendered)
+        return rendered
+
+    def __str__(self) -> str:
+        return self.template
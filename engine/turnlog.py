@@ -0,0 +1,142 @@
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional
+
+
+class Turn:
+    """A single utterance recorded in a :class:`TurnLog`."""
+    __slots__ = ('time', 'agent_name', 'utterance')
+
+    def __init__(self, time: int, agent_name: str, utterance: str) -> None:
+        self.time = time
+        self.agent_name = agent_name
+        self.utterance = utterance
+
+    def __iter__(self):
+        # Allows ``agent_name, utterance = turn``
+        yield self.agent_name
+        yield self.utterance
+
+    def __repr__(self) -> str:
+        return f'Turn(time={self.time}, agent_name={self.agent_name!r}, utterance={self.utterance!r})'
+
+
+class TurnLog:
+    """
+    Append-only conversation log stored as parallel arrays.
+
+    Turn numbers and speaker ids live in typed arrays, speaker names are interned
+    once and utterances are kept in a plain list, so appending a turn never
+    reallocates the rest of the log.
+
+    `fork` returns a log sharing the first turns with this one : the fork only stores
+    the turns appended to it and reads the shared prefix from its ``parent``, which
+    may keep growing independently.
+    """
+
+    def __init__(self, parent: Optional['TurnLog'] = None) -> None:
+        self.times = array('q')
+        self.speaker_ids = array('l')
+        self.utterances: List[str] = []
+
+        self.speakers: List[str] = []
+        self._speaker_index = dict()
+
+        # Turns [0, base) are read from the parent
+        self.parent = parent
+        self.base = len(parent) if parent is not None else 0
+        self.last_time = parent.last_time if parent is not None else 0
+
+    def fork(self) -> 'TurnLog':
+        return TurnLog(parent=self)
+
+    def intern(self, agent_name: str) -> int:
+        speaker_id = self._speaker_index.get(agent_name)
+        if speaker_id is None:
+            speaker_id = len(self.speakers)
+            self._speaker_index[agent_name] = speaker_id
+            self.speakers.append(agent_name)
+        return speaker_id
+
+    def append(self, time: int, agent_name: str, utterance: str) -> None:
+        if time <= self.last_time:
+            raise ValueError(f'Turn {time} is not after the last turn {self.last_time}')
+        self.last_time = time
+        self.times.append(time)
+        self.speaker_ids.append(self.intern(agent_name))
+        self.utterances.append(utterance)
+
+    def validate(self) -> None:
+        """Full O(n) consistency check of the log, meant for debugging only."""
+        assert len(self.times) == len(self.speaker_ids) == len(self.utterances)
+        times = [turn.time for turn in self]
+        for prev, cur in zip(times, times[1:]):
+            assert prev < cur, f'Turn numbers are not increasing : {prev} -> {cur}'
+        assert all(0 <= i < len(self.speakers) for i in self.speaker_ids)
+        assert self.last_time == (times[-1] if times else 0)
+
+    def __len__(self) -> int:
+        return self.base + len(self.utterances)
+
+    def __getitem__(self, pos: int) -> Turn:
+        if pos < 0:
+            pos += len(self)
+            if pos < 0:
+                raise IndexError('TurnLog index out of range')
+        if pos < self.base:
+            return self.parent[pos]
+        pos -= self.base
+        return Turn(self.times[pos], self.speakers[self.speaker_ids[pos]], self.utterances[pos])
+
+    def position(self, time: int) -> int:
+        """Position of the turn numbered ``time``, KeyError if there is none."""
+        if self.base and time <= self.parent[self.base - 1].time:
+            return self.parent.position(time)
+        pos = bisect_left(self.times, time)
+        if pos == len(self.times) or self.times[pos] != time:
+            raise KeyError(time)
+        return self.base + pos
+
+    def __iter__(self) -> Iterator[Turn]:
+        for pos in range(len(self)):
+            yield self[pos]
+
+    def tail(self, n: int) -> Iterator[Turn]:
+        """Iterate over the last ``n`` turns in chronological order."""
+        for pos in range(max(len(self) - n, 0), len(self)):
+            yield self[pos]
+
+    def state_dict(self) -> Dict:
+        """Flat state, forks included : `from_state_dict` restores a log without parent."""
+        if self.parent is not None:
+            flat = TurnLog()
+            for turn in self:
+                flat.append(turn.time, turn.agent_name, turn.utterance)
+            return flat.state_dict()
+        return {
+            'times': self.times.tolist(),
+            'speakers': list(self.speakers),
+            'speaker_ids': self.speaker_ids.tolist(),
+            'utterances': list(self.utterances),
+        }
+
+    @classmethod
+    def from_state_dict(cls, state: Dict) -> 'TurnLog':
+        log = cls()
+        for time, speaker_id, utterance in zip(state['times'], state['speaker_ids'], state['utterances']):
+            log.append(time, state['speakers'][speaker_id], utterance)
+        return log
+
+    def to_dataframe(self, primary_key_format: str = 'STEP:{time}'):
+        """
+        Export the log in the legacy ``Field.dialog`` layout: one row per turn
+        indexed by primary key and one column per speaker.
+        """
+        import pandas as pd
+
+        turns = list(self)
+        index = [primary_key_format.format(time=turn.time) for turn in turns]
+        columns = {turn.agent_name: [None]*len(turns) for turn in turns}
+        for pos, turn in enumerate(turns):
+            columns[turn.agent_name][pos] = turn.utterance
+        return pd.DataFrame(columns, index=index)
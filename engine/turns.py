@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Sequence, Union
+
+from engine.space import Space
+
+logger = logging.getLogger(__name__)
+
+
+class TurnPolicy:
+    """
+    Decides which agent of a :class:`engine.field.Field` speaks next, by agent id.
+
+    `speculate` is called when agent ``speaker_id`` starts its turn, so that a policy
+    needing a request of its own (see `RouterPolicy`) can issue it concurrently.
+    """
+
+    def next_speaker(self, field, var_space: Space) -> int:
+        raise NotImplementedError()
+
+    async def anext_speaker(self, field, var_space: Space) -> int:
+        return self.next_speaker(field, var_space)
+
+    def speculate(self, field, var_space: Space, speaker_id: int) -> None:
+        pass
+
+    async def aspeculate(self, field, var_space: Space, speaker_id: int) -> None:
+        self.speculate(field, var_space, speaker_id)
+
+
+class FixedPolicy(TurnPolicy):
+    def __init__(self, agent_id: int) -> None:
+        self.agent_id = agent_id
+
+    def next_speaker(self, field, var_space: Space) -> int:
+        return self.agent_id
+
+
+class RoundRobinPolicy(TurnPolicy):
+    """Agents of ``order`` speak in turn; after a speaker outside of it, ``order[0]`` starts."""
+
+    def __init__(self, order: Sequence[int]) -> None:
+        assert len(order) > 0, 'RoundRobinPolicy needs at least one agent'
+        self.order = list(order)
+        self._position = {agent_id: pos for pos, agent_id in enumerate(self.order)}
+
+    def next_speaker(self, field, var_space: Space) -> int:
+        pos = self._position.get(field.last_speaker_id())
+        return self.order[0] if pos is None else self.order[(pos + 1) % len(self.order)]
+
+
+class RulePolicy(TurnPolicy):
+    """
+    Next speaker chosen from the last one : ``rules`` maps a speaker id to the next
+    agent id, or to the policy choosing it. Speakers without a rule (including
+    utterances of non-agents) are followed by ``default``.
+    """
+
+    def __init__(self, rules: Dict[int, Union[int, TurnPolicy]], default: Union[int, TurnPolicy]) -> None:
+        self.rules = {k: v if isinstance(v, TurnPolicy) else FixedPolicy(v) for k, v in rules.items()}
+        self.default = default if isinstance(default, TurnPolicy) else FixedPolicy(default)
+
+    def policy_after(self, speaker_id: Optional[int]) -> TurnPolicy:
+        return self.rules.get(speaker_id, self.default)
+
+    def next_speaker(self, field, var_space: Space) -> int:
+        return self.policy_after(field.last_speaker_id()).next_speaker(field, var_space)
+
+    async def anext_speaker(self, field, var_space: Space) -> int:
+        return await self.policy_after(field.last_speaker_id()).anext_speaker(field, var_space)
+
+    def speculate(self, field, var_space: Space, speaker_id: int) -> None:
+        self.policy_after(speaker_id).speculate(field, var_space, speaker_id)
+
+    async def aspeculate(self, field, var_space: Space, speaker_id: int) -> None:
+        await self.policy_after(speaker_id).aspeculate(field, var_space, speaker_id)
+
+
+class RouterPolicy(TurnPolicy):
+    """
+    A router agent picks the next speaker among ``candidates``.
+
+    The router answers ``{key: label}`` where the label is an agent name or the prompt
+    key of an agent (see `Field.get_agent_with_key`); an unknown label falls back to the
+    first candidate. With ``speculative``, the router request is built when the previous
+    agent starts its turn and sent alongside it, saving one serial round-trip per turn;
+    the router then decides without the utterance being generated.
+    """
+
+    def __init__(self,
+                 router_name: str,
+                 candidates: Sequence[int],
+                 key: str = 'Therapist',
+                 message_len: int = 8,
+                 speculative: bool = False,
+                 decode: Callable = None) -> None:
+        self.router_name = router_name
+        self.candidates = list(candidates)
+        self.key = key
+        self.message_len = message_len
+        self.speculative = speculative
+        self.decode = decode
+        self.stats = dict(requests=0, speculated=0, fallbacks=0)
+
+        self._pending = None
+        self._executor = None
+
+    def resolve(self, field, response) -> int:
+        label = self.decode(response) if self.decode is not None else response.get(self.key)
+        agent_id = field.agent_id(label)
+        if agent_id is None:
+            agent_name = dict(field.key_agents).get(label)
+            agent_id = field.agent_id(agent_name)
+        if agent_id not in self.candidates:
+            logger.warning(f'Router chose {label!r}, not one of the candidates : falls back to the first one')
+            self.stats['fallbacks'] += 1
+            agent_id = self.candidates[0]
+        return agent_id
+
+    def _build(self, field, var_space: Space):
+        self.stats['requests'] += 1
+        agent, msgs, _ = field.build_request(self.router_name, var_space, self.message_len)
+        return agent, msgs
+
+    def next_speaker(self, field, var_space: Space) -> int:
+        pending, self._pending = self._pending, None
+        if isinstance(pending, Future):
+            response, _ = pending.result()
+        else:
+            agent, msgs = self._build(field, var_space)
+            response, _ = field.complete(self.router_name, agent, msgs)
+        return self.resolve(field, response)
+
+    async def anext_speaker(self, field, var_space: Space) -> int:
+        pending, self._pending = self._pending, None
+        if isinstance(pending, asyncio.Task):
+            response, _ = await pending
+        else:
+            agent, msgs = self._build(field, var_space)
+            response, _ = await field.acomplete(self.router_name, agent, msgs)
+        return self.resolve(field, response)
+
+    def speculate(self, field, var_space: Space, speaker_id: int) -> None:
+        if not self.speculative or self._pending is not None:
+            return
+        # Messages are built now, on the caller's thread : the worker only waits on the API
+        agent, msgs = self._build(field, var_space)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='router')
+        self._pending = self._executor.submit(field.complete, self.router_name, agent, msgs)
+        self.stats['speculated'] += 1
+
+    async def aspeculate(self, field, var_space: Space, speaker_id: int) -> None:
+        if not self.speculative or self._pending is not None:
+            return
+        agent, msgs = self._build(field, var_space)
+        self._pending = asyncio.create_task(field.acomplete(self.router_name, agent, msgs))
+        self.stats['speculated'] += 1
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
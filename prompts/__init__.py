@@ -1,13 +1,6 @@
-import yaml
-import glob
 from pathlib import Path
 
-prompt_dict = {}
-for file in Path("prompts").glob("*.yml"):
-    fname = file.stem
-    try:
-        prompt_dict[fname] = yaml.load(open(file, encoding='utf-8'), Loader=yaml.FullLoader)
-    except yaml.scanner.ScannerError as e:
-        print("Error with ", file)
+from src.registry import YamlRegistry
 
-print(f'prompt_dict:\n{prompt_dict.keys()}')
+# Prompt scripts are parsed on first access, see YamlRegistry
+prompt_dict = YamlRegistry(Path(__file__).parent)
@@ -22,27 +22,38 @@ scenario described in the configuration file.
 from __future__ import annotations
 
 import argparse
-import json
+import asyncio
 import logging
 import os
+import time
 from tqdm import tqdm
 from pathlib import Path
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Union
 
 import openai
-import pandas as pd
 import yaml
 
+from engine.cache import ResponseCache, add_cache_arguments, cache_from_args
+from engine.context import ContextBuilder, add_context_arguments, context_from_args
+from engine.artifacts import ArtifactSink, iter_artifacts
+from engine.checkpoint import CheckpointLog
 from engine.field import Field
-from engine.space import Space
+from engine.instrument import EVENTS_FNAME, Instrument, JsonlSink, add_instrument_arguments
+from engine.parsing import repair_json
+from engine.provider import Provider, add_provider_arguments, provider_from_args
+from engine.results import ResultsStore, add_results_arguments, results_from_args
+from engine.scheduler import RequestScheduler, add_scheduler_arguments, scheduler_from_args
+from engine.space import Space, Var
+from engine.turns import RoundRobinPolicy
 
 
 LOGGER = logging.getLogger(__name__)
+UTTERANCE_KEYS = ("patient_utterance", "physician_utterance")
 
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Run clinical communication simulations")
-    parser.add_argument("--openai_api_key", required=True, type=str, help="OpenAI API key")
+    parser.add_argument("--openai_api_key", default=None, type=str, help="OpenAI API key")
     parser.add_argument(
         "--config",
         required=True,
@@ -73,7 +84,32 @@ def parse_args() -> argparse.Namespace:
         type=int,
         help="Override the number of previous turns shared with the agent prompts",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--concurrency",
+        default=1,
+        type=int,
+        help="Maximum number of scenarios running at the same time",
+    )
+    parser.add_argument(
+        "--compress_artifacts",
+        action="store_true",
+        help="Gzip the artifacts of each scenario once it is finished",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue each scenario from its last checkpointed turn",
+    )
+    add_cache_arguments(parser)
+    add_provider_arguments(parser)
+    add_context_arguments(parser)
+    add_scheduler_arguments(parser)
+    add_instrument_arguments(parser)
+    add_results_arguments(parser)
+    args = parser.parse_args()
+    if args.provider == "openai" and args.openai_api_key is None:
+        parser.error("--openai_api_key is required by the openai provider")
+    return args
 
 
 def load_config(config_path: str) -> Dict:
@@ -87,7 +123,7 @@ def ensure_directory(path: str | Path) -> Path:
     return directory
 
 
-def _collect_space_variables(base_context: Dict[str, str], agent_inputs: Iterable[List[str]]) -> List[str]:
+def _collect_space_variables(base_context: Dict[str, str], agent_inputs: Iterable[List[str]]) -> List[Union[str, Var]]:
     """Collect the full set of variable names required by the prompts.
 
     Parameters
@@ -100,7 +136,8 @@ def _collect_space_variables(base_context: Dict[str, str], agent_inputs: Iterabl
     Returns
     -------
     list
-        A unique list of variable names to initialise the shared Space.
+        A unique list of variables to initialise the shared Space, the scenario context
+        declared as string :class:`Var`.
     """
 
     variables = set(base_context.keys())
@@ -117,7 +154,7 @@ def _collect_space_variables(base_context: Dict[str, str], agent_inputs: Iterabl
     )
     for inputs in agent_inputs:
         variables.update(inputs)
-    return sorted(variables)
+    return [Var(name, str) if name in base_context else name for name in sorted(variables)]
 
 
 def _normalise_objectives(values: Iterable[str]) -> str:
@@ -150,134 +187,320 @@ def _prepare_base_context(config: Dict, scenario: Dict) -> Dict[str, str]:
     return cleaned_context
 
 
+def _turn_record(turn: int, speaker: str, utterance: str, response_payload: Dict, response_info: Dict) -> Dict:
+    """Row of ``turns.csv`` and of the results dataset."""
+    return {
+        "turn": turn,
+        "speaker": speaker,
+        "utterance": utterance,
+        **{k: v for k, v in response_payload.items() if k not in UTTERANCE_KEYS},
+        **response_info,
+    }
+
+
+def _write_artifacts(sink: ArtifactSink, record: Dict, artifact: Dict, debug_payload: Dict) -> None:
+    """Store the prompts and messages of a turn in the blobs and append its artifact and row."""
+    artifact.update(
+        system_prompt_ref=sink.blob(debug_payload["system_prompt"]),
+        user_prompt_ref=sink.blob(debug_payload["user_prompt"]),
+        request_message_refs=[
+            {"role": m["role"], "ref": sink.blob(m["content"])} for m in debug_payload["messages"]
+        ],
+    )
+    sink.write_turn(record, artifact)
+
+
 def _load_response(response):
     if isinstance(response, dict):
         return response
     if isinstance(response, str):
-        return json.loads(response)
+        payload, _ = repair_json(response)
+        return payload
     raise TypeError(f"Unexpected response type: {type(response)}")
 
 
-def run_scenario(
+async def arun_scenario(
     config: Dict,
     scenario: Dict,
     output_dir: Path,
     turn_limit: int,
     memory_turns: int,
-) -> None:
+    cache: ResponseCache | None = None,
+    provider: Provider | None = None,
+    context: ContextBuilder | None = None,
+    compress_artifacts: bool = False,
+    resume: bool = False,
+    scheduler: RequestScheduler | None = None,
+    record_events: bool = False,
+    results: ResultsStore | None = None,
+) -> Dict:
+    """Run a single scenario, awaiting every LLM request.
+
+    With ``record_events``, the timing spans of every turn and the token counts of
+    every request are appended to ``events.jsonl`` in the scenario directory. With
+    ``results``, the turn rows of the finished scenario are written to that dataset.
+
+    Returns
+    -------
+    dict
+        Timing summary of the scenario: wall-clock seconds and the summed time
+        spent waiting on LLM requests.
+    """
+    scenario_start = time.perf_counter()
+    llm_latency = 0.0
+
     roles = config["roles"]
     patient_agent_name = roles.get("patient_agent_name", "Patient")
     physician_agent_name = roles.get("physician_agent_name", "Physician")
 
-    field = Field()
-    field.add_agent(patient_agent_name, roles["patient_prompt"])
-    field.add_agent(physician_agent_name, roles["physician_prompt"])
+    scenario_dir = ensure_directory(output_dir / scenario["id"])
+    instrument = Instrument(scenario=scenario["id"])
+    if record_events:
+        instrument = Instrument(JsonlSink(scenario_dir / EVENTS_FNAME), scenario=scenario["id"])
+
+    field = Field(cache=cache, provider=provider, context=context, scheduler=scheduler, instrument=instrument)
+    patient_id = field.add_agent(patient_agent_name, roles["patient_prompt"])
+    physician_id = field.add_agent(physician_agent_name, roles["physician_prompt"])
+    # The physician opens, then both agents alternate
+    turn_policy = RoundRobinPolicy([patient_id, physician_id])
 
     base_context = _prepare_base_context(config, scenario)
 
     space_vars = _collect_space_variables(base_context, field.get_agent_inputs())
-    diagnosis_space = Space(scope=space_vars)
+    diagnosis_space = Space(scope=space_vars, readers=field.get_agent_readers())
     diagnosis_space.sync(base_context)
 
-    initial_message = scenario["initial_physician_message"].strip()
-    field.add_chat(physician_agent_name, initial_message)
-    diagnosis_space["last_physician_message"] = initial_message
-
-    scenario_dir = ensure_directory(output_dir / scenario["id"])
-    artifact_dir = ensure_directory(scenario_dir / "artifacts")
-    artifact_index: List[Dict[str, str]] = []
-
-    transcript_records: List[Dict] = []
-
-    for turn_idx in tqdm(range(1, turn_limit + 1)):
-        last_agent, last_utterance = field.get_last_chat()
-        if last_agent == physician_agent_name:
-            diagnosis_space["last_physician_message"] = last_utterance
-            next_agent = patient_agent_name
-        else:
-            diagnosis_space["last_patient_message"] = last_utterance
-            next_agent = physician_agent_name
-
-        response, response_info, debug_payload = field.run(
-            agent_name=next_agent,
-            var_space=diagnosis_space,
-            message_len=memory_turns,
-            capture_debug=True,
-        )
-        response_payload = _load_response(response)
-
-        if next_agent == patient_agent_name:
-            utterance_key = "patient_utterance"
-            diagnosis_space["last_patient_message"] = response_payload.get(utterance_key, "")
-        else:
-            utterance_key = "physician_utterance"
-            diagnosis_space["last_physician_message"] = response_payload.get(utterance_key, "")
-
-        utterance = response_payload.get(utterance_key)
-        if utterance is None:
-            raise KeyError(
-                f"The response from {next_agent} did not contain the expected key '{utterance_key}'."
-            )
-
-        field.add_chat(next_agent, utterance)
-        diagnosis_space.sync(response_payload)
-
-        record = {
-            "turn": turn_idx,
-            "speaker": next_agent,
-            "utterance": utterance,
-            **{k: v for k, v in response_payload.items() if k != utterance_key},
-            **response_info,
-        }
-        transcript_records.append(record)
-
-        turn_key = f"turn_{turn_idx:02d}_{next_agent.lower()}"
-        artifact_payload = {
-            "turn": turn_idx,
-            "speaker": next_agent,
-            "utterance": utterance,
-            "space_variables": debug_payload.get("space_values", {}),
-            "system_prompt": debug_payload.get("system_prompt"),
-            "user_prompt": debug_payload.get("user_prompt"),
-            "request_messages": debug_payload.get("messages", []),
-            "response_payload": response_payload,
-            "response_info": response_info,
+    checkpoint = CheckpointLog(scenario_dir)
+    restored = checkpoint.load() if resume else None
+
+    if restored is not None and restored[0]["completed"]:
+        LOGGER.info("Scenario '%s' already completed in %s, skipped", scenario["id"], scenario_dir)
+        instrument.close()
+        return {
+            "scenario_id": scenario["id"],
+            "turns": 0,
+            "wall_clock": 0.0,
+            "llm_latency": 0.0,
+            "parse_stats": field.get_parse_stats(),
         }
 
-        artifact_path = artifact_dir / f"{turn_key}.json"
-        with artifact_path.open("w", encoding="utf-8") as fh:
-            json.dump(artifact_payload, fh, ensure_ascii=False, indent=2)
-
-        artifact_index.append(
-            {
-                "turn": turn_idx,
-                "speaker": next_agent,
-                "key": turn_key,
-                "path": str(artifact_path.relative_to(scenario_dir)),
-            }
-        )
+    if restored is None:
+        initial_message = scenario["initial_physician_message"].strip()
+        field.add_chat(physician_agent_name, initial_message)
+        diagnosis_space["last_physician_message"] = initial_message
+        last_turn = 0
+    else:
+        header, entries = restored
+        CheckpointLog.restore(field, diagnosis_space, entries)
+        last_turn = header["turn"]
+    checkpoint.open(field, diagnosis_space)
+
+    sink = ArtifactSink(
+        scenario_dir,
+        compress=compress_artifacts,
+        resume_turn=last_turn if restored is not None else None,
+    )
+    previous_snapshot = None
+
+    for turn_idx in tqdm(
+        range(last_turn + 1, turn_limit + 1),
+        desc=scenario["id"],
+        initial=last_turn,
+        total=turn_limit,
+    ):
+        with instrument.span("turn", turn=turn_idx) as turn_span:
+            _, last_utterance = field.get_last_chat()
+            next_id = await turn_policy.anext_speaker(field, diagnosis_space)
+            next_agent = field.agent_names[next_id]
+            if next_id == patient_id:
+                diagnosis_space["last_physician_message"] = last_utterance
+            else:
+                diagnosis_space["last_patient_message"] = last_utterance
+            turn_span["agent"] = next_agent
+
+            request_start = time.perf_counter()
+            response, response_info, debug_payload = await field.arun(
+                agent_name=next_agent,
+                var_space=diagnosis_space,
+                message_len=memory_turns,
+                capture_debug=True,
+            )
+            llm_latency += time.perf_counter() - request_start
+            response_payload = _load_response(response)
+
+            if next_id == patient_id:
+                utterance_key = "patient_utterance"
+                diagnosis_space["last_patient_message"] = response_payload.get(utterance_key, "")
+            else:
+                utterance_key = "physician_utterance"
+                diagnosis_space["last_physician_message"] = response_payload.get(utterance_key, "")
+
+            utterance = response_payload.get(utterance_key)
+            if utterance is None:
+                raise KeyError(
+                    f"The response from {next_agent} did not contain the expected key '{utterance_key}'."
+                )
+
+            field.add_chat(next_agent, utterance)
+            diagnosis_space.sync(response_payload)
+
+            record = _turn_record(turn_idx, next_agent, utterance, response_payload, response_info)
+            with instrument.span("artifacts", agent=next_agent):
+                # Only the variables written since the previous turn are stored, prompts and
+                # messages are referenced by the hash of their content in blobs.jsonl
+                space_snapshot = debug_payload["space_values"]
+                artifact_payload = {
+                    "turn": turn_idx,
+                    "speaker": next_agent,
+                    "utterance": utterance,
+                    "space_version": space_snapshot.version,
+                    "space_delta": diagnosis_space.delta(previous_snapshot, space_snapshot),
+                    # Hashes filled in by _write_artifacts
+                    "system_prompt_ref": None,
+                    "user_prompt_ref": None,
+                    "request_message_refs": None,
+                    "response_payload": response_payload,
+                    "response_info": response_info,
+                }
+                # File writes run in a worker thread, the other scenarios keep running meanwhile
+                await asyncio.to_thread(_write_artifacts, sink, record, artifact_payload, debug_payload)
+                previous_snapshot = space_snapshot
+
+            with instrument.span("checkpoint", agent=next_agent):
+                # The field and the space are not written until the commit returns
+                await asyncio.to_thread(checkpoint.commit, {"turn": turn_idx, "completed": False})
 
     transcript_path = scenario_dir / "transcript.md"
     with transcript_path.open("w", encoding="utf-8") as fh:
         fh.write(field.view_dialog())
 
-    metadata_path = scenario_dir / "turns.csv"
-    pd.DataFrame(transcript_records).to_csv(metadata_path, index=False)
-
-    artifact_index_path = scenario_dir / "artifacts_index.json"
-    with artifact_index_path.open("w", encoding="utf-8") as fh:
-        json.dump(
-            {
-                "scenario_id": scenario["id"],
-                "artifacts": artifact_index,
-                "base_context": base_context,
-            },
-            fh,
-            ensure_ascii=False,
-            indent=2,
+    sink.close(
+        scenario_id=scenario["id"],
+        base_context=base_context,
+        parse_stats=field.get_parse_stats(),
+        unknown_keys=sorted(diagnosis_space.unknown),
+    )
+    if results is not None:
+        # Rebuilt from the artifacts, so that a resumed scenario writes every turn
+        records = [
+            _turn_record(a["turn"], a["speaker"], a["utterance"], a["response_payload"], a["response_info"])
+            for a in iter_artifacts(scenario_dir, resolve=False)
+        ]
+        results.write(records, {"scenario": scenario["id"]}, name="turns")
+    checkpoint.update({"turn": turn_limit, "completed": True})
+    checkpoint.close()
+
+    instrument.close()
+    LOGGER.info("Scenario '%s' completed. Results stored in %s", scenario["id"], scenario_dir)
+
+    return {
+        "scenario_id": scenario["id"],
+        "turns": turn_limit - last_turn,
+        "wall_clock": time.perf_counter() - scenario_start,
+        "llm_latency": llm_latency,
+        "parse_stats": field.get_parse_stats(),
+    }
+
+
+def run_scenario(
+    config: Dict,
+    scenario: Dict,
+    output_dir: Path,
+    turn_limit: int,
+    memory_turns: int,
+    cache: ResponseCache | None = None,
+    provider: Provider | None = None,
+    context: ContextBuilder | None = None,
+    compress_artifacts: bool = False,
+    resume: bool = False,
+    scheduler: RequestScheduler | None = None,
+    record_events: bool = False,
+    results: ResultsStore | None = None,
+) -> Dict:
+    return asyncio.run(
+        arun_scenario(
+            config,
+            scenario,
+            output_dir,
+            turn_limit,
+            memory_turns,
+            cache,
+            provider,
+            context,
+            compress_artifacts,
+            resume,
+            scheduler,
+            record_events,
+            results,
         )
+    )
 
-    LOGGER.info("Scenario '%s' completed. Results stored in %s", scenario["id"], scenario_dir)
+
+async def run_scenarios(
+    config: Dict,
+    scenarios: List[Dict],
+    output_dir: Path,
+    turn_limit: int,
+    memory_turns: int,
+    concurrency: int,
+    cache: ResponseCache | None = None,
+    provider: Provider | None = None,
+    context: ContextBuilder | None = None,
+    compress_artifacts: bool = False,
+    resume: bool = False,
+    scheduler: RequestScheduler | None = None,
+    record_events: bool = False,
+    results: ResultsStore | None = None,
+) -> List[Dict]:
+    """Run independent scenarios concurrently, at most ``concurrency`` at a time."""
+    scenario_ids = [scenario["id"] for scenario in scenarios]
+    duplicated = sorted({i for i in scenario_ids if scenario_ids.count(i) > 1})
+    if duplicated:
+        # Each scenario owns output_dir / id, concurrent runs must not share it
+        raise ValueError(f"Scenario ids must be unique, duplicated: {duplicated}")
+
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def _bounded(scenario: Dict) -> Dict:
+        async with semaphore:
+            LOGGER.info(f"Running {scenario}")
+            return await arun_scenario(
+                config,
+                scenario,
+                output_dir,
+                turn_limit,
+                memory_turns,
+                cache,
+                provider,
+                context,
+                compress_artifacts,
+                resume,
+                scheduler,
+                record_events,
+                results,
+            )
+
+    return await asyncio.gather(*(_bounded(scenario) for scenario in scenarios))
+
+
+def _log_summary(summaries: List[Dict], wall_clock: float) -> None:
+    llm_latency = sum(s["llm_latency"] for s in summaries)
+    for summary in summaries:
+        LOGGER.info(
+            "Scenario '%s': %d turns, %.2fs wall-clock, %.2fs LLM latency",
+            summary["scenario_id"],
+            summary["turns"],
+            summary["wall_clock"],
+            summary["llm_latency"],
+        )
+        LOGGER.info("Scenario '%s' response parsing: %s", summary["scenario_id"], summary["parse_stats"])
+    LOGGER.info(
+        "%d scenarios finished in %.2fs wall-clock, summed LLM latency %.2fs (x%.1f)",
+        len(summaries),
+        wall_clock,
+        llm_latency,
+        llm_latency / wall_clock if wall_clock > 0 else 0.0,
+    )
 
 
 def main() -> None:
@@ -299,10 +522,37 @@ def main() -> None:
 
     output_dir = ensure_directory(args.output_dir)
 
-    for scenario in scenarios:
-        LOGGER.info(f"Running {scenario}")
-        
-        run_scenario(config, scenario, output_dir, turn_limit, memory_turns)
+    cache = cache_from_args(args)
+    provider = provider_from_args(args)
+    context = context_from_args(args)
+    # Shared by every scenario so that concurrent runs draw from the same quota
+    scheduler = scheduler_from_args(args)
+
+    start = time.perf_counter()
+    summaries = asyncio.run(
+        run_scenarios(
+            config,
+            scenarios,
+            output_dir,
+            turn_limit,
+            memory_turns,
+            args.concurrency,
+            cache,
+            provider,
+            context,
+            args.compress_artifacts,
+            args.resume,
+            scheduler,
+            args.record_events,
+            results_from_args(args, output_dir),
+        )
+    )
+    _log_summary(summaries, time.perf_counter() - start)
+    LOGGER.info("%s", scheduler)
+
+    if cache is not None:
+        LOGGER.info("%s", cache)
+        cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,354 @@
+"""Label the therapist utterances of finished simulations with their psychotherapy technique.
+
+The technique classifier of `prompts/inference.yml` is run in batches through
+`prompts/inference-batch.yml`: utterances found below the input directories
+(`experiments.csv` of `run_simul.py`, `turns.csv` or artifacts of
+`run_clinical_conversation.py`) are deduplicated, packed ``--batch_size`` per
+request and classified concurrently. Labels are appended to
+`utterance_labels.jsonl` as batches complete, so a rerun only classifies new
+utterances.
+
+Example usage
+-------------
+
+```bash
+python run_evaluation.py \
+    --openai_api_key $OPENAI_API_KEY \
+    --input_dir outputs \
+    --output_dir outputs/evaluation
+```
+
+With ``--write_batch_file``, the requests are written in the OpenAI batch
+submission format instead of being sent; the output file of the batch is then
+loaded with ``--batch_results``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import openai
+import pandas as pd
+
+import prompts
+from engine.agent import Agent
+from engine.artifacts import TURNS_FNAME, find_scenario_dirs, iter_artifacts
+from engine.cache import add_cache_arguments, cache_from_args
+from engine.parsing import ResponseParseError
+from engine.provider import add_provider_arguments, provider_from_args
+from engine.scheduler import add_scheduler_arguments, scheduler_from_args
+from engine.space import Space
+
+LOGGER = logging.getLogger(__name__)
+
+LABELS_FNAME = "utterance_labels.jsonl"
+EXPERIMENTS_FNAME = "experiments.csv"
+# Techniques are listed as "- NAME" lines in the system prompt of the classifier
+TECHNIQUE_PATTERN = re.compile(r"^\s*- ([A-Z][A-Z_ ]*?)\s*$", re.MULTILINE)
+OTHER_TECHNIQUE = "OTHER"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Classify the psychotherapy techniques of simulated dialogs")
+    parser.add_argument("--openai_api_key", default=None, type=str, help="OpenAI API key")
+    parser.add_argument(
+        "--input_dir",
+        nargs="+",
+        required=True,
+        type=str,
+        help="Directories searched for experiments.csv, turns.csv and artifacts",
+    )
+    parser.add_argument(
+        "--output_dir",
+        default="./outputs/evaluation",
+        type=str,
+        help="Directory where labels and technique distributions will be saved",
+    )
+    parser.add_argument("--prompt", default="inference-batch", type=str, help="Prompt script of the classifier")
+    parser.add_argument(
+        "--speaker",
+        default="Therapist|Physician",
+        type=str,
+        help="Regular expression selecting the speakers whose utterances are classified",
+    )
+    parser.add_argument("--batch_size", default=20, type=int, help="Utterances packed in one request")
+    parser.add_argument("--concurrency", default=4, type=int, help="Maximum number of requests in flight")
+    parser.add_argument(
+        "--max_rounds",
+        default=2,
+        type=int,
+        help="Rounds of requests; utterances left unlabeled by a round are sent again in the next",
+    )
+    parser.add_argument(
+        "--write_batch_file",
+        default=None,
+        type=str,
+        help="Write the requests to this OpenAI batch submission file instead of sending them",
+    )
+    parser.add_argument(
+        "--batch_results",
+        default=None,
+        type=str,
+        help="Load the labels from the output file of a submitted batch",
+    )
+    add_cache_arguments(parser)
+    add_provider_arguments(parser)
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+    sends_requests = args.write_batch_file is None and args.batch_results is None
+    if sends_requests and args.provider == "openai" and args.openai_api_key is None:
+        parser.error("--openai_api_key is required by the openai provider")
+    return args
+
+
+def utterance_key(utterance: str) -> str:
+    """Short content hash, used both to deduplicate and as the utterance id in the requests."""
+    return hashlib.sha256(utterance.strip().encode("utf-8")).hexdigest()[:10]
+
+
+def load_turns(input_dirs: Iterable[str]) -> List[Dict]:
+    """Every turn recorded below ``input_dirs``, as ``session``, ``turn``, ``speaker``, ``utterance`` rows."""
+    rows = []
+    for input_dir in map(Path, input_dirs):
+        for path in sorted(input_dir.rglob(EXPERIMENTS_FNAME)):
+            session = str(path.parent)
+            experiments = pd.read_csv(path)
+            for turn, (speaker, utterance) in enumerate(zip(experiments["role"], experiments["content"])):
+                rows.append({"session": session, "turn": turn, "speaker": speaker, "utterance": utterance})
+
+        for scenario_dir in find_scenario_dirs(input_dir):
+            session = str(scenario_dir)
+            turns_path = scenario_dir / TURNS_FNAME
+            if turns_path.exists():
+                with turns_path.open("r", encoding="utf-8", newline="") as fh:
+                    turns = list(csv.DictReader(fh))
+            else:
+                turns = iter_artifacts(scenario_dir, resolve=False)
+            for turn in turns:
+                rows.append(
+                    {
+                        "session": session,
+                        "turn": int(turn["turn"]),
+                        "speaker": turn["speaker"],
+                        "utterance": turn["utterance"],
+                    }
+                )
+    return [row for row in rows if isinstance(row["utterance"], str) and row["utterance"].strip()]
+
+
+def load_labels(path: Path) -> Dict[str, str]:
+    labels = dict()
+    if path.exists():
+        with path.open("r", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                labels[record["key"]] = record["technique"]
+    return labels
+
+
+def make_batches(utterances: Dict[str, str], batch_size: int) -> List[Dict[str, str]]:
+    keys = list(utterances)
+    return [{k: utterances[k] for k in keys[i : i + batch_size]} for i in range(0, len(keys), batch_size)]
+
+
+def build_messages(agent: Agent, batch: Dict[str, str]) -> List[Dict]:
+    space = Space(agent.user_inputs)
+    space["utterances"] = json.dumps(batch, ensure_ascii=False, indent=0)
+    msgs = []
+    system_prompt = agent.get_sys_prompt(space)
+    if system_prompt is not None:
+        msgs.append({"role": "system", "content": system_prompt})
+    msgs.append({"role": "user", "content": agent.get_message(space)})
+    return msgs
+
+
+def read_labels(response: Dict, batch: Dict[str, str]) -> Dict[str, str]:
+    """Labels of the utterances of ``batch`` found in a response, ignoring ids that were not asked."""
+    return {k: str(v).strip() for k, v in response.items() if k in batch and isinstance(v, (str, int, float))}
+
+
+class LabelWriter:
+    """Appends the labels to ``utterance_labels.jsonl`` as soon as a batch is done."""
+
+    def __init__(self, path: Path, utterances: Dict[str, str]) -> None:
+        self.utterances = utterances
+        self.fh = path.open("a", encoding="utf-8")
+
+    def write(self, labels: Dict[str, str]) -> None:
+        for key, technique in labels.items():
+            record = {"key": key, "technique": technique, "utterance": self.utterances[key]}
+            self.fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.fh.close()
+
+
+async def classify(
+    agent: Agent,
+    utterances: Dict[str, str],
+    writer: LabelWriter,
+    batch_size: int,
+    concurrency: int,
+    max_rounds: int,
+) -> Dict[str, str]:
+    """Classify ``utterances`` (key -> utterance) in batches of ``batch_size``, ``concurrency`` at a time."""
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    labels: Dict[str, str] = dict()
+
+    async def _bounded(batch: Dict[str, str]) -> None:
+        async with semaphore:
+            try:
+                response, _ = await agent.arequest(build_messages(agent, batch))
+            except ResponseParseError as err:
+                LOGGER.warning("Batch of %d utterances left unlabeled: %s", len(batch), err)
+                return
+            batch_labels = read_labels(response, batch)
+            labels.update(batch_labels)
+            writer.write(batch_labels)
+
+    pending = dict(utterances)
+    for round_idx in range(max(max_rounds, 1)):
+        if not pending:
+            break
+        batches = make_batches(pending, batch_size)
+        LOGGER.info("Round %d: %d utterances in %d requests", round_idx + 1, len(pending), len(batches))
+        await asyncio.gather(*(_bounded(batch) for batch in batches))
+        pending = {k: v for k, v in pending.items() if k not in labels}
+
+    if pending:
+        LOGGER.warning("%d utterances are still unlabeled after %d rounds", len(pending), max_rounds)
+    return labels
+
+
+def write_batch_file(agent: Agent, utterances: Dict[str, str], batch_size: int, path: Path) -> int:
+    """Write one request per batch in the OpenAI batch submission format, returns the number of requests."""
+    batches = make_batches(utterances, batch_size)
+    with path.open("w", encoding="utf-8") as fh:
+        for idx, batch in enumerate(batches):
+            request = {
+                "custom_id": f"batch-{idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": dict(agent.api_kwargs, messages=build_messages(agent, batch)),
+            }
+            fh.write(json.dumps(request, ensure_ascii=False) + "\n")
+    return len(batches)
+
+
+def read_batch_results(agent: Agent, utterances: Dict[str, str], path: Path) -> Dict[str, str]:
+    """Labels found in the output file of a batch; utterance ids make the responses self-describing."""
+    labels = dict()
+    with path.open("r", encoding="utf-8") as fh:
+        for line in fh:
+            result = json.loads(line)
+            body = (result.get("response") or {}).get("body")
+            if not body:
+                LOGGER.warning("Request %s failed: %s", result.get("custom_id"), result.get("error"))
+                continue
+            try:
+                response, _ = agent.format_response(body, 0.0)
+            except ResponseParseError as err:
+                LOGGER.warning("Request %s cannot be parsed: %s", result.get("custom_id"), err)
+                continue
+            labels.update(read_labels(response, utterances))
+    return labels
+
+
+def get_techniques(agent: Agent) -> List[str]:
+    return [t.strip() for t in TECHNIQUE_PATTERN.findall(agent.system_prompt or "")]
+
+
+def write_distributions(turns: pd.DataFrame, techniques: List[str], output_dir: Path) -> pd.DataFrame:
+    """Technique counts and shares per session, unknown labels counted as ``OTHER``."""
+    known = turns["technique"].where(turns["technique"].isin(techniques), OTHER_TECHNIQUE)
+    known = known.where(turns["technique"].notna())
+    counts = pd.crosstab(turns["session"], known).reindex(columns=techniques + [OTHER_TECHNIQUE], fill_value=0)
+    counts = counts.reindex(turns["session"].unique(), fill_value=0)
+    labeled = counts.sum(axis=1)
+    shares = counts.div(labeled.where(labeled > 0), axis=0).fillna(0.0).add_suffix("_share")
+
+    distributions = pd.concat([counts, shares], axis=1)
+    distributions.insert(0, "n_unlabeled", turns.groupby("session")["technique"].apply(lambda s: s.isna().sum()))
+    distributions.insert(0, "n_utterances", turns.groupby("session").size())
+    distributions.index.name = "session"
+    distributions.to_csv(output_dir / "technique_distributions.csv")
+    return distributions
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    openai.api_key = args.openai_api_key
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    cache = cache_from_args(args)
+    agent = Agent(
+        prompts.prompt_dict[args.prompt],
+        cache=cache,
+        provider=provider_from_args(args),
+        scheduler=scheduler_from_args(args),
+    )
+
+    turns = [row for row in load_turns(args.input_dir) if re.search(args.speaker, str(row["speaker"]))]
+    for row in turns:
+        row["key"] = utterance_key(row["utterance"])
+    utterances = {row["key"]: row["utterance"] for row in turns}
+
+    labels_path = output_dir / LABELS_FNAME
+    labels = load_labels(labels_path)
+    pending = {k: v for k, v in utterances.items() if k not in labels}
+    LOGGER.info(
+        "%d turns selected, %d distinct utterances, %d to classify",
+        len(turns),
+        len(utterances),
+        len(pending),
+    )
+
+    if args.write_batch_file is not None:
+        n_requests = write_batch_file(agent, pending, args.batch_size, Path(args.write_batch_file))
+        LOGGER.info("%d requests written to %s", n_requests, args.write_batch_file)
+        return
+
+    writer = LabelWriter(labels_path, utterances)
+    start = time.perf_counter()
+    if args.batch_results is not None:
+        new_labels = read_batch_results(agent, pending, Path(args.batch_results))
+        writer.write(new_labels)
+    else:
+        new_labels = asyncio.run(
+            classify(agent, pending, writer, args.batch_size, args.concurrency, args.max_rounds)
+        )
+    writer.close()
+    labels.update(new_labels)
+    LOGGER.info("%d utterances labeled in %.2fs", len(new_labels), time.perf_counter() - start)
+
+    turns = pd.DataFrame(turns, columns=["session", "turn", "speaker", "utterance", "key"])
+    turns["technique"] = turns["key"].map(labels)
+    turns.drop(columns="key").to_csv(output_dir / "utterance_techniques.csv", index=False)
+    write_distributions(turns, get_techniques(agent), output_dir)
+
+    LOGGER.info("Response parsing: %s", agent.get_parse_stats())
+    LOGGER.info("%s", agent.scheduler)
+    if cache is not None:
+        LOGGER.info("%s", cache)
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
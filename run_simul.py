@@ -1,18 +1,31 @@
 import os
-import json
+import uuid
 import random
+import asyncio
 import logging
 import argparse
 import pandas as pd
 from pprint import pformat
-from itertools import chain
+from itertools import chain, product
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import openai
 
 import Persona
 from src.logger import Logger
-from engine.space import Space
+from engine.space import Space, Var
 from engine.field import Field
+from engine.cache import add_cache_arguments, cache_from_args
+from engine.provider import add_provider_arguments, provider_from_args
+from engine.context import add_context_arguments, context_from_args
+from engine.checkpoint import CheckpointLog
+from engine.parsing import repair_json
+from engine.scheduler import add_scheduler_arguments, scheduler_from_args
+from engine.instrument import add_instrument_arguments, instrument_from_args
+from engine.artifacts import TreeSink
+from engine.results import add_results_arguments, results_from_args
+from engine.turns import FixedPolicy, RouterPolicy, RulePolicy
+from engine.server import SessionServer
 from utils import name_map
 
 logging.basicConfig(level=logging.INFO)
@@ -24,17 +37,57 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--openai_api_key', type=str, required=False)
 
 # Execution option
-parser.add_argument('--seed', type=str, default=1234)
+parser.add_argument('--seed', type=int, default=1234)
 parser.add_argument('--scenario', type=str, default='common')
 parser.add_argument('--sample_idx', type=str, default='depression_persona')
 parser.add_argument('--turn_limit', type=int, default=5)
 
 parser.add_argument('--prompt_therapist', type=str, default=None)
 parser.add_argument('--prompt_client', type=str, required=True)
+# Without --prompt_therapist, the router picks one of --therapists every turn
+parser.add_argument('--prompt_router', type=str, default='router')
+parser.add_argument('--speculative_router', action='store_true', help='send the router request during the client turn')
 
 parser.add_argument('--emotion', type=str) # 감정 추가
+parser.add_argument('--output_root', type=str, default='./outputs/simul')
+parser.add_argument('--resume', action='store_true', help='continue from the last checkpointed step')
+# Conversation tree : every branch samples --branches candidates at the steps of --branch_turns
+parser.add_argument('--branches', type=int, default=1)
+parser.add_argument('--branch_turns', type=int, nargs='*', default=[1])
+parser.add_argument('--branch_use_n', action='store_true', help='sample the candidates with one request (n parameter)')
+add_cache_arguments(parser)
+add_provider_arguments(parser)
+add_context_arguments(parser)
+add_scheduler_arguments(parser)
+add_instrument_arguments(parser)
+add_results_arguments(parser)
+# Number of processes sharing the --rpm/--tpm quota, set by the sweep
+parser.set_defaults(rate_share=1)
 
-def generate_client_behavior(_scenario, _cnt, _q1, _q2, _q3):
+# Session server : concurrent human therapists, each answering from a browser
+parser.add_argument('--serve', action='store_true')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--max_sessions', type=int, default=None)
+
+# Sweep option : persona x scenario x therapist x seed grid
+parser.add_argument('--sweep', action='store_true')
+parser.add_argument('--personas', type=str, nargs='*', default=None, help='default : every Persona')
+parser.add_argument('--scenarios', type=str, nargs='*', default=None, help='default : every scenario')
+parser.add_argument('--therapists', type=str, nargs='*', default=['therapist-base', 'therapist-downarrow'])
+parser.add_argument('--seeds', type=int, nargs='*', default=[1234])
+parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+SCENARIOS = ['common', 'simul', 'resistance', 'overwhelmed', 'atl', 'defector']
+OPENING_MESSAGE = 'hi, nice to see you today how you been going?'
+# Persona context written once per session, before the first turn
+PERSONA_VARIABLES = [Var('automatic_thoughts', str), Var('client_symptom', str), Var('description', str),
+                     Var('client_situation', str)]
+# Persona context repeated on every row, dictionary-encoded in the results dataset
+STATIC_COLUMNS = ['automatic_thoughts', 'client_symptom', 'description', 'client_situation', 'client_reaction',
+                  'client_mood', 'therapist_candidates']
+
+def generate_client_behavior(_scenario, _cnt, _q1, _q2, _q3, _rng=random):
     if _scenario == 'common':
         if _cnt > _q3:
             _aha_moment = 'Yes'  
@@ -47,7 +100,7 @@ def generate_client_behavior(_scenario, _cnt, _q1, _q2, _q3):
             _behavior = 'sustaining unhealthy behavior'
         else:
             _aha_moment = 'No'  
-            _behavior = random.choice(['sharing emotions', 'sharing experiences'])
+            _behavior = _rng.choice(['sharing emotions', 'sharing experiences'])
     elif _scenario == 'simul':
         if _cnt > _q3:
             _aha_moment = 'Yes'  
@@ -79,42 +132,178 @@ def generate_client_behavior(_scenario, _cnt, _q1, _q2, _q3):
             _behavior = 'sharing complicate thoughts'
         else:
             _aha_moment = 'No'  
-            _behavior = random.choice(['sharing emotions', 'sharing experiences'])        
+            _behavior = _rng.choice(['sharing emotions', 'sharing experiences'])        
     elif _scenario == 'defector':
-        return random.choice(['sharing emotions', 'sharing experiences'], p=[0.3, 0.7])
+        _aha_moment = 'No'
+        _behavior = _rng.choices(['sharing emotions', 'sharing experiences'], weights=[0.3, 0.7])[0]
     else:
         raise ValueError(f'Cannot support scenario : {_scenario}')
     return _behavior, _aha_moment
 
 
-if __name__ == '__main__':
-    TURN_LIMIT = 9
-    symptom = 'GAD'
-    version = 3
-    SCENARIO = 'simul'
-    API_KEY = 'TODO'
-    sample_idx = f'patient-{symptom}-v{version}'
-    args = parser.parse_args(args=[
-        '--openai_api_key', API_KEY,
-        '--scenario', SCENARIO,
-        '--prompt_client', 'patient',
-        '--prompt_therapist', 'human',
-        '--sample_idx', sample_idx,
-        '--turn_limit', str(TURN_LIMIT)
-    ])
-
-    assert args.openai_api_key != 'TODO', "OpenAI의 API key를 입력해주세요!"
-    output_dir = f'./outputs/simul/{args.sample_idx}-{args.scenario}-{args.prompt_client}-{args.seed}'
+def get_output_dir(args):
+    return f'{args.output_root}/{args.sample_idx}-{args.scenario}-{args.prompt_client}-{args.seed}'
+
+
+def get_run_name(args):
     run_name = []
     if args.prompt_therapist is not None:
         run_name.append(args.prompt_therapist)
     else:
         run_name.append('MultiTherapist')
-    run_name = '-'.join(run_name)
+    if getattr(args, 'session_id', None) is not None:
+        run_name.append(args.session_id)
+    return '-'.join(run_name)
+
+
+def prepare_turn(args, field, diagnosis_space, turn_policy, client_id, counts, logger, rng=random):
+    """Pick the speaker of step ``counts`` and write its inputs to the space."""
+    last_agent, last_utterance = field.get_last_chat()
+    current_id = turn_policy.next_speaker(field, diagnosis_space)
+    current_agent = field.agent_names[current_id]
+    if current_id != client_id:
+        logger.info(f'{counts} th step, Therapist turn')
+
+        diagnosis_space.sync(dict(
+            user_utterance=last_utterance,
+            selected_therapist = current_agent
+        ))
+
+    else:
+        logger.info(f'{counts} th step, Client turn')
+        q1, q2, q3 = args.turn_limit * 1/4 , args.turn_limit * 2/4, args.turn_limit * 3/4
+        behavior, aha_moment = generate_client_behavior(args.scenario, counts, q1, q2, q3, rng)
+
+        diagnosis_space.sync(dict(
+            aha_moment=aha_moment,
+            conversational_behavior_gt=behavior,
+            therapist_utterance=last_utterance
+            ))
+        # With --speculative_router, the next therapist is picked during the client's turn
+        if counts + 1 < args.turn_limit:
+            turn_policy.speculate(field, diagnosis_space, current_id)
+    return current_id, current_agent
+
+
+def get_utterance(response_formated, is_client):
+    if is_client:
+        if isinstance(response_formated, str):
+            # Agents without json_object output still answer in json
+            response_formated, _ = repair_json(response_formated)
+        if isinstance(response_formated, dict):
+            current_utterance = response_formated['Client_Response']
+        else:
+            print(f'{type(response_formated)}\n{response_formated}')
+            raise TypeError()
+    else:
+        current_utterance = response_formated['Response']
+    return response_formated, current_utterance
+
+
+def print_stream(key):
+    """``on_token`` callback printing the value of ``key`` while it is generated, for human therapists."""
+    printed = 0
+
+    def on_token(delta, stream):
+        nonlocal printed
+        text = stream.partial(key) or ''
+        if len(text) > printed:
+            print(('\n[Client] ' if printed == 0 else '') + text[printed:], end='', flush=True)
+            printed = len(text)
+    return on_token
+
+
+def record_turn(field, diagnosis_space, current_agent, response_formated, current_utterance):
+    """Add the utterance to the dialog and the response to the space, returns the row of experiments.csv."""
+    field.add_chat(current_agent, current_utterance)
+
+    if isinstance(response_formated, dict):
+        diagnosis_space.sync(response_formated)
+
+    agent_name, agent_utterance = field.get_last_chat()
+    return dict({'role': agent_name, 'content': agent_utterance}, **diagnosis_space.values)
+
+
+def turn_info(counts, response_info):
+    """Step, latency and token counts of a turn, kept next to its experiments.csv row."""
+    return dict({k: v for k, v in response_info.items() if k != 'parse'}, turn=counts)
+
+
+def result_rows(response_tab, turn_infos):
+    """Rows of the results dataset, built once the session is written."""
+    return [dict(row, **info) for row, info in zip(response_tab, turn_infos)]
+
+
+def explore(args, field, diagnosis_space, turn_policy, client_id, logger, run_dir):
+    """
+    Conversation tree : at the steps of --branch_turns, every branch samples --branches
+    candidate responses (see `Field.branch`) and continues with each of them, on forks
+    sharing the dialog so far. The branches of a step run concurrently.
+    Every turn is written once to tree.jsonl and to the rows returned for experiments.csv, with
+    the node it follows. Returns the rows and their turn infos.
+    """
+    tree = TreeSink(run_dir)
+    agent_name, agent_utterance = field.get_last_chat()
+    snapshot = diagnosis_space.snapshot()
+    root = tree.add(None, turn=0, role=agent_name, content=agent_utterance, space_delta=diagnosis_space.delta(None, snapshot))
+    response_tab = [dict({'node': root, 'parent': None, 'role': agent_name, 'content': agent_utterance}, **diagnosis_space.values)]
+    turn_infos = [dict(turn=0)]
+
+    def step(branch, counts):
+        field, space, node, snapshot, path = branch
+        # Client behaviors are drawn from a generator per branch, independent of the thread timings
+        rng = random.Random(f'{args.seed}:{path}')
+        current_id, current_agent = prepare_turn(args, field, space, turn_policy, client_id, counts, logger, rng)
+        if counts in args.branch_turns:
+            candidates = field.branch(current_agent, space, args.turn_limit+1, args.branches, use_n=args.branch_use_n)
+        else:
+            response_formated, response_info = field.run(current_agent, space, args.turn_limit+1)
+            candidates = [(field, space, response_formated, response_info)]
+
+        children = []
+        for candidate, (child_field, child_space, response_formated, response_info) in enumerate(candidates):
+            response_formated, current_utterance = get_utterance(response_formated, current_id == client_id)
+            row = record_turn(child_field, child_space, current_agent, response_formated, current_utterance)
+            children.append((child_field, child_space, node, snapshot, f'{path}.{candidate}', candidate, row, response_info))
+        return children
+
+    frontier = [(field, diagnosis_space, root, snapshot, '0')]
+    with ThreadPoolExecutor(max_workers=max(args.branches, 1), thread_name_prefix='explore') as executor:
+        for counts in range(1, args.turn_limit):
+            with field.instrument.span('turn', turn=counts, branches=len(frontier)):
+                results = list(executor.map(step, frontier, [counts]*len(frontier)))
+
+            # Nodes are numbered in frontier order, so that the tree does not depend on the thread timings
+            frontier = []
+            for children in results:
+                for child_field, child_space, parent, parent_snapshot, path, candidate, row, response_info in children:
+                    child_snapshot = child_space.snapshot()
+                    node = tree.add(parent, turn=counts, candidate=candidate, role=row['role'], content=row['content'],
+                                    response_info=response_info, space_delta=child_space.delta(parent_snapshot, child_snapshot))
+                    response_tab.append(dict({'node': node, 'parent': parent}, **row))
+                    turn_infos.append(turn_info(counts, response_info))
+                    frontier.append((child_field, child_space, node, child_snapshot, path))
+            logger.info(f'{counts} DONE, {len(frontier)} branches')
+    tree.close()
+    logger.info(f'{len(response_tab)} turns in {len(frontier)} branches written to {tree.path}')
+    return response_tab, turn_infos
+
+
+def setup_session(args, human_channel=None):
+    """Output directory, logger, field, agents, space and turn policy of a session, as a namespace."""
+    if args.provider == 'openai':
+        assert args.openai_api_key not in (None, 'TODO'), "OpenAI의 API key를 입력해주세요!"
+
+    # Looked up first : an unknown persona fails before any directory is created
+    persona = Persona.story_dict[args.sample_idx]['Input']
+
+    output_dir = get_output_dir(args)
+    run_name = get_run_name(args)
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(f'{output_dir}/{run_name}', exist_ok=True)
 
-    logger = Logger(run_name, output_dir)
+    # Logger name is unique per output_dir so that sweep workers reusing a process do not share handlers
+    logger = Logger(f'{os.path.basename(output_dir)}-{run_name}', output_dir)
     logger.addFileHandler(f'{run_name}-log.txt')
 
     for k, v in vars(args).items():
@@ -124,31 +313,47 @@ if __name__ == '__main__':
 
     openai.api_key = args.openai_api_key
 
-    c_symptom = Persona.story_dict[args.sample_idx]['Input']['SYMPTOM']
-    c_description= Persona.story_dict[args.sample_idx]['Input']['DESCRIPTION']
-    c_situation = Persona.story_dict[args.sample_idx]['Input']['SITUATION']
-    c_reaction = Persona.story_dict[args.sample_idx]['Input']['REACTION']
-    c_automatic_thought = Persona.story_dict[args.sample_idx]['Input']['AUTOMATIC_THOUGHT']
+    c_symptom = persona['SYMPTOM']
+    c_description= persona['DESCRIPTION']
+    c_situation = persona['SITUATION']
+    c_reaction = persona['REACTION']
+    c_automatic_thought = persona['AUTOMATIC_THOUGHT']
 
-    field = Field()
-    field.add_agent(name_map[args.prompt_client], args.prompt_client) 
+    # Sampled responses are cached per seed, so re-running a seed replays the same session
+    cache = cache_from_args(args, sample=args.seed)
+    scheduler = scheduler_from_args(args, share=args.rate_share)
+    instrument = instrument_from_args(args, f'{output_dir}/{run_name}', scenario=f'{os.path.basename(output_dir)}/{run_name}')
+    field = Field(cache=cache,
+                  provider=provider_from_args(args),
+                  context=context_from_args(args),
+                  scheduler=scheduler,
+                  instrument=instrument)
+    client_id = field.add_agent(name_map[args.prompt_client], args.prompt_client)
 
     agent_key = {
         'therapist-base': 'Therapist Naive',
         'therapist-downarrow': 'Therapist DownArrow',
         'human':' Therapist Human',
         }  
-    
-    if args.prompt_therapist == 'human':
-        field.add_agent(agent_key[args.prompt_therapist], prompt_fname=args.prompt_therapist, human=True)
-    else:
-        field.add_agent(agent_key[args.prompt_therapist], prompt_fname=args.prompt_therapist)
 
-    space_vars = [['automatic_thoughts'],['client_symptom'],['description'],['client_situation'], ['c_reaction']] + field.get_agent_inputs()
-    space_vars = list(chain.from_iterable(space_vars))
-    assert isinstance(space_vars, list)
+    # A single therapist, or every therapist of --therapists picked by the router each turn
+    therapist_prompts = [args.prompt_therapist] if args.prompt_therapist is not None else args.therapists
+    therapist_ids = [
+        field.add_agent(agent_key[prompt_therapist], prompt_fname=prompt_therapist,
+                        human=prompt_therapist == 'human', human_channel=human_channel)
+        for prompt_therapist in therapist_prompts
+    ]
+    router = None
+    if len(therapist_ids) > 1:
+        field.add_agent('Router', args.prompt_router)
+        router = RouterPolicy('Router', therapist_ids, key='Therapist',
+                              message_len=args.turn_limit, speculative=args.speculative_router and args.branches == 1)
+    # The client answers every therapist (and the opening message), the therapists answer the client
+    turn_policy = RulePolicy({client_id: router or therapist_ids[0]}, default=client_id)
+
+    space_vars = PERSONA_VARIABLES + ['c_reaction'] + list(chain.from_iterable(field.get_agent_inputs()))
     
-    diagnosis_space = Space(scope=space_vars)
+    diagnosis_space = Space(scope=space_vars, readers=field.get_agent_readers())
 
     diagnosis_space['client_symptom'] = c_symptom
     diagnosis_space['description'] = c_description
@@ -157,83 +362,274 @@ if __name__ == '__main__':
     
     diagnosis_space['automatic_thoughts'] = c_automatic_thought
     diagnosis_space['client_mood'] = args.emotion
+    diagnosis_space['therapist_candidates'] = ', '.join(therapist_prompts)
 
-    field.add_chat(agent_name='Therapist', utterance='hi, nice to see you today how you been going?')
+    return argparse.Namespace(
+        run_dir=f'{output_dir}/{run_name}', run_name=run_name, logger=logger,
+        results=results_from_args(args, args.output_root), cache=cache, scheduler=scheduler, instrument=instrument,
+        field=field, client_id=client_id, therapist_prompts=therapist_prompts, router=router,
+        turn_policy=turn_policy, diagnosis_space=diagnosis_space,
+    )
 
+
+def replay_rows(diagnosis_space, entries):
+    """experiments.csv rows and turn infos of the checkpointed turns, replaying their space deltas."""
+    values = dict(diagnosis_space.values)
     response_tab = []
-    counts = 1
-    keep_therapy = True
-    while keep_therapy:
-        last_agent, last_utterance = field.get_last_chat()
-        if last_agent == 'Client':
-            logger.info(f'{counts} th step, Therapist turn')
-
-            if args.prompt_therapist is not None:
-                current_agent = field.get_agent_with_key(args.prompt_therapist)
-            else:
-                router_response_formated, response_info = field.run(
-                    agent_name='Router', 
-                    var_space=diagnosis_space, 
-                    message_len=args.turn_limit)
-                current_agent = router_response_formated['Therapist']
-                current_agent = field.get_agent_with_key(current_agent)
+    for entry in entries:
+        values.update(entry['space'])
+        _, role, content = entry['dialog'][-1]
+        response_tab.append(dict({'role': role, 'content': content}, **values))
+    return response_tab, [entry['info'] for entry in entries]
 
-            diagnosis_space.sync(dict(
-                user_utterance=last_utterance,
-                selected_therapist = current_agent
-            ))
 
-        elif 'Therapist' in last_agent:
-            logger.info(f'{counts} th step, Client turn')
-            current_agent = 'Client'
-            q1, q2, q3 = args.turn_limit * 1/4 , args.turn_limit * 2/4, args.turn_limit * 3/4
-            behavior, aha_moment = generate_client_behavior(args.scenario, counts, q1, q2, q3)
-            
-            diagnosis_space.sync(dict(
-                aha_moment=aha_moment,
-                conversational_behavior_gt=behavior,
-                therapist_utterance=last_utterance
-                ))
+def write_session(args, session, response_tab, turn_infos):
+    pd.DataFrame(response_tab).to_csv(f'{session.run_dir}/experiments.csv')
+
+    # The branches of a tree are rebuilt from tree.jsonl
+    if args.branches == 1:
+        with open(f'{session.run_dir}/dialog.md', 'w', encoding='utf-8') as f:
+            f.write(session.field.view_dialog())
+
+    if session.results is not None:
+        partition = dict(persona=args.sample_idx, scenario=args.scenario, client=args.prompt_client,
+                         therapist=args.prompt_therapist or 'MultiTherapist', seed=args.seed)
+        rows = result_rows(response_tab, turn_infos)
+        path = session.results.write(rows, partition, name=session.run_name, static=STATIC_COLUMNS)
+        session.logger.info(f'{len(rows)} rows written to {path}')
+
+
+def close_session(session):
+    logger = session.logger
+    logger.info(f'Response parsing : {session.field.get_parse_stats()}')
+    if session.diagnosis_space.unknown:
+        logger.info(f'Undeclared response keys : {list(session.diagnosis_space.unknown)}')
+    logger.info(f'{session.scheduler}')
+    if session.router is not None:
+        session.router.close()
+        logger.info(f'Router : {session.router.stats}')
+    session.instrument.close()
+    if session.cache is not None:
+        logger.info(f'{session.cache}')
+        session.cache.close()
+    # Sweep workers run many sessions per process
+    logger.close()
+
+
+def run_session(args):
+    random.seed(args.seed)
+    if args.branches > 1 and args.resume:
+        raise ValueError('--resume is not supported with --branches')
+
+    session = setup_session(args)
+    logger, field, diagnosis_space = session.logger, session.field, session.diagnosis_space
+    turn_policy, client_id, instrument = session.turn_policy, session.client_id, session.instrument
+
+    # One line per turn in checkpoint.jsonl, checkpoint.json only holds the counters
+    checkpoint = CheckpointLog(session.run_dir)
+    try:
+        restored = checkpoint.load() if args.resume else None
+        if restored is None:
+            field.add_chat(agent_name='Therapist', utterance=OPENING_MESSAGE)
+
+            response_tab = []
+            turn_infos = []
+            counts = 1
+            keep_therapy = True
         else:
-            raise KeyError(f'Wrong Agent')
-        
-        response_formated, response_info = field.run(
-            agent_name=current_agent, 
-            var_space=diagnosis_space, 
-            message_len=args.turn_limit+1)
-        
-        if current_agent == 'Client':
-            if isinstance(response_formated, str):
-                try:
-                    current_utterance = json.loads(response_formated)['Client_Response']
-                except json.decoder.JSONDecodeError as err:
-                    logger.info(f'CANNOT DECODE :\n{response_formated}')
-                    raise json.decoder.JSONDecodeError(err)
-            elif isinstance(response_formated, dict):
-                current_utterance = response_formated['Client_Response']
-            else:
-                print(f'{type(response_formated)}\n{response_formated}')
-                raise TypeError()
-        elif 'Therapist' in current_agent:
-            current_utterance = response_formated['Response']
+            header, entries = restored
+            response_tab, turn_infos = replay_rows(diagnosis_space, entries)
+            checkpoint.restore(field, diagnosis_space, entries)
+            version, internal_state, gauss_next = header['random_state']
+            random.setstate((version, tuple(internal_state), gauss_next))
+
+            counts = header['counts']
+            keep_therapy = counts < args.turn_limit
+            logger.info(f'Resume from {counts} th step')
+
+        if args.branches > 1:
+            response_tab, turn_infos = explore(args, field, diagnosis_space, turn_policy, client_id, logger, session.run_dir)
+            keep_therapy = False
         else:
-            raise KeyError(f'Wrong Agent')
-        field.add_chat(current_agent, current_utterance)
+            checkpoint.open(field, diagnosis_space)
 
-        if isinstance(response_formated, dict):
-            diagnosis_space.sync(response_formated)
-        
-        agent_name, agent_utterance = field.get_last_chat()
-        response_tab.append(dict({'role': agent_name, 'content': agent_utterance}, **diagnosis_space.values))
+        while keep_therapy:
+            with instrument.span('turn', turn=counts) as turn_span:
+                current_id, current_agent = prepare_turn(args, field, diagnosis_space, turn_policy, client_id, counts, logger)
+
+                # A human therapist reads the client's reply as it is streamed (stream: true in the client prompt)
+                human_session = 'human' in session.therapist_prompts
+                on_token = print_stream('Client_Response') if current_id == client_id and human_session else None
+                response_formated, response_info = field.run(
+                    agent_name=current_agent, 
+                    var_space=diagnosis_space, 
+                    message_len=args.turn_limit+1,
+                    on_token=on_token)
+
+                response_formated, current_utterance = get_utterance(response_formated, current_id == client_id)
+                response_tab.append(record_turn(field, diagnosis_space, current_agent, response_formated, current_utterance))
+                turn_infos.append(turn_info(counts, response_info))
+                turn_span['agent'] = current_agent
+
+                logger.info(f'{counts} DONE')
+                counts += 1
+                if counts >= args.turn_limit:
+                    keep_therapy = False   
+
+                with instrument.span('checkpoint', agent=current_agent):
+                    checkpoint.commit(dict(counts=counts, random_state=random.getstate()), info=turn_infos[-1])
+
+        write_session(args, session, response_tab, turn_infos)
+    finally:
+        checkpoint.close()
+        close_session(session)
+
+    return f'{session.run_dir}/experiments.csv'
 
-        logger.info(f'{counts} DONE')
-        counts += 1
-        if counts >= args.turn_limit:
-            keep_therapy = False   
 
-    response_tab = pd.DataFrame(response_tab)
-    response_tab.to_csv(f'{output_dir}/{run_name}/experiments.csv')
+async def arun_session(args, human_channel=None, publish=None):
+    """
+    Same session as `run_session`, awaiting every turn, for the session server (`--serve`) :
+    the human therapist answers through ``human_channel`` and ``publish(event, **fields)``
+    receives the turns and the streamed client replies. The client behaviors are drawn from
+    a generator of the session, as sessions share the process. Server sessions are not
+    checkpointed : each has its own run name and cannot be resumed.
+    """
+    rng = random.Random(args.seed)
+    publish = publish or (lambda event, **fields: None)
+    session = setup_session(args, human_channel)
+    logger, field, diagnosis_space = session.logger, session.field, session.diagnosis_space
+    turn_policy, client_id, instrument = session.turn_policy, session.client_id, session.instrument
 
-    with open(f'{output_dir}/{run_name}/dialog.md', 'w', encoding='utf-8') as f:
-        f.write(field.view_dialog())
+    def on_token(delta, stream):
+        publish('partial', text=stream.partial('Client_Response') or '')
+
+    field.add_chat(agent_name='Therapist', utterance=OPENING_MESSAGE)
+    publish('turn', turn=0, agent='Therapist', utterance=OPENING_MESSAGE)
+    response_tab = []
+    turn_infos = []
+    try:
+        for counts in range(1, args.turn_limit):
+            with instrument.span('turn', turn=counts) as turn_span:
+                current_id = await turn_policy.anext_speaker(field, diagnosis_space)
+                # The speaker is known, prepare_turn only writes its inputs
+                current_id, current_agent = prepare_turn(
+                    args, field, diagnosis_space, FixedPolicy(current_id), client_id, counts, logger, rng)
+
+                response_formated, response_info = await field.arun(
+                    agent_name=current_agent,
+                    var_space=diagnosis_space,
+                    message_len=args.turn_limit+1,
+                    on_token=on_token if current_id == client_id else None)
+
+                response_formated, current_utterance = get_utterance(response_formated, current_id == client_id)
+                response_tab.append(record_turn(field, diagnosis_space, current_agent, response_formated, current_utterance))
+                turn_infos.append(turn_info(counts, response_info))
+                publish('turn', turn=counts, agent=current_agent, utterance=current_utterance)
+                turn_span['agent'] = current_agent
+                logger.info(f'{counts} DONE')
+        # Off the event loop serving the other sessions
+        await asyncio.to_thread(write_session, args, session, response_tab, turn_infos)
+    finally:
+        close_session(session)
+    return f'{session.run_dir}/experiments.csv'
+
+
+def serve(args):
+    """
+    Host concurrent human-therapist sessions (see `engine.server.SessionServer`). The body of
+    ``POST /sessions`` overrides the session options (sample_idx, scenario, prompt_client,
+    seed, turn_limit, emotion); every session gets its own output directory.
+    """
+    options = ('sample_idx', 'scenario', 'prompt_client', 'seed', 'turn_limit', 'emotion')
+
+    async def run(params, channel, publish):
+        cell = argparse.Namespace(**vars(args))
+        for k in options:
+            if k in params:
+                setattr(cell, k, type(getattr(args, k))(params[k]) if getattr(args, k) is not None else params[k])
+        cell.prompt_therapist = 'human'
+        cell.session_id = uuid.uuid4().hex[:8]
+        return await arun_session(cell, channel, publish)
+
+    def check_params(params):
+        # The params name the output directory of the session : only known values are accepted
+        known = dict(sample_idx=Persona.story_dict, scenario=SCENARIOS, prompt_client=name_map)
+        for k, values in known.items():
+            if k in params and not (isinstance(params[k], str) and params[k] in values):
+                raise ValueError(f'Unknown {k} {params[k]!r}')
+        for k in ('seed', 'turn_limit'):
+            if k in params and not str(params[k]).isdigit():
+                raise ValueError(f'{k} must be an integer')
+
+    server = SessionServer(run, max_sessions=args.max_sessions, check_params=check_params)
+    asyncio.run(server.serve(args.host, args.port))
+
+
+def build_grid(args):
+    personas = args.personas or sorted(Persona.story_dict.keys())
+    scenarios = args.scenarios or SCENARIOS
+    grid = []
+    for sample_idx, scenario, prompt_therapist, seed in product(personas, scenarios, args.therapists, args.seeds):
+        cell = argparse.Namespace(**vars(args))
+        cell.sample_idx = sample_idx
+        cell.scenario = scenario
+        cell.prompt_therapist = prompt_therapist
+        cell.seed = seed
+        grid.append(cell)
+    return grid
+
+
+def _run_cell(cell):
+    try:
+        return 'done', run_session(cell), None
+    except Exception as err:
+        return 'failed', None, repr(err)
+
+
+def sweep(args):
+    """
+    Run every cell of the persona x scenario x therapist x seed grid on a process pool.
+    Cells whose experiments.csv already exists are skipped, and the outcome of
+    every cell is written to `{output_root}/sweep_index.csv`.
+    """
+    index = []
+    pending = {}
+    grid = build_grid(args)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for cell in grid:
+            # Workers split the rate limits evenly
+            cell.rate_share = min(args.workers, len(grid))
+            row = dict(persona=cell.sample_idx, scenario=cell.scenario, therapist=cell.prompt_therapist, seed=cell.seed)
+            path = f'{get_output_dir(cell)}/{get_run_name(cell)}/experiments.csv'
+            if os.path.exists(path):
+                index.append(dict(row, status='skipped', path=path, error=None))
+            else:
+                pending[executor.submit(_run_cell, cell)] = row
+
+        logging.info(f'{len(pending)} cells to run, {len(index)} skipped')
+        for future in as_completed(pending):
+            row = pending[future]
+            status, path, error = future.result()
+            logging.info(f'{status} : {row}' + (f' ({error})' if error else ''))
+            index.append(dict(row, status=status, path=path, error=error))
+
+    os.makedirs(args.output_root, exist_ok=True)
+    index = pd.DataFrame(index).sort_values(['persona', 'scenario', 'therapist', 'seed'])
+    index.to_csv(f'{args.output_root}/sweep_index.csv', index=False)
+    return index
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # engine.field messages go to logs/ next to this script, wherever it is launched from
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    logging.getLogger('engine.field').addHandler(logging.FileHandler(f'{log_dir}/engine.field.log', 'w', 'utf-8'))
+    if args.serve:
+        serve(args)
+    elif args.sweep:
+        sweep(args)
+    else:
+        run_session(args)
 
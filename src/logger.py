@@ -29,3 +29,11 @@ class Logger:
 
     def info(self, line):
         self.logger.info(line)
+
+    def close(self):
+        """Close the file handlers and forget the logger, so that processes running many sessions do not keep them."""
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        if logging.Logger.manager.loggerDict.get(self.logger.name) is self.logger:
+            del logging.Logger.manager.loggerDict[self.logger.name]
@@ -0,0 +1,102 @@
+import os
+import pickle
+import logging
+from pathlib import Path
+from typing import Dict, Iterator
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRNAME = '__pycache__'
+
+
+def load_yaml(path: Path):
+    # Imported here : cached files do not need yaml at all
+    import yaml
+    # libyaml when it is compiled in, the pure python loader otherwise
+    SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        with open(path, encoding='utf-8') as fh:
+            return yaml.load(fh, Loader=SafeLoader)
+    except UnicodeDecodeError:
+        with open(path) as fh:
+            return yaml.load(fh, Loader=SafeLoader)
+
+
+class YamlRegistry(MutableMapping):
+    """
+    Mapping of the ``*.yml`` files of a directory, keyed by file stem.
+
+    Only the file names are listed up front; a file is parsed on first access and kept
+    in memory. Parsed files are also pickled under ``__pycache__``, tagged with the
+    mtime and size of the source, so later processes skip the yaml parsing until the
+    file changes. Entries set explicitly take precedence over the files.
+    """
+
+    def __init__(self, root: Path, cache_dir: Path = None) -> None:
+        self.root = Path(root)
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else self.root / CACHE_DIRNAME
+        self._paths = None
+        self._loaded: Dict = dict()
+
+    @property
+    def paths(self) -> Dict[str, Path]:
+        if self._paths is None:
+            self._paths = {path.stem: path for path in sorted(self.root.glob('*.yml'))}
+        return self._paths
+
+    def __getitem__(self, key: str):
+        if key not in self._loaded:
+            self._loaded[key] = self._load(self.paths[key])
+        return self._loaded[key]
+
+    def __setitem__(self, key: str, value) -> None:
+        self._loaded[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._loaded and key not in self.paths:
+            raise KeyError(key)
+        self._loaded.pop(key, None)
+        self.paths.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.paths
+        yield from (key for key in self._loaded if key not in self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths.keys() | self._loaded.keys())
+
+    def __contains__(self, key) -> bool:
+        return key in self._loaded or key in self.paths
+
+    def _load(self, path: Path):
+        stat = path.stat()
+        tag = (stat.st_mtime_ns, stat.st_size)
+        cache_path = self.cache_dir / f'{path.name}.pickle'
+        try:
+            with open(cache_path, 'rb') as fh:
+                cached_tag, content = pickle.load(fh)
+            if cached_tag == tag:
+                return content
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            pass
+
+        try:
+            content = load_yaml(path)
+        except Exception:
+            logger.error(f'Error with {path}')
+            raise
+
+        try:
+            self.cache_dir.mkdir(exist_ok=True)
+            tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as fh:
+                pickle.dump((tag, content), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError as err:
+            # Read-only checkout : parse again next time
+            logger.debug(f'Cannot cache {path} : {err}')
+        return content
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({self.root}, {list(self)})'